@@ -1 +1,13 @@
-from openbis_json_parser.main import parse_dict, parse_json, write_ontology
+from openbis_json_parser.main import (
+    ConversionCache,
+    PropertyRegistry,
+    TripleBuffer,
+    TripleStore,
+    convert_json,
+    delta_json,
+    parse_dict,
+    parse_json,
+    stream_dict,
+    stream_json,
+    write_ontology,
+)
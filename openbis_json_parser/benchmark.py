@@ -0,0 +1,719 @@
+import contextlib
+import copy
+import glob
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+from rdflib import DCAT, RDF, Literal, URIRef
+
+from openbis_json_parser import main as obis_parser
+from openbis_json_parser.main import OBIS, build_index, load_index, load_ontology, obis
+
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+FIXTURES = ["user", "collection", "object", "project", "space", "dataset"]
+
+
+def load_fixture(name):
+    with open(os.path.join(__location__, "tests", f"{name}.json")) as f:
+        return json.load(f)
+
+
+def _reference_keys(data, keys=None):
+    # keys holding a full json object somewhere, an int under them is a back reference
+    keys = set() if keys is None else keys
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, dict) and "@id" in value:
+                keys.add(key)
+            _reference_keys(value, keys)
+    elif isinstance(data, list):
+        for item in data:
+            _reference_keys(item, keys)
+    return keys
+
+
+def _shift_ids(data, offset, reference_keys):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key == "@id" or (key in reference_keys and isinstance(value, int) and not isinstance(value, bool)):
+                data[key] = value + offset
+            else:
+                _shift_ids(value, offset, reference_keys)
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            if isinstance(item, int) and not isinstance(item, bool):
+                data[i] = item + offset
+            else:
+                _shift_ids(item, offset, reference_keys)
+
+
+def search_result(copies=50):
+    # a SearchResult holding every fixture entity several times, @ids are unique like in one jackson document
+    objects = []
+    for name in FIXTURES:
+        fixture = load_fixture(name)
+        reference_keys = _reference_keys(fixture)
+        for _ in range(copies):
+            hit = copy.deepcopy(fixture)
+            _shift_ids(hit, 1000 * (len(objects) + 1), reference_keys)
+            objects.append(hit)
+    return {
+        "@type": "as.dto.common.search.SearchResult",
+        "@id": 0,
+        "objects": objects,
+        "totalCount": len(objects),
+    }
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    # best of repeat runs, the parsers debug output is discarded
+    best = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def scan_obis_entity(string: str):
+    # the per key graph query get_obis_entity used before the index existed
+    hits = list(obis[: OBIS.openbis_json_key : Literal(string)])
+    if hits:
+        return hits[0]
+    else:
+        return None
+
+
+def json_keys(data, keys=None):
+    keys = [] if keys is None else keys
+    if isinstance(data, dict):
+        for key, value in data.items():
+            keys.append(key)
+            if key == "@type":
+                keys.append(value)
+            json_keys(value, keys)
+    elif isinstance(data, list):
+        for item in data:
+            json_keys(item, keys)
+    return keys
+
+
+def bench_key_lookup():
+    keys = json_keys([load_fixture(name) for name in FIXTURES])
+    scan = timed(lambda: [scan_obis_entity(key) for key in keys])
+    index = timed(lambda: [obis_parser.get_obis_entity(key) for key in keys])
+    print(f"key lookup ({len(keys)} keys): graph scan {scan * 1e3:.2f} ms, index {index * 1e3:.2f} ms")
+
+
+def bench_parse_per_object(copies=50):
+    data = search_result(copies)
+    count = len(data["objects"])
+    index = timed(obis_parser.parse_dict, data, repeat=1)
+    obis_parser.get_obis_entity, lookup = scan_obis_entity, obis_parser.get_obis_entity
+    try:
+        scan = timed(obis_parser.parse_dict, data, repeat=1)
+    finally:
+        obis_parser.get_obis_entity = lookup
+    print(
+        f"parse_dict per object ({count} objects): graph scan {scan / count * 1e3:.3f} ms, "
+        f"index {index / count * 1e3:.3f} ms"
+    )
+
+
+def bench_startup(runs=5):
+    parse = timed(lambda: build_index(load_ontology()))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        load_index(cache_dir=cache_dir)
+        cached = timed(load_index, cache_dir=cache_dir)
+    print(f"ontology index: parse openbis.ttl {parse * 1e3:.2f} ms, compiled cache {cached * 1e3:.2f} ms")
+
+    # a fresh interpreter importing the parser and resolving one key, like a cli run
+    code = "from openbis_json_parser import main; main.get_obis_entity('code')"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, OPENBIS_JSON_PARSER_CACHE=cache_dir)
+        subprocess.run([sys.executable, "-c", code], cwd=__location__, env=env, check=True)
+        start = time.perf_counter()
+        for _ in range(runs):
+            subprocess.run([sys.executable, "-c", code], cwd=__location__, env=env, check=True)
+        warm = (time.perf_counter() - start) / runs
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run([sys.executable, "-c", "import rdflib"], check=True)
+    rdflib_only = (time.perf_counter() - start) / runs
+    print(f"interpreter start + import + first lookup: {warm * 1e3:.1f} ms (rdflib import alone {rdflib_only * 1e3:.1f} ms)")
+
+
+def bench_iri_assignment(copies=(10, 50, 100)):
+    for n in copies:
+        data = search_result(n)
+        legacy = timed(obis_parser.parse_dict, data, single_pass=False, repeat=1)
+        single_pass = timed(obis_parser.parse_dict, data, single_pass=True, repeat=1)
+        print(
+            f"parse_dict ({len(data['objects'])} objects): fix_iris {legacy * 1e3:.0f} ms, "
+            f"single pass {single_pass * 1e3:.0f} ms"
+        )
+
+
+def _peak_memory(func, *args, **kwargs):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+def bench_streaming_memory(copies=(10, 50)):
+    def materialized(data):
+        with tempfile.TemporaryDirectory() as target:
+            obis_parser.write_ontology(obis_parser.parse_dict(data), os.path.join(target, "out.nt"), "ntriples")
+
+    def streamed(data):
+        with open(os.devnull, "wb") as devnull:
+            obis_parser.stream_dict(data, devnull)
+
+    for n in copies:
+        data = search_result(n)
+        graph = _peak_memory(materialized, data)
+        stream = _peak_memory(streamed, data)
+        print(
+            f"ntriples peak memory ({len(data['objects'])} objects): graph {graph / 2**20:.1f} MiB, "
+            f"streaming {stream / 2**20:.1f} MiB"
+        )
+
+
+def bench_streaming_input(copies=50):
+    def loaded(path):
+        with open(path) as f, open(os.devnull, "wb") as devnull:
+            obis_parser.stream_dict(json.load(f), devnull)
+
+    def incremental(path):
+        with open(os.devnull, "wb") as devnull:
+            obis_parser.stream_json(path, devnull)
+
+    data = search_result(copies)
+    with tempfile.TemporaryDirectory() as target:
+        path = os.path.join(target, "search_result.json")
+        with open(path, "w") as f:
+            json.dump(data, f)
+        size = os.path.getsize(path)
+        del data
+        load = _peak_memory(loaded, path)
+        stream = _peak_memory(incremental, path)
+    print(
+        f"json input peak memory ({size / 2**20:.1f} MiB file): json.load {load / 2**20:.1f} MiB, "
+        f"incremental {stream / 2**20:.1f} MiB"
+    )
+
+
+def bench_json_decode(copies=(10, 50, 100)):
+    orjson = obis_parser.orjson
+    for n in copies:
+        text = json.dumps(search_result(n)).encode("utf-8")
+        plain = timed(json.loads, text)
+        obis_parser.orjson = None
+        try:
+            stdlib = timed(obis_parser.loads_json, text)
+            stdlib_memory = _peak_memory(obis_parser.loads_json, text)
+        finally:
+            obis_parser.orjson = orjson
+        line = (
+            f"json decode ({len(text) / 2**20:.1f} MiB): json.loads {plain * 1e3:.1f} ms "
+            f"{_peak_memory(json.loads, text) / 2**20:.1f} MiB, "
+            f"loads_json {stdlib * 1e3:.1f} ms {stdlib_memory / 2**20:.1f} MiB"
+        )
+        if orjson is not None:
+            line += f", with orjson {timed(obis_parser.loads_json, text) * 1e3:.1f} ms"
+        print(line)
+
+
+def property_values(data, values=None):
+    values = [] if values is None else values
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key == "properties" and isinstance(value, dict):
+                values.extend(value.values())
+            else:
+                property_values(value, values)
+    elif isinstance(data, list):
+        for item in data:
+            property_values(item, values)
+    return values
+
+
+def bench_value_types(copies=200):
+    # fixture values plus a controlled vocabulary, units and flags, repeated like in an export
+    values = property_values([load_fixture(name) for name in FIXTURES])
+    values += ["DRAFT", "FINAL", "mm", "kg", "true", "false", "12.5", "3", "2024-09-04", "4,9,2024"]
+    values = [value for value in values if isinstance(value, str)] * copies
+
+    def uncached():
+        for value in values:
+            obis_parser._value_literal(value)
+
+    def cached():
+        obis_parser._value_cache.clear()
+        for value in values:
+            obis_parser.value_literal(value)
+
+    def batch():
+        obis_parser._value_cache.clear()
+        obis_parser.value_literals(values)
+
+    print(
+        f"value type inference ({len(values)} values, {len(set(values))} distinct): "
+        f"uncached {timed(uncached, repeat=1) * 1e3:.1f} ms, lru cache {timed(cached) * 1e3:.1f} ms, "
+        f"batch {timed(batch) * 1e3:.1f} ms"
+    )
+
+
+def bench_literals(values=(100000, 1000000), distinct=50000):
+    # property values (comma decimals, integers, text) and timestamps as a large export has them: converted one
+    # at a time like before, with the number fast path, and in the deferred batches of iterate_json
+    import random
+    import re
+
+    r = random.Random(0)
+    raw = []
+    for i in range(max(values)):
+        kind = i % 4
+        if kind == 0:
+            raw.append(("value", f"{r.randrange(distinct) / 1000:.3f}".replace(".", ",")))
+        elif kind == 1:
+            raw.append(("value", str(r.randrange(distinct))))
+        elif kind == 2:
+            raw.append(("value", r.choice(["DRAFT", "FINAL", "mm", "kg", "4,9,2024"])))
+        else:
+            raw.append(("date", 1685542100000 + r.randrange(distinct) * 997))
+    node, relation = URIRef("https://example.com/object/1"), OBIS.code
+    graph = _NullGraph()
+
+    def convert(rows):
+        obis_parser._value_cache.clear()
+        with obis_parser._literal_batch(graph):
+            for kind, value in rows:
+                if kind == "value":
+                    obis_parser.describe_value(graph, node, relation, value)
+                else:
+                    obis_parser._add_annotation(graph, node, "registrationDate", value, None)
+
+    never = re.compile("(?!)")
+    for n in values:
+        rows = raw[:n]
+        results = {}
+        with mock.patch.object(obis_parser, "LITERAL_BATCH_SIZE", 0):
+            with mock.patch.object(obis_parser, "_INT_VALUE", never), mock.patch.object(obis_parser, "_FLOAT_VALUE", never):
+                results["literal_eval"] = timed(convert, rows, repeat=1)
+            results["per value"] = timed(convert, rows, repeat=1)
+        results[f"batched, memo of {obis_parser.LITERAL_MEMO_SIZE}"] = timed(convert, rows, repeat=1)
+        print(
+            f"literals ({n} values, {distinct} distinct per kind): "
+            + ", ".join(f"{name} {elapsed:.2f} s" for name, elapsed in results.items())
+        )
+
+
+class _NullGraph:
+    # takes the triples without storing them, so only the traversal is measured
+    def add(self, triple):
+        pass
+
+    def subjects(self, predicate, object):
+        return iter(())
+
+
+def count_nodes(data):
+    nodes, stack = 0, [data]
+    while stack:
+        value = stack.pop()
+        nodes += 1
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return nodes
+
+
+def bench_emit_once(copies=(50, 200)):
+    # a SearchResult whose hits embed their own copies of the same persons, spaces, projects, data stores and
+    # types: traversing every copy against linking the copies of an entity written before
+    for n in copies:
+        data = search_result(n)
+        results = {}
+        for name, classes in (("every copy", frozenset()), ("emit once", obis_parser.EMIT_ONCE_CLASSES)):
+            with mock.patch.object(obis_parser, "EMIT_ONCE_CLASSES", classes):
+                _, stats = obis_parser.parse_dict(copy.deepcopy(data), stats=True)
+            results[name] = stats
+        once, every = results["emit once"], results["every copy"]
+        saved = every.phases["iterate_json"] - once.phases["iterate_json"]
+        print(
+            f"repeated entities ({len(data['objects'])} hits): {sum(once.repeated_entities.values())} copies skipped, "
+            f"iterate_json {every.phases['iterate_json']:.2f} s -> {once.phases['iterate_json']:.2f} s "
+            f"({saved:.2f} s saved), triples {every.triples} -> {once.triples}"
+        )
+
+
+def bench_traversal(copies=50, depth=5000):
+    data = search_result(copies)
+    nodes = count_nodes(data)
+    elapsed = timed(obis_parser.iterate_json, data, _NullGraph())
+    print(f"iterate_json ({nodes} json nodes): {elapsed / nodes * 1e6:.2f} us per node")
+
+    chain = None
+    for i in range(depth, 0, -1):
+        chain = {"@type": "as.dto.sample.Sample", "@id": i, "code": f"S{i}", "parents": [chain] if chain else []}
+    elapsed = timed(obis_parser.iterate_json, chain, _NullGraph(), repeat=1)
+    print(f"iterate_json (parent chain of {depth} samples): {elapsed * 1e3:.0f} ms")
+
+
+def bench_batch(files=60, jobs=(1, os.cpu_count() or 1)):
+    # one cli run per file, like the nightly job did, against batch runs over the same files
+    cli = [sys.executable, "-m", "openbis_json_parser.cli"]
+    cwd = os.path.dirname(__location__)
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(files):
+            name = FIXTURES[i % len(FIXTURES)]
+            with open(os.path.join(tmp, f"{name}-{i}.json"), "w") as f:
+                json.dump(load_fixture(name), f)
+        paths = sorted(glob.glob(os.path.join(tmp, "*.json")))
+        sample = paths[:10]
+        start = time.perf_counter()
+        for path in sample:
+            subprocess.run(cli + [path, "-o", os.devnull], cwd=cwd, check=True, capture_output=True)
+        single = (time.perf_counter() - start) / len(sample)
+        print(f"cli per file: {1 / single:.1f} files/s")
+        for n in sorted(set(jobs)):
+            start = time.perf_counter()
+            subprocess.run(cli + [tmp, "-j", str(n), "-o", os.devnull], cwd=cwd, check=True, capture_output=True)
+            elapsed = time.perf_counter() - start
+            print(f"cli batch -j {n} ({files} files): {files / elapsed:.1f} files/s")
+
+
+def file_listing(files=5000):
+    # the dataset fixture with a large synthetic file listing, the first file carries the data store
+    data = load_fixture("dataset")
+    template = next(f for f in data["files"]["objects"] if not f["directory"])
+    permid = template["permId"]["dataSetId"]["permId"]
+    objects = []
+    for i in range(files):
+        first = 100000 + 4 * i
+        path = f"original/file_{i:06d}.dat"
+        entry = copy.deepcopy(template)
+        entry["@id"] = first
+        entry["permId"] = {
+            "@type": "dss.dto.datasetfile.id.DataSetFilePermId",
+            "@id": first + 1,
+            "dataSetId": {"@type": "as.dto.dataset.id.DataSetPermId", "@id": first + 2, "permId": permid},
+            "filePath": path,
+        }
+        entry["dataSetPermId"] = first + 2
+        if i == 0:
+            entry["dataStore"] = dict(data["dataStore"], **{"@id": 99999})
+        else:
+            entry["dataStore"] = 99999
+        entry["path"] = path
+        objects.append(entry)
+    data["files"]["objects"] = objects
+    data["files"]["totalCount"] = files
+    return data
+
+
+def bench_file_listing(files=(20000, 100000)):
+    # streaming a dataset with a large file listing, the files converted one by one or a column at a time
+    from unittest import mock
+
+    for n in files:
+        data = file_listing(n)
+        with open(os.devnull, "wb") as devnull:
+            with mock.patch.dict(obis_parser.LIST_HANDLERS, clear=True):
+                per_file = timed(obis_parser.stream_dict, data, devnull, repeat=1)
+            columnar = timed(obis_parser.stream_dict, data, devnull, repeat=1)
+        print(f"file listing ({n} files): per file {n / per_file:.0f} files/s, columnar {n / columnar:.0f} files/s")
+
+
+def scan_attach_distributions(graph):
+    # attach_distributions before the lookups were indexed, several graph scans per distribution
+    for distribution in graph[: RDF.type : DCAT.Distribution]:
+        for permid in graph.objects(distribution, OBIS.dataset_permid):
+            identifer = next(graph.subjects(RDF.value, permid), None)
+            if identifer:
+                dataset = next(graph.subjects(OBIS.has_identifier, identifer), None)
+                if dataset:
+                    graph.add((dataset, DCAT.distribution, distribution))
+                    store = [
+                        store
+                        for store in graph.subjects(RDF.type, OBIS.DataStore)
+                        if store in graph.objects(dataset, OBIS.relates_to)
+                    ][0]
+                    store_url = graph.value(store, DCAT.endpointURL)
+                    file_url = graph.value(distribution, OBIS.file_path)
+                    if store_url:
+                        obj = URIRef(f"{store_url}/datastore_server/{permid}/{file_url}")
+                        graph.add((distribution, DCAT.downloadURL, obj))
+    return graph
+
+
+def bench_attach_distributions(files=(1000, 5000)):
+    for n in files:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            graph = obis_parser.parse_dict(file_listing(n))
+        indexed = timed(obis_parser.attach_distributions, graph, repeat=1)
+        scan = timed(scan_attach_distributions, graph, repeat=1)
+        print(f"attach_distributions ({n} files): scan {scan * 1e3:.0f} ms, indexed {indexed * 1e3:.0f} ms")
+
+
+def _rss_kib(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise OSError(f"no {field} in /proc/self/status")
+
+
+def _reset_peak_rss():
+    # linux resets the high water mark of the resident set when 5 is written to clear_refs,
+    # elsewhere the peak is the one of the whole process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    try:
+        return _rss_kib("VmHWM") * 1024
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def bench_phases(samples=(500, 2000), base_url="https://openbis.matolab.org/"):
+    # wall time, peak rss and triples/s of each conversion step on synthetic exports, triples/s is
+    # the size of the resulting graph over the time of the step
+    from openbis_json_parser.synthetic import generate_export
+
+    for n in samples:
+        data = generate_export(n)
+        json_bytes = json.dumps(data).encode("utf-8")
+        rows = []
+
+        def phase(name, func, *args, **kwargs):
+            per_phase = _reset_peak_rss()
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                result = func(*args, **kwargs)
+                elapsed = time.perf_counter() - start
+            rows.append((name, elapsed, _peak_rss(), per_phase))
+            return result
+
+        data = phase("decode", obis_parser.loads_json, json_bytes)
+        iris = phase("resolve_iris", obis_parser.resolve_iris, data, base_url=base_url)
+        graph = obis_parser.Graph()
+        phase("iterate_json", obis_parser.iterate_json, data, graph, base_url=base_url, iris=iris)
+        graph = phase("drop_iris", obis_parser.drop_iris, graph, iris.dropped)
+        graph = phase("attach_distributions", obis_parser.attach_distributions, graph)
+        for target_format in ("turtle", "ntriples"):
+            phase(f"write_ontology {target_format}", obis_parser.write_ontology, graph, io.BytesIO(), target_format)
+        # the two pass conversion fix_iris belongs to
+        legacy, references = obis_parser.Graph(), {}
+        phase("iterate_json (two pass)", obis_parser.iterate_json, data, legacy, base_url=base_url, references=references)
+        phase("fix_iris (two pass)", obis_parser.fix_iris, legacy, base_url=base_url, references=references.values())
+
+        triples = len(graph)
+        print(f"phases of a synthetic export: {n} samples, {len(json_bytes) / 2**20:.1f} MiB json, {triples} triples")
+        for name, elapsed, peak, per_phase in rows:
+            print(
+                f"  {name:<26} {elapsed * 1e3:9.0f} ms  {peak / 2**20:7.1f} MiB peak rss{'' if per_phase else ' (process)'}"
+                f"  {triples / elapsed:10.0f} triples/s"
+            )
+
+
+def bench_triple_buffer(samples=(500, 2000)):
+    # memory per triple of the graph parse_dict builds against the compact TripleBuffer, the json is excluded
+    from openbis_json_parser.synthetic import generate_export
+
+    for n in samples:
+        data = generate_export(n)
+        sizes, times = {}, {}
+        for compact in (False, True):
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                tracemalloc.start()
+                start = time.perf_counter()
+                result = obis_parser.parse_dict(data, compact=compact)
+                times[compact] = time.perf_counter() - start
+                sizes[compact] = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+            triples = len(result)
+            del result
+        print(
+            f"parse_dict ({triples} triples): graph {sizes[False] / triples:.0f} B/triple in {times[False]:.2f} s, "
+            f"TripleBuffer {sizes[True] / triples:.0f} B/triple in {times[True]:.2f} s"
+        )
+
+
+def bench_triple_store(exports=8, samples=200):
+    # merging several exports of one instance: into one Graph against a TripleStore on disk, the persons,
+    # spaces, projects, types and data stores they share are kept once in both
+    from openbis_json_parser.synthetic import generate_export
+
+    datas = [generate_export(samples, seed=seed) for seed in range(exports)]
+
+    def merged_graph():
+        graph = obis_parser.Graph()
+        for data in datas:
+            graph += obis_parser.parse_dict(copy.deepcopy(data))
+        with open(os.devnull, "wb") as devnull:
+            obis_parser.write_ontology(graph, devnull, "ntriples")
+
+    with tempfile.TemporaryDirectory() as target:
+        path = os.path.join(target, "store.db")
+
+        def merged_store():
+            with obis_parser.TripleStore(path) as store:
+                for data in datas:
+                    store.add_dict(copy.deepcopy(data))
+                with open(os.devnull, "wb") as devnull:
+                    store.export(devnull)
+
+        start = time.perf_counter()
+        graph = _peak_memory(merged_graph)
+        graph_time = time.perf_counter() - start
+        start = time.perf_counter()
+        store = _peak_memory(merged_store)
+        store_time = time.perf_counter() - start
+        with obis_parser.TripleStore(path) as merged:
+            triples = len(merged)
+        print(
+            f"merge {exports} exports ({triples} triples): graph {graph / 2**20:.1f} MiB peak in {graph_time:.2f} s, "
+            f"TripleStore {store / 2**20:.1f} MiB peak in {store_time:.2f} s, {os.path.getsize(path) / 2**20:.1f} MiB on disk"
+        )
+
+
+def bench_property_registry(samples=500, properties=40):
+    # objects with many custom properties, each property looked up in the graph and created again for every
+    # value against once per conversion from the PropertyRegistry
+    from openbis_json_parser.synthetic import generate_export
+
+    data = generate_export(samples)
+    for item in data["objects"]:
+        if isinstance(item, dict) and isinstance(item.get("properties"), dict):
+            item["properties"].update({f"EMODUL_EXTRA.PROPERTY_{i}": f"{i}.5" for i in range(properties)})
+
+    iris = obis_parser.resolve_iris(data)
+
+    def convert(registry):
+        graph = obis_parser.Graph()
+        # without a registry iterate_json looks every property up in the graph
+        with obis_parser._property_registry() if registry else contextlib.nullcontext():
+            obis_parser.iterate_json(data, graph, iris=iris)
+        return graph
+
+    for name, registry in (("graph lookup", False), ("registry", True)):
+        start = time.perf_counter()
+        graph = convert(registry)
+        print(
+            f"iterate_json with {properties} extra properties per object ({len(graph)} triples), {name}: "
+            f"{time.perf_counter() - start:.2f} s"
+        )
+
+
+def bench_shards(samples=3000, level="collection", jobs=(1, os.cpu_count() or 1)):
+    # turtle of a whole export in one piece, against one file per collection serialized by several processes
+    from openbis_json_parser import cli
+    from openbis_json_parser.synthetic import generate_export
+
+    graph = obis_parser.parse_dict(generate_export(samples, experiments=samples // 100), compact=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        whole = timed(obis_parser.write_ontology, graph, os.path.join(tmp, "export.ttl"), "turtle", repeat=1)
+        print(f"turtle ({len(graph)} triples): one file {whole:.2f} s")
+        for n in sorted(set(jobs)):
+            elapsed = timed(
+                cli.write_shards,
+                graph,
+                output_dir=tmp,
+                level=level,
+                target_format="turtle",
+                jobs=n,
+                report=io.StringIO(),
+                repeat=1,
+            )
+            print(f"turtle ({len(graph)} triples): shards by {level}, {n} jobs {elapsed:.2f} s")
+
+
+def bench_compression(copies=50):
+    # streaming a search result to ntriples, plain and compressed on both ends: time and bytes on disk
+    data = search_result(copies)
+    with tempfile.TemporaryDirectory() as target:
+        for compression in [None] + list(obis_parser.COMPRESSIONS):
+            if compression == "zstd" and obis_parser.zstandard is None:
+                print("compressed streaming: zstd skipped, zstandard is not installed")
+                continue
+            extension = obis_parser.COMPRESSIONS.get(compression, "")
+            json_file = os.path.join(target, "search_result.json" + extension)
+            with obis_parser.open_output(json_file) as f:
+                f.write(json.dumps(data).encode("utf-8"))
+            output_file = os.path.join(target, "search_result.nt" + extension)
+            elapsed = timed(obis_parser.stream_json, json_file, output_file, repeat=1)
+            print(
+                f"compressed streaming ({compression or 'plain'}): {elapsed:.2f} s, "
+                f"input {os.path.getsize(json_file) / 2**10:.0f} KiB, output {os.path.getsize(output_file) / 2**10:.0f} KiB"
+            )
+
+
+def bench_fetch(samples=300, page_size=20, latency=0.3, jobs=(1, 4)):
+    # paged fetching from a stand-in openBIS answering after latency seconds, with several requests in flight
+    # the network waits overlap with the conversion of the pages that arrived
+    from openbis_json_parser import fetch
+    from openbis_json_parser.synthetic import generate_export
+
+    results = fetch.replay_results(generate_export(samples))
+    for n in jobs:
+        with fetch.ReplayServer(results, latency=latency) as server, open(os.devnull, "wb") as devnull:
+            start = time.perf_counter()
+            triples = fetch.fetch(server.url, devnull, user="user", password="", jobs=n, page_size=page_size)
+            elapsed = time.perf_counter() - start
+        print(
+            f"fetch {server.requests} requests with {latency * 1e3:.0f} ms latency, {n} jobs: {elapsed:.2f} s, "
+            f"{triples / elapsed:.0f} triples/s"
+        )
+
+
+def run():
+    bench_startup()
+    bench_key_lookup()
+    bench_parse_per_object()
+    bench_iri_assignment()
+    bench_streaming_memory()
+    bench_streaming_input()
+    bench_compression()
+    bench_json_decode()
+    bench_value_types()
+    bench_literals()
+    bench_property_registry()
+    bench_traversal()
+    bench_emit_once()
+    bench_attach_distributions()
+    bench_file_listing()
+    bench_phases()
+    bench_triple_buffer()
+    bench_triple_store()
+    bench_batch()
+    bench_shards()
+    bench_fetch()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,20 +1,346 @@
 import argparse
+import concurrent.futures
+import contextlib
+import cProfile
+import glob
+import io
 import json
+import logging
+import os
+import pstats
+import pathlib
 import sys
+import time
 import urllib.request
 
-from openbis_json_parser.main import parse_dict, parse_json, write_ontology
+from rdflib import URIRef
+
+from openbis_json_parser.main import (
+    COMPRESSIONS,
+    SHARD_LEVELS,
+    STREAMING_FORMATS,
+    ConversionCache,
+    ConversionStats,
+    PropertyRegistry,
+    TripleBuffer,
+    TripleStore,
+    compress_bytes,
+    compression_of,
+    convert_json,
+    delta_json,
+    init_worker,
+    json_store_rows,
+    load_json,
+    open_input,
+    open_output,
+    parse_dict,
+    parse_json,
+    set_debug,
+    shard_graph,
+    shard_name,
+    stream_json,
+    write_ontology,
+)
+
+# file extensions of the per file outputs in batch mode
+EXTENSIONS = {
+    "ntriples": ".nt",
+    "nquads": ".nq",
+    "rdfxml": ".rdf",
+    "turtle": ".ttl",
+    "ttl": ".ttl",
+    "json-ld": ".jsonld",
+}
+
+
+# json files searched for in directories, also compressed
+JSON_PATTERNS = ["*.json"] + [f"*.json{extension}" for extension in COMPRESSIONS.values()]
+
+
+def find_json_files(inputs, manifest=None):
+    # files, directories (searched for JSON_PATTERNS), glob patterns and manifest files listing one path per line
+    paths = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            paths += sorted(str(path) for pattern in JSON_PATTERNS for path in pathlib.Path(entry).rglob(pattern))
+        elif glob.has_magic(entry):
+            paths += sorted(glob.glob(entry, recursive=True))
+        else:
+            paths.append(entry)
+    if manifest:
+        with open(manifest) as f:
+            paths += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return list(dict.fromkeys(paths))
+
+
+# one conversion cache per directory and process, it keeps track of the size it wrote
+_caches = {}
+
+
+def get_cache(cache_dir, max_bytes=1 << 30):
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ConversionCache(cache_dir, max_bytes)
+    return _caches[cache_dir]
+
+
+def convert_file(
+    json_file, output_file=None, target_format="ntriples", base_url=None, graph_name=None, cache_dir=None, stats=False
+):
+    # converts one file in a worker, the output goes to output_file or is returned,
+    # returns (json_file, triples, output or None, error or None, ConversionStats.as_dict() or None)
+    collector = ConversionStats() if stats else None
+    try:
+        with collector.collect() if collector else contextlib.nullcontext():
+            if cache_dir is not None:
+                output = convert_json(json_file, target_format, base_url, graph_name=graph_name, cache=get_cache(cache_dir))
+                # cached outputs are not parsed again, only line based formats tell the number of triples
+                count = output.count(b"\n") if target_format in STREAMING_FORMATS else 0
+                if output_file:
+                    with open_output(output_file) as f:
+                        f.write(output)
+                    output = None
+            elif target_format in STREAMING_FORMATS:
+                target = output_file or io.BytesIO()
+                count = stream_json(json_file, target, target_format=target_format, base_url=base_url, graph_name=graph_name)
+                output = None if output_file else target.getvalue()
+            else:
+                onto = parse_json(json_file, base_url=base_url)
+                write_ontology(onto, output_file, target_format=target_format)
+                count, output = len(onto), None
+    except Exception as e:
+        return json_file, 0, None, f"{type(e).__name__}: {e}", None
+    return json_file, count, output, None, collector.as_dict() if collector else None
+
+
+def convert_files(
+    json_files,
+    target_file=None,
+    output_dir=None,
+    target_format="nquads",
+    base_url=None,
+    jobs=1,
+    report=sys.stderr,
+    cache_dir=None,
+    stats=None,
+    compression=None,
+):
+    # converts many files with a pool of jobs processes, either into one file per input in output_dir
+    # or into one stream, for nquads each file gets a named graph, returns the number of failed files.
+    # the ConversionStats of the workers are merged into stats if given, the outputs are compressed with
+    # compression or, for a target file name ending in one, its compression
+    if output_dir is None and target_format not in STREAMING_FORMATS:
+        raise ValueError(f"{target_format} can not be merged into one stream, give an output directory")
+    tasks = []
+    root = os.path.commonpath([os.path.abspath(path) for path in json_files]) if json_files else ""
+    if len(json_files) == 1:
+        root = os.path.dirname(root)
+    for json_file in json_files:
+        output_file, graph_name = None, None
+        if output_dir is not None:
+            relative = os.path.relpath(os.path.abspath(json_file), root)
+            if compression_of(relative):
+                relative = os.path.splitext(relative)[0]
+            output_file = os.path.join(output_dir, os.path.splitext(relative)[0] + EXTENSIONS[target_format])
+            if compression is not None:
+                output_file += COMPRESSIONS[compression]
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        elif target_format == "nquads":
+            graph_name = URIRef(pathlib.Path(json_file).resolve().as_uri())
+        tasks.append((json_file, output_file, target_format, base_url, graph_name, cache_dir, stats is not None))
+
+    start = time.perf_counter()
+    files, triples, failed = 0, 0, 0
+    with contextlib.ExitStack() as stack:
+        if jobs > 1 and tasks:
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker))
+            # results come back in input order, so the merged stream does not depend on the scheduling
+            results = pool.map(convert_file, *zip(*tasks), chunksize=max(1, min(64, len(tasks) // (jobs * 4))))
+        else:
+            results = (convert_file(*task) for task in tasks)
+        if output_dir is None and isinstance(target_file, str):
+            target_file = stack.enter_context(open_output(target_file, compression))
+        for json_file, count, output, error, file_stats in results:
+            if file_stats is not None:
+                stats.merge(ConversionStats.from_dict(file_stats))
+            if error:
+                failed += 1
+                print(f"{json_file}: {error}", file=report)
+                continue
+            files += 1
+            triples += count
+            if output is not None:
+                target_file.write(output)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(
+        f"converted {files} files ({failed} failed), {triples} triples in {elapsed:.2f} s: "
+        f"{files / elapsed:.1f} files/s, {triples / elapsed:.0f} triples/s",
+        file=report,
+    )
+    return failed
+
+
+# the properties of the files a process converted for a TripleStore, the store holds the definitions already
+_store_properties = PropertyRegistry()
+
+
+def store_file(json_file, base_url=None, stats=False):
+    # converts one file for a TripleStore in a worker, returns (json_file, rows, namespaces, error or None,
+    # ConversionStats.as_dict() or None)
+    collector = ConversionStats() if stats else None
+    try:
+        with collector.collect() if collector else contextlib.nullcontext():
+            rows, namespaces = json_store_rows(json_file, base_url=base_url, properties=_store_properties)
+    except Exception as e:
+        return json_file, None, None, f"{type(e).__name__}: {e}", None
+    return json_file, rows, namespaces, None, collector.as_dict() if collector else None
+
+
+def store_files(json_files, store, base_url=None, jobs=1, report=sys.stderr, stats=None):
+    # adds many files to a TripleStore, they are converted by a pool of jobs processes and written
+    # by this one, returns the number of failed files
+    start = time.perf_counter()
+    files, added, failed = 0, 0, 0
+    with contextlib.ExitStack() as stack:
+        if jobs > 1 and len(json_files) > 1:
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker))
+            results = pool.map(store_file, json_files, [base_url] * len(json_files), [stats is not None] * len(json_files))
+        else:
+            results = (store_file(json_file, base_url, stats is not None) for json_file in json_files)
+        for json_file, rows, namespaces, error, file_stats in results:
+            if file_stats is not None:
+                stats.merge(ConversionStats.from_dict(file_stats))
+            if error:
+                failed += 1
+                print(f"{json_file}: {error}", file=report)
+                continue
+            files += 1
+            added += store.add_rows(rows, namespaces)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(
+        f"stored {files} files ({failed} failed) in {elapsed:.2f} s, {added} new triples, {len(store)} in the store",
+        file=report,
+    )
+    return failed
+
+
+def write_shard(shard, output_file=None, target_format="nquads", graph_name=None, compression=None):
+    # serializes and compresses one shard in a worker, to output_file or returned,
+    # returns (output or None, bytes, triples)
+    output = compress_bytes(shard.serialize(format=target_format, graph_name=graph_name).encode("utf-8"), compression)
+    if output_file is None:
+        return output, len(output), len(shard)
+    with open(output_file, "wb") as f:
+        f.write(output)
+    return None, len(output), len(shard)
+
+
+def write_shards(
+    graph,
+    target_file=None,
+    output_dir=None,
+    level="project",
+    target_format="nquads",
+    base_url=None,
+    jobs=1,
+    report=sys.stderr,
+    compression=None,
+):
+    # splits a Graph or TripleBuffer with shard_graph and serializes the shards with a pool of jobs processes,
+    # into one file per shard in output_dir or as named graphs of one nquads file. shards.json in output_dir,
+    # or next to the file, lists the shards with their file, graph, offset, size and triples, returns it.
+    # compressed shards in one file are a gzip member or zstd frame each, which can be read on their own
+    if output_dir is None and target_format != "nquads":
+        raise ValueError(f"{target_format} has no named graphs, give an output directory")
+    if compression is None and output_dir is None and isinstance(target_file, str):
+        compression = compression_of(target_file)
+    start = time.perf_counter()
+    shards = shard_graph(graph, level)
+    # the shared triples first, then the shards by name
+    names = {container: shard_name(container, base_url) for container in shards}
+    containers = sorted(shards, key=lambda container: (container is not None, names[container]))
+    entries, tasks, taken = [], [], set()
+    for container in containers:
+        name = names[container]
+        while name in taken:
+            name += "_"
+        taken.add(name)
+        graph_name = container if target_format == "nquads" else None
+        entry = {"name": name, "container": None if container is None else str(container)}
+        if target_format == "nquads":
+            entry["graph"] = entry["container"]
+        output_file = None
+        if output_dir is not None:
+            entry["file"] = name + EXTENSIONS[target_format] + (COMPRESSIONS[compression] if compression else "")
+            output_file = os.path.join(output_dir, entry["file"])
+        entries.append(entry)
+        tasks.append((shards[container], output_file, target_format, graph_name, compression))
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        if jobs > 1 and len(tasks) > 1:
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs))
+            # results come back in shard order, so the offsets do not depend on the scheduling
+            results = pool.map(write_shard, *zip(*tasks))
+        else:
+            results = (write_shard(*task) for task in tasks)
+        if output_dir is not None:
+            manifest_file = os.path.join(output_dir, "shards.json")
+        elif isinstance(target_file, str):
+            manifest_file = target_file + ".shards.json"
+            target_file = stack.enter_context(open(target_file, "wb"))
+        else:
+            manifest_file = None
+        offset = 0
+        for entry, (output, size, triples) in zip(entries, results):
+            if output is not None:
+                target_file.write(output)
+                entry["offset"] = offset
+                offset += size
+            entry.update(bytes=size, triples=triples)
+    manifest = {"level": level, "format": target_format, "compression": compression, "shards": entries}
+    if manifest_file is not None:
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    triples = sum(entry["triples"] for entry in entries)
+    print(f"wrote {len(entries)} shards, {triples} triples in {elapsed:.2f} s", file=report)
+    return manifest
+
+
+def merge_files(json_files, base_url=None, report=sys.stderr):
+    # the conversions of many json files in one TripleBuffer, they share a PropertyRegistry,
+    # returns (buffer, number of failed files)
+    merged, properties, failed = TripleBuffer(), PropertyRegistry(), 0
+    for json_file in json_files:
+        try:
+            with open_input(json_file) as f:
+                buffer = parse_dict(load_json(f), base_url=base_url, compact=True, properties=properties)
+        except Exception as e:
+            failed += 1
+            print(f"{json_file}: {type(e).__name__}: {e}", file=report)
+            continue
+        for prefix, namespace in buffer.namespaces.items():
+            merged.bind(prefix, namespace)
+        for triple in buffer:
+            merged.add(triple)
+    return merged, failed
 
 
 def main():
     parser = argparse.ArgumentParser(prog="OpenBIS JSON Parser")
-    parser.add_argument("json_file", metavar="json-file")
+    parser.add_argument(
+        "json_file",
+        metavar="json-file",
+        nargs="*",
+        help="json file, url or - for stdin, several files, directories or glob patterns convert a batch",
+    )
     parser.add_argument("-o", "--output-file", help="Resulting ntriples")
     parser.add_argument(
         "-f",
         "--format",
         choices=["ntriples", "nquads", "rdfxml", "turtle", "ttl", "json-ld"],
-        default="ntriples",
+        default=None,
     )
     parser.add_argument(
         "-b",
@@ -22,19 +348,171 @@ def main():
         help="OpenBIS base URL",
         default="https://openbis.matolab.org/",
     )
+    parser.add_argument("-m", "--manifest", help="File listing json files to convert, one per line")
+    parser.add_argument("-d", "--output-dir", help="Write one output file per json file into this directory")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes in batch mode")
+    parser.add_argument("--cache-dir", help="Keep converted outputs in this directory and reuse them for unchanged inputs")
+    parser.add_argument(
+        "--state",
+        help="State file of the last run, only entities changed since then are converted and the output is a delta",
+    )
+    parser.add_argument(
+        "--removals", help="With --state, write the added triples to the output and the removed ones to this file"
+    )
+    parser.add_argument(
+        "--no-prune",
+        action="store_true",
+        help="With --state, keep the entities of the last run that are missing from a partial export",
+    )
+    parser.add_argument(
+        "--store",
+        help="Add the json files to this SQLite triple store, and export the whole store to the output file "
+        "if one is given or there are no json files",
+    )
+    parser.add_argument(
+        "--shard",
+        choices=list(SHARD_LEVELS),
+        help="Split the output by space, project or collection into one file per shard in --output-dir, or one "
+        "named graph per shard with nquads, serialized by --jobs processes and listed in a shards.json",
+    )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        choices=list(COMPRESSIONS),
+        help="Compress the output, also chosen by an output file ending in .gz or .zst. "
+        "Compressed input is recognized by itself",
+    )
+    parser.add_argument("--stats", action="store_true", help="Print time per phase and counters to stderr")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="-",
+        metavar="FILE",
+        help="Profile the conversion, print the top functions to stderr or save the profile to FILE",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every key and triple to stderr")
     args = parser.parse_args()
-    if args.json_file.startswith("http://") or args.json_file.startswith("https://"):
-        with urllib.request.urlopen(args.json_file) as resp:
-            data = json.load(resp)
-        onto = parse_dict(data, base_url=args.base_url)
-    elif args.json_file == "-":
-        onto = parse_dict(json.load(sys.stdin.buffer), base_url=args.base_url)
-    else:
-        onto = parse_json(args.json_file, base_url=args.base_url)
+    if not args.json_file and not args.manifest and not args.store:
+        parser.error("a json-file or a manifest is required")
     if args.output_file is None or args.output_file == "-":
-        write_ontology(onto, sys.stdout.buffer, target_format=args.format)
+        target_file = sys.stdout.buffer
     else:
-        write_ontology(onto, args.output_file, target_format=args.format)
+        target_file = args.output_file
+
+    single = args.json_file[0] if len(args.json_file) == 1 else None
+    if args.state and (args.manifest or args.output_dir or single is None):
+        parser.error("--state converts a single json file")
+    if args.no_prune and not args.state:
+        parser.error("--no-prune needs --state")
+    if args.store and (args.state or args.output_dir or args.cache_dir):
+        parser.error("--store can not be combined with --state, --output-dir or --cache-dir")
+    if args.shard and (args.store or args.state or args.cache_dir):
+        parser.error("--shard can not be combined with --store, --state or --cache-dir")
+    if args.shard and not args.output_dir and (target_file is sys.stdout.buffer or (args.format or "nquads") != "nquads"):
+        parser.error("--shard needs --output-dir, or nquads and an --output-file")
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr, format="%(message)s")
+        set_debug()
+    stats = ConversionStats() if args.stats else None
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        with contextlib.ExitStack() as stack:
+            if args.compress and not (args.output_dir or args.shard):
+                # compressed in a background thread while the conversion writes to it
+                target_file = stack.enter_context(open_output(target_file, args.compress))
+            failed = convert(args, single, target_file, stats)
+    finally:
+        if profiler:
+            profiler.disable()
+            if args.profile == "-":
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+            else:
+                profiler.dump_stats(args.profile)
+    if stats:
+        print(stats.report(), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+def convert(args, single, target_file, stats=None):
+    # the conversion main() asked for, returns the number of failed files
+    if args.store:
+        json_files = find_json_files(args.json_file, args.manifest)
+        failed = 0
+        with TripleStore(args.store) as store:
+            if json_files:
+                failed = store_files(json_files, store, base_url=args.base_url, jobs=args.jobs, stats=stats)
+            if args.output_file or not json_files:
+                store.export(target_file, target_format=args.format or "ntriples")
+        return failed
+    if args.shard:
+        json_files = find_json_files(args.json_file, args.manifest)
+        with stats.collect() if stats is not None else contextlib.nullcontext():
+            graph, failed = merge_files(json_files, base_url=args.base_url)
+        write_shards(
+            graph,
+            target_file,
+            output_dir=args.output_dir,
+            level=args.shard,
+            target_format=args.format or "nquads",
+            base_url=args.base_url,
+            jobs=args.jobs,
+            compression=args.compress,
+        )
+        return failed
+    if args.manifest or args.output_dir or single is None or os.path.isdir(single) or glob.has_magic(single):
+        # batch mode, merged streams are nquads unless told otherwise
+        target_format = args.format or ("ntriples" if args.output_dir else "nquads")
+        json_files = find_json_files(args.json_file, args.manifest)
+        failed = convert_files(
+            json_files,
+            target_file,
+            output_dir=args.output_dir,
+            target_format=target_format,
+            base_url=args.base_url,
+            jobs=args.jobs,
+            cache_dir=args.cache_dir,
+            stats=stats,
+            compression=args.compress if args.output_dir else None,
+        )
+        return failed
+
+    target_format = args.format or "ntriples"
+    with contextlib.ExitStack() as stack:
+        if stats is not None:
+            stack.enter_context(stats.collect())
+        if single.startswith("http://") or single.startswith("https://"):
+            source = stack.enter_context(urllib.request.urlopen(single))
+        elif single == "-":
+            source = sys.stdin.buffer
+        else:
+            source = single
+        json_file = stack.enter_context(open_input(source))
+        if args.state:
+            # rdf patch, or n-triples of the additions with --removals
+            delta_json(
+                json_file,
+                args.state,
+                target_file,
+                base_url=args.base_url,
+                removals_file=args.removals,
+                prune=not args.no_prune,
+            )
+        elif args.cache_dir:
+            output = convert_json(json_file, target_format, args.base_url, cache=get_cache(args.cache_dir))
+            if isinstance(target_file, str):
+                with open_output(target_file) as f:
+                    f.write(output)
+            else:
+                target_file.write(output)
+        elif target_format in STREAMING_FORMATS:
+            # line based formats are written while the json is read, without building the graph
+            stream_json(json_file, target_file, target_format=target_format, base_url=args.base_url)
+        else:
+            onto = parse_dict(load_json(json_file), base_url=args.base_url)
+            write_ontology(onto, target_file, target_format=target_format)
+    return 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,420 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import http.client
+import http.server
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+
+from openbis_json_parser.main import STREAMING_FORMATS, loads_json, serialize, stream_documents, unserialize
+
+# the v3 json-rpc api below the openBIS url
+API_PATH = "/openbis/openbis/rmi-application-server-v3.json"
+
+# kind of entity -> (search method, search criteria, fetch options)
+SEARCHES = {
+    "spaces": ("searchSpaces", "as.dto.space.search.SpaceSearchCriteria", "as.dto.space.fetchoptions.SpaceFetchOptions"),
+    "projects": (
+        "searchProjects",
+        "as.dto.project.search.ProjectSearchCriteria",
+        "as.dto.project.fetchoptions.ProjectFetchOptions",
+    ),
+    "experiments": (
+        "searchExperiments",
+        "as.dto.experiment.search.ExperimentSearchCriteria",
+        "as.dto.experiment.fetchoptions.ExperimentFetchOptions",
+    ),
+    "samples": ("searchSamples", "as.dto.sample.search.SampleSearchCriteria", "as.dto.sample.fetchoptions.SampleFetchOptions"),
+    "datasets": (
+        "searchDataSets",
+        "as.dto.dataset.search.DataSetSearchCriteria",
+        "as.dto.dataset.fetchoptions.DataSetFetchOptions",
+    ),
+}
+# json type of the entities -> kind, for replaying exports
+KINDS = {
+    "as.dto.space.Space": "spaces",
+    "as.dto.project.Project": "projects",
+    "as.dto.experiment.Experiment": "experiments",
+    "as.dto.sample.Sample": "samples",
+    "as.dto.dataset.DataSet": "datasets",
+}
+
+_PERSON = "as.dto.person.fetchoptions.PersonFetchOptions"
+_PROPERTIES = "as.dto.property.fetchoptions.PropertyFetchOptions"
+# relations fetched with the entities of each kind, key -> fetch options
+RELATIONS = {
+    "spaces": {"registrator": _PERSON},
+    "projects": {"space": "as.dto.space.fetchoptions.SpaceFetchOptions", "registrator": _PERSON, "modifier": _PERSON},
+    "experiments": {
+        "type": "as.dto.experiment.fetchoptions.ExperimentTypeFetchOptions",
+        "project": "as.dto.project.fetchoptions.ProjectFetchOptions",
+        "properties": _PROPERTIES,
+        "registrator": _PERSON,
+        "modifier": _PERSON,
+    },
+    "samples": {
+        "type": "as.dto.sample.fetchoptions.SampleTypeFetchOptions",
+        "project": "as.dto.project.fetchoptions.ProjectFetchOptions",
+        "space": "as.dto.space.fetchoptions.SpaceFetchOptions",
+        "experiment": "as.dto.experiment.fetchoptions.ExperimentFetchOptions",
+        "properties": _PROPERTIES,
+        "parents": "as.dto.sample.fetchoptions.SampleFetchOptions",
+        "children": "as.dto.sample.fetchoptions.SampleFetchOptions",
+        "registrator": _PERSON,
+        "modifier": _PERSON,
+    },
+    "datasets": {
+        "type": "as.dto.dataset.fetchoptions.DataSetTypeFetchOptions",
+        "experiment": "as.dto.experiment.fetchoptions.ExperimentFetchOptions",
+        "sample": "as.dto.sample.fetchoptions.SampleFetchOptions",
+        "properties": _PROPERTIES,
+        "dataStore": "as.dto.datastore.fetchoptions.DataStoreFetchOptions",
+        "registrator": _PERSON,
+        "modifier": _PERSON,
+    },
+}
+
+
+class FetchError(Exception):
+    pass
+
+
+def search_criteria(kind):
+    # matches every entity of the kind
+    return {"@type": SEARCHES[kind][1], "operator": "AND", "criteria": []}
+
+
+def fetch_options(kind):
+    options = {"@type": SEARCHES[kind][2]}
+    options.update((key, {"@type": options_type}) for key, options_type in RELATIONS[kind].items())
+    return options
+
+
+class Fetcher:
+    # client of the openBIS v3 json api, requests go over at most jobs pooled keep-alive connections and are
+    # retried with backoff on connection errors and 5xx answers. search() pages through a search with the
+    # from/count of the fetch options, jobs pages are requested ahead while the caller works on the last one
+    def __init__(self, url, token=None, jobs=4, page_size=1000, retries=3, backoff=0.5, timeout=60):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"not an http(s) url: {url}")
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path if parts.path.endswith(".json") else parts.path.rstrip("/") + API_PATH
+        self.token = token
+        self.jobs = jobs
+        self.page_size = page_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # idle connections, a request takes one or opens a new one
+        self.connections = queue.LifoQueue()
+        self.executor = None
+        self.logged_in = False
+        # requests answered, counted from the prefetch threads
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def post(self, body: bytes) -> bytes:
+        for attempt in itertools.count():
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                connection = self.connect()
+            try:
+                connection.request("POST", self.path, body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.connections.put(connection)
+                if response.status == 200:
+                    with self.lock:
+                        self.requests += 1
+                    return data
+                error = f"HTTP {response.status} {response.reason}"
+                if response.status < 500 and response.status != 429:
+                    raise FetchError(error)
+            if attempt >= self.retries:
+                raise FetchError(f"{error}, gave up after {attempt + 1} attempts")
+            time.sleep(self.backoff * 2**attempt)
+
+    def call(self, method, *params):
+        # one json-rpc call, returns its decoded result
+        body = json.dumps({"id": "1", "jsonrpc": "2.0", "method": method, "params": list(params)}).encode("utf-8")
+        response = loads_json(self.post(body))
+        if response.get("error"):
+            error = response["error"]
+            raise FetchError(f"{method}: {error.get('message', error) if isinstance(error, dict) else error}")
+        return response.get("result")
+
+    def login(self, user, password):
+        self.token = self.call("login", user, password)
+        if not self.token:
+            raise FetchError(f"login of {user} failed")
+        self.logged_in = True
+        return self.token
+
+    def search(self, kind, criteria=None, options=None):
+        # the pages of a search as SearchResult documents, in order
+        method = SEARCHES[kind][0]
+        criteria = criteria or search_criteria(kind)
+        options = options or fetch_options(kind)
+
+        def page(start):
+            return self.call(method, self.token, criteria, dict(options, **{"from": start, "count": self.page_size}))
+
+        first = page(0)
+        yield first
+        total = first.get("totalCount") or 0
+        starts = iter(range(self.page_size, total, self.page_size))
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs, thread_name_prefix="fetch")
+        pending = collections.deque(self.executor.submit(page, start) for start in itertools.islice(starts, self.jobs))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for start in itertools.islice(starts, 1):
+                    pending.append(self.executor.submit(page, start))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def pages(self, kinds=tuple(SEARCHES), criteria=None, options=None):
+        # the pages of the searches of several kinds one after another
+        for kind in kinds:
+            yield from self.search(kind, criteria=(criteria or {}).get(kind), options=(options or {}).get(kind))
+
+    def close(self):
+        if self.logged_in:
+            with contextlib.suppress(FetchError):
+                self.call("logout", self.token)
+            self.logged_in = False
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def fetch(
+    url,
+    target_file,
+    kinds=tuple(SEARCHES),
+    token=None,
+    user=None,
+    password=None,
+    target_format="ntriples",
+    base_url=None,
+    jobs=4,
+    page_size=1000,
+    retries=3,
+    criteria=None,
+    options=None,
+) -> int:
+    # pages through the searches of the given kinds and converts every page as it arrives into one stream,
+    # returns the number of lines written. iris are made from base_url, the openBIS url by default
+    with Fetcher(url, token=token, jobs=jobs, page_size=page_size, retries=retries) as fetcher:
+        if token is None:
+            fetcher.login(user, password)
+        pages = fetcher.pages(kinds, criteria=criteria, options=options)
+        return stream_documents(pages, target_file, target_format, base_url=base_url or url)
+
+
+def replay_results(data):
+    # the objects of an export by kind, with their @id back references resolved so every page can be
+    # written as a document of its own
+    data = unserialize(data)
+    objects = data.get("objects", []) if data.get("@type") == "as.dto.common.search.SearchResult" else [data]
+    results = {kind: [] for kind in SEARCHES}
+    for item in objects:
+        kind = KINDS.get(item.get("@type")) if isinstance(item, dict) else None
+        if kind is not None:
+            results[kind].append(item)
+    return results
+
+
+class ReplayServer:
+    # stand-in for the openBIS v3 api: login, logout and the search methods answered from the objects in
+    # results (kind -> list, see replay_results), paged by from/count and written like jackson does it.
+    # latency delays every answer, the first failures requests are answered with 503
+    def __init__(self, results, host="127.0.0.1", port=0, token="replay-token", latency=0.0, failures=0):
+        self.results = {SEARCHES[kind][0]: objects for kind, objects in results.items()}
+        self.token = token
+        self.latency = latency
+        self.failures = failures
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, response = server.answer(body)
+                if server.latency:
+                    time.sleep(server.latency)
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def answer(self, body):
+        # (status, json response) of one request
+        with self.lock:
+            self.requests += 1
+            if self.failures > 0:
+                self.failures -= 1
+                return 503, {"error": "unavailable"}
+        request = json.loads(body)
+        method, params = request.get("method"), request.get("params", [])
+
+        def result(value):
+            return 200, {"id": request.get("id"), "jsonrpc": "2.0", "result": value}
+
+        if method == "login":
+            return result(self.token)
+        if not params or params[0] != self.token:
+            return 200, {"id": request.get("id"), "jsonrpc": "2.0", "error": {"message": "invalid session token"}}
+        if method == "logout":
+            return result(None)
+        if method not in self.results:
+            return 200, {"id": request.get("id"), "jsonrpc": "2.0", "error": {"message": f"no such method {method}"}}
+        objects = self.results[method]
+        options = params[2] if len(params) > 2 and isinstance(params[2], dict) else {}
+        start = options.get("from") or 0
+        count = options.get("count")
+        page = objects[start:] if count is None else objects[start : start + count]
+        return result(
+            serialize({"@type": "as.dto.common.search.SearchResult", "objects": page, "totalCount": len(objects)})
+        )
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="OpenBIS JSON Parser Fetch")
+    parser.add_argument("url", nargs="?", help="openBIS url, e.g. https://openbis.example.org")
+    parser.add_argument(
+        "-k", "--kind", action="append", choices=list(SEARCHES), help="Entities to fetch, all kinds by default"
+    )
+    parser.add_argument("-u", "--user", help="Log in as this user, the password is read from $OPENBIS_PASSWORD")
+    parser.add_argument("-t", "--token", help="Session token of a logged in user")
+    parser.add_argument("-o", "--output-file", help="Resulting ntriples")
+    parser.add_argument("-f", "--format", choices=list(STREAMING_FORMATS), default="ntriples")
+    parser.add_argument("-b", "--base-url", help="Base URL of the iris, the openBIS url by default")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of concurrent requests")
+    parser.add_argument("--page-size", type=int, default=1000, help="Objects per request")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of a failed request")
+    parser.add_argument(
+        "--fetch-options", help="Json file with the search criteria and fetch options by kind: {kind: {criteria, options}}"
+    )
+    parser.add_argument("--serve", metavar="JSON_FILE", help="Replay the export in JSON_FILE as a stand-in openBIS")
+    parser.add_argument("-p", "--port", type=int, default=8081, help="Port of the stand-in with --serve")
+    args = parser.parse_args()
+
+    if args.serve:
+        with open(args.serve, "rb") as f:
+            results = replay_results(json.load(f))
+        with ReplayServer(results, port=args.port) as server:
+            print(f"replaying {args.serve} on {server.url}, log in with any user", file=sys.stderr)
+            with contextlib.suppress(KeyboardInterrupt):
+                server.thread.join()
+        return
+    if not args.url:
+        parser.error("the openBIS url is required")
+    if not args.token and not args.user:
+        parser.error("log in with --user or give a --token")
+    criteria, options = None, None
+    if args.fetch_options:
+        with open(args.fetch_options) as f:
+            searches = json.load(f)
+        criteria = {kind: search["criteria"] for kind, search in searches.items() if search.get("criteria")}
+        options = {kind: search["options"] for kind, search in searches.items() if search.get("options")}
+
+    target_file = sys.stdout.buffer if args.output_file in (None, "-") else args.output_file
+    start = time.perf_counter()
+    try:
+        count = fetch(
+            args.url,
+            target_file,
+            kinds=args.kind or tuple(SEARCHES),
+            token=args.token,
+            user=args.user,
+            password=os.environ.get("OPENBIS_PASSWORD", ""),
+            target_format=args.format,
+            base_url=args.base_url,
+            jobs=args.jobs,
+            page_size=args.page_size,
+            retries=args.retries,
+            criteria=criteria,
+            options=options,
+        )
+    except FetchError as e:
+        print(f"fetching failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"fetched and converted {count} triples in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
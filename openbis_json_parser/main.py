@@ -1,22 +1,56 @@
 import ast
+import codecs
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import logging
+import os
 import pathlib
+import queue
 import re
+import sqlite3
+import tempfile
+import threading
+import time
 import urllib.parse
+from array import array
+from collections import Counter, OrderedDict
 from datetime import datetime
-from typing import Tuple, Union
+from types import MappingProxyType
+from typing import List, Mapping, NamedTuple, Optional, Tuple, Union
 
 from dateutil.parser import parse as date_parse
 from rdflib import BNode, Graph, Literal, Namespace, URIRef
 from rdflib.namespace import OWL, RDF, RDFS, XSD, DCAT
+from rdflib.plugins.serializers.nt import _nt_row, _quoteLiteral
+
+try:
+    import orjson
+except ImportError:  # optional faster decoder, the stdlib one is used without it
+    orjson = None
+try:
+    import zstandard
+except ImportError:  # optional, only needed for .zst files
+    zstandard = None
 
 # plugin api endpoint for permIds should be here
 default_ns = Namespace("https://openbismantic.matolab.org/openbismantic/")
 
 
+ONTOLOGY_FILE = pathlib.Path(__file__).parent.parent / "openbis.ttl"
+# bump when the layout of the cached ontology index changes
+INDEX_CACHE_VERSION = 1
+# bump when the same input converts to different output, older cached conversions are then ignored
+CONVERSION_CACHE_VERSION = 1
+
+
 def load_ontology():
     g = Graph()
-    g.parse(str(pathlib.Path(__file__).parent.parent / "openbis.ttl"))
+    g.parse(str(ONTOLOGY_FILE))
     return g
 
 
@@ -24,7 +58,232 @@ OBIS = Namespace("http://w3id.org/matolab/openbis/")
 QUDT = Namespace("http://qudt.org/schema/qudt/")
 OA = Namespace("http://www.w3.org/ns/oa#")
 
-obis = load_ontology()
+# openBIS entity types which are converted to owl:Class and the class they specialize
+TYPE_PARENTS = {
+    "as.dto.sample.SampleType": OBIS.Object,
+    "as.dto.experiment.ExperimentType": OBIS.Collection,
+}
+
+
+class OntologyIndex(NamedTuple):
+    # openbis json key or @type -> ontology entity
+    json_keys: Mapping[str, URIRef]
+    # @type -> parent class of the instances created for it
+    type_parents: Mapping[str, URIRef]
+
+
+def build_index(graph: Graph) -> OntologyIndex:
+    json_keys = {}
+    for entity, key in graph.subject_objects(OBIS.openbis_json_key):
+        # only plain literals match the lookup by Literal(key), first declaration wins
+        if isinstance(key, Literal) and key.language is None and key.datatype is None:
+            json_keys.setdefault(str(key), entity)
+    return OntologyIndex(MappingProxyType(json_keys), MappingProxyType(dict(TYPE_PARENTS)))
+
+
+def _cache_dir() -> pathlib.Path:
+    if os.environ.get("OPENBIS_JSON_PARSER_CACHE"):
+        return pathlib.Path(os.environ["OPENBIS_JSON_PARSER_CACHE"])
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return pathlib.Path(cache_home) / "openbis_json_parser"
+
+
+def ontology_hash(ontology_file=ONTOLOGY_FILE) -> str:
+    with open(ontology_file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _write_atomic(path: pathlib.Path, content: Union[str, bytes]):
+    # written to a temporary file next to path and renamed, readers never see a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_index(ontology_file=ONTOLOGY_FILE, cache_dir=None) -> OntologyIndex:
+    # the compiled index is cached per ontology content, so editing openbis.ttl invalidates it
+    digest = ontology_hash(ontology_file)
+    cache_file = pathlib.Path(cache_dir or _cache_dir()) / f"index-v{INDEX_CACHE_VERSION}-{digest}.json"
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["version"] == INDEX_CACHE_VERSION and cached["ontology_sha256"] == digest:
+            json_keys = {key: URIRef(iri) for key, iri in cached["json_keys"].items()}
+            return OntologyIndex(MappingProxyType(json_keys), MappingProxyType(dict(TYPE_PARENTS)))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    g = Graph()
+    g.parse(str(ontology_file))
+    index = build_index(g)
+    content = json.dumps(
+        {
+            "version": INDEX_CACHE_VERSION,
+            "ontology_sha256": digest,
+            "json_keys": {key: str(iri) for key, iri in index.json_keys.items()},
+        }
+    )
+    try:
+        _write_atomic(cache_file, content)
+    except OSError:
+        # a read only cache location only costs the parse on the next start
+        pass
+    return index
+
+
+_index = None
+_ontology = None
+
+
+def get_index() -> OntologyIndex:
+    global _index
+    if _index is None:
+        _index = load_index()
+    return _index
+
+
+def init_worker():
+    # initializer of worker processes, the ontology index is loaded once per worker, not per conversion
+    get_index()
+
+
+def __getattr__(name):
+    # the ontology graph and index are loaded on first use instead of at import
+    global _ontology
+    if name == "obis":
+        if _ontology is None:
+            _ontology = load_ontology()
+        return _ontology
+    if name == "obis_index":
+        return get_index()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+log = logging.getLogger("openbis_json_parser")
+# the per key and per triple messages are only built if this is set, a disabled log costs one global lookup
+_debug = False
+# the ConversionStats being filled, None if nobody collects them
+_stats = None
+# the PropertyRegistry of the running conversion, a context variable as threads of the server convert side by side
+_properties = contextvars.ContextVar("properties", default=None)
+# the _LiteralBatch of the running iterate_json
+_literals = contextvars.ContextVar("literals", default=None)
+
+
+def set_debug(enabled=True):
+    # per key and per triple messages on the openbis_json_parser logger at DEBUG level
+    global _debug
+    _debug = enabled
+    if enabled and not log.isEnabledFor(logging.DEBUG):
+        log.setLevel(logging.DEBUG)
+
+
+class ConversionStats:
+    # time per conversion phase and counters, filled by the conversions running while collect() is active
+    COUNTERS = ("triples", "iris_rewritten", "iris_dropped", "skipped_directories", "download_urls")
+    TABLES = ("entities", "repeated_entities", "unhandled_keys", "unknown_types")
+
+    def __init__(self):
+        # phase -> seconds and number of times it ran
+        self.phases = Counter()
+        self.calls = Counter()
+        # entity class iri -> entities created
+        self.entities = Counter()
+        # entity class iri -> repeated copies only linked to, see EMIT_ONCE_CLASSES
+        self.repeated_entities = Counter()
+        # json keys and @types the ontology has nothing for
+        self.unhandled_keys = Counter()
+        self.unknown_types = Counter()
+        self.triples = 0
+        self.iris_rewritten = 0
+        self.iris_dropped = 0
+        self.skipped_directories = 0
+        self.download_urls = 0
+
+    @contextlib.contextmanager
+    def collect(self):
+        global _stats
+        previous, _stats = _stats, self
+        try:
+            yield self
+        finally:
+            _stats = previous
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def merge(self, other):
+        for name in ("phases", "calls") + self.TABLES:
+            getattr(self, name).update(getattr(other, name))
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def as_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in self.COUNTERS}
+        for name in ("phases", "calls") + self.TABLES:
+            data[name] = {str(key): value for key, value in getattr(self, name).items()}
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for name in cls.COUNTERS:
+            setattr(stats, name, data[name])
+        for name in ("phases", "calls") + cls.TABLES:
+            getattr(stats, name).update(data[name])
+        return stats
+
+    def report(self) -> str:
+        total = sum(self.phases.values())
+        lines = [f"{'phase':<22} {'calls':>7} {'seconds':>9} {'share':>6}"]
+        for name, seconds in self.phases.items():
+            lines.append(f"{name:<22} {self.calls[name]:>7} {seconds:>9.3f} {seconds / total if total else 0:>6.1%}")
+        lines.append(f"{'triples':<22} {self.triples:>7}" + (f" {self.triples / total:>9.0f}/s" if total else ""))
+        for name in self.COUNTERS[1:]:
+            lines.append(f"{name.replace('_', ' '):<22} {getattr(self, name):>7}")
+        for name in self.TABLES:
+            table = getattr(self, name)
+            if table:
+                lines.append(f"{name.replace('_', ' ')}:")
+                for key, count in table.most_common():
+                    lines.append(f"  {_short_name(key):<36} {count:>7}")
+        return "\n".join(lines)
+
+
+def _short_name(term):
+    # iris are shown by their last segment, keys and @types as they are
+    term = str(term)
+    return term.split("#")[-1].split("/")[-1] if "://" in term else term
+
+
+def _phase(name):
+    # times the block into the stats being collected, if any
+    return _stats.phase(name) if _stats is not None else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def _untracked():
+    # the iri pre-scan walks the json a second time, it is neither counted nor logged
+    global _stats, _debug
+    saved = _stats, _debug
+    _stats, _debug = None, False
+    try:
+        yield
+    finally:
+        _stats, _debug = saved
+
 
 TEMP = Namespace("https://example.com/")
 
@@ -35,20 +294,12 @@ def _get_ns(base_url=None):
     return Namespace(urllib.parse.urljoin(base_url, "openbismantic/"))
 
 
-def get_obis_entity(string: str):
-    hits=list(obis[:OBIS.openbis_json_key:Literal(string)])
-    if hits:
-        return hits[0]
-    else:
-        return None
+def get_obis_entity(string: str) -> Optional[URIRef]:
+    return (_index or get_index()).json_keys.get(string)
 
 
 def get_custom_props(string: str, graph):
-    hits = list(graph[: OBIS.code : Literal(string)])
-    if hits:
-        return hits[0]
-    else:
-        return None
+    return next(graph.subjects(OBIS.code, Literal(string)), None)
 
 
 def is_date(string, fuzzy=False) -> bool:
@@ -60,124 +311,1456 @@ def is_date(string, fuzzy=False) -> bool:
         return False
 
 
-def get_value_type(string: str) -> Tuple:
+# plain numbers literal_eval takes as int or float, checked first as most values are numbers
+_INT_VALUE = re.compile(r"[+-]?(?:0+|[1-9][0-9]*)")
+_FLOAT_VALUE = re.compile(r"[+-]?(?:(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+)")
+
+
+def _infer_value(string) -> Tuple[Tuple, object]:
+    # the value type and, for dates, the parsed date, so it has not to be parsed again
     string = str(string)
     # remove spaces and replace , with . and
     string = string.strip().replace(",", ".")
     if len(string) == 0:
-        return "BLANK", None
+        return ("BLANK", None), None
+    if _INT_VALUE.fullmatch(string):
+        return ("INT", XSD.integer), None
+    # floats equal to 0 or 1 are taken for booleans below
+    if _FLOAT_VALUE.fullmatch(string) and float(string) not in (0.0, 1.0):
+        return ("FLOAT", XSD.double), None
     try:
         t = ast.literal_eval(string)
     except ValueError:
-        return "TEXT", XSD.string
+        return ("TEXT", XSD.string), None
     except SyntaxError:
-        if is_date(string):
-            return "DATE", XSD.dateTime
-        else:
-            return "TEXT", XSD.string
+        try:
+            return ("DATE", XSD.dateTime), date_parse(string)
+        except ValueError:
+            return ("TEXT", XSD.string), None
     else:
         if type(t) in [int, float, bool]:
             if type(t) is int:
-                return "INT", XSD.integer
+                return ("INT", XSD.integer), None
             if t in set((True, False)):
-                return "BOOL", XSD.boolean
+                return ("BOOL", XSD.boolean), None
             if type(t) is float:
-                return "FLOAT", XSD.double
+                return ("FLOAT", XSD.double), None
         else:
             # return 'TEXT'
-            return "TEXT", XSD.string
+            return ("TEXT", XSD.string), None
+
+
+def get_value_type(string: str) -> Tuple:
+    return _infer_value(string)[0]
+
+
+def _value_literal(value_string) -> Tuple[Tuple, Literal]:
+    val_type, date = _infer_value(value_string)
+    if val_type[0] == "INT":
+        literal = Literal(int(value_string), datatype=val_type[1])
+    elif val_type[0] == "BOOL":
+        literal = Literal(bool(value_string), datatype=val_type[1])
+    elif val_type[0] == "FLOAT":
+        if isinstance(value_string, str):
+            # replace , with . as decimal separator
+            value_string = value_string.strip().replace(",", ".")
+        literal = Literal(float(value_string), datatype=val_type[1])
+    elif val_type[0] == "DATE":
+        # the date was parsed with , replaced, the literal is made from the value as it is
+        if value_string != value_string.strip().replace(",", "."):
+            date = date_parse(value_string)
+        literal = Literal(str(date.isoformat()), datatype=val_type[1])
+    else:
+        literal = Literal(value_string.strip(), datatype=val_type[1])
+    return val_type, literal
+
+
+# property values repeat a lot (vocabularies, units, flags), so their types and literals are cached
+VALUE_CACHE_SIZE = 4096
+_value_cache = OrderedDict()
+# conversions can run on several threads, the cache is only read and reordered under it
+_value_lock = threading.Lock()
+
+
+def value_literal(value_string) -> Tuple[Tuple, Literal]:
+    # value type and literal describe_value uses for a property value
+    try:
+        key = (type(value_string), value_string)
+        hash(key)
+    except TypeError:
+        # lists and dicts are not cached
+        return _value_literal(value_string)
+    with _value_lock:
+        cached = _value_cache.get(key)
+        if cached is not None:
+            _value_cache.move_to_end(key)
+            return cached
+    cached = _value_literal(value_string)
+    with _value_lock:
+        _value_cache[key] = cached
+        while len(_value_cache) > VALUE_CACHE_SIZE:
+            _value_cache.popitem(last=False)
+    return cached
+
+
+def value_literals(values, seen=None, literal=value_literal) -> List:
+    # literal (value_literal by default, timestamp_literal for timestamps) for many values at once, every distinct
+    # value is converted a single time even if there are more of them than the cache holds. seen carries the
+    # results of earlier calls, with the literal function in their key
+    seen = {} if seen is None else seen
+    result = []
+    for value in values:
+        try:
+            key = (literal, type(value), value)
+            described = seen.get(key)
+        except TypeError:
+            result.append(literal(value))
+            continue
+        if described is None:
+            described = seen[key] = literal(value)
+        result.append(described)
+    return result
+
+
+def timestamp_literal(milliseconds) -> Literal:
+    # registrationDate and modificationDate are milliseconds since the epoch, written as local time
+    iso_string = datetime.fromtimestamp(milliseconds / 1000).isoformat()
+    return Literal(str(iso_string), datatype=XSD.dateTimeStamp)
+
+
+# raw values iterate_json collects before they are turned into literals together, 0 converts every value at once
+LITERAL_BATCH_SIZE = 65536
+# distinct values and timestamps whose literals are kept for the later batches of one conversion, about 500 bytes
+# each. the ones met first are kept, later ones go through the value cache
+LITERAL_MEMO_SIZE = 1 << 16
+
+
+class _LiteralBatch:
+    # deferred literal stage of iterate_json: property values and timestamps are collected while the json is
+    # traversed and converted in batches with value_literals, every distinct value once while the memo has room,
+    # then their triples are added to the graph. the batches are not vectorized (numpy): timestamps are written in
+    # local time with the daylight saving offset of each date, and a value is only known to be a comma decimal
+    # after the type inference of its string
+    def __init__(self, graph, size=LITERAL_BATCH_SIZE):
+        self.graph = graph
+        self.size = size
+        # (node, relation, value_string)
+        self.values = []
+        # (entity, annotation, milliseconds)
+        self.timestamps = []
+        self.seen = {}
+
+    def add_value(self, node, relation, value_string):
+        self.values.append((node, relation, value_string))
+        if len(self.values) >= self.size:
+            self.flush()
+
+    def add_timestamp(self, entity, annotation, milliseconds):
+        self.timestamps.append((entity, annotation, milliseconds))
+        if len(self.timestamps) >= self.size:
+            self.flush()
+
+    def flush(self):
+        values, self.values = self.values, []
+        timestamps, self.timestamps = self.timestamps, []
+        literals = value_literals([row[2] for row in values], self.seen)
+        for (node, relation, _), (val_type, literal) in zip(values, literals):
+            _describe_literal(self.graph, node, relation, val_type, literal)
+        literals = value_literals([row[2] for row in timestamps], self.seen, timestamp_literal)
+        for (entity, annotation, _), literal in zip(timestamps, literals):
+            self.graph.add((entity, annotation, literal))
+        # the memo is cut back to the values met first, clearing it would convert the frequent ones again
+        excess = len(self.seen) - LITERAL_MEMO_SIZE
+        if excess > 0:
+            for key in list(itertools.islice(reversed(self.seen), excess)):
+                del self.seen[key]
+
+
+@contextlib.contextmanager
+def _literal_batch(graph):
+    # the values of the block are converted when it ends, or as soon as a batch is full
+    if not LITERAL_BATCH_SIZE or isinstance(graph, _IriRecorder):
+        yield None
+        return
+    batch = _LiteralBatch(graph, LITERAL_BATCH_SIZE)
+    token = _literals.set(batch)
+    try:
+        yield batch
+    finally:
+        _literals.reset(token)
+    batch.flush()
 
 
 def describe_value(graph, node, relation, value_string: str):
-    val_type = get_value_type(value_string)
+    batch = _literals.get()
+    if batch is not None and batch.graph is graph:
+        batch.add_value(node, relation, value_string)
+        return
+    val_type, literal = value_literal(value_string)
+    _describe_literal(graph, node, relation, val_type, literal)
+
+
+# terms of the value descriptions, looked up once instead of per value
+_QUANTITY_VALUE = QUDT.QuantityValue
+_QUDT_VALUE = QUDT.value
+_ANNOTATION = OA.Annotation
+_HAS_LITERAL_BODY = OA.hasLiteralBody
+
+
+def _describe_literal(graph, node, relation, val_type, literal):
     if val_type:
         body = BNode()
         graph.add((node, relation, body))
 
     if val_type[0] == "INT":
-        graph.add((body, RDF.type, QUDT.QuantityValue))
-        graph.add(
-            (
-                body,
-                QUDT.value,
-                Literal(int(value_string), datatype=val_type[1]),
-            )
-        )
+        graph.add((body, _RDF_TYPE, _QUANTITY_VALUE))
+        graph.add((body, _QUDT_VALUE, literal))
     elif val_type[0] == "BOOL":
         body = BNode()
-        graph.add((body, RDF.type, QUDT.QuantityValue))
-        graph.add(
-            (
-                body,
-                QUDT.value,
-                Literal(bool(value_string), datatype=val_type[1]),
-            )
-        )
+        graph.add((body, _RDF_TYPE, _QUANTITY_VALUE))
+        graph.add((body, _QUDT_VALUE, literal))
     elif val_type[0] == "FLOAT":
-        if isinstance(value_string, str):
-            # replace , with . as decimal separator
-            value_string = value_string.strip().replace(",", ".")
-        graph.add((body, RDF.type, QUDT.QuantityValue))
-        graph.add(
-            (
-                body,
-                QUDT.value,
-                Literal(float(value_string), datatype=val_type[1]),
-            )
-        )
+        graph.add((body, _RDF_TYPE, _QUANTITY_VALUE))
+        graph.add((body, _QUDT_VALUE, literal))
     elif val_type[0] == "DATE":
         body = BNode()
-        graph.add((body, RDF.type, QUDT.QuantityValue))
-        graph.add(
-            (
-                body,
-                QUDT.value,
-                Literal(
-                    str(date_parse(value_string).isoformat()),
-                    datatype=val_type[1],
-                ),
-            )
-        )
+        graph.add((body, _RDF_TYPE, _QUANTITY_VALUE))
+        graph.add((body, _QUDT_VALUE, literal))
     else:
-        graph.add((body, RDF.type, OA.Annotation))
-        graph.add(
-            (
-                body,
-                OA.hasLiteralBody,
-                Literal(value_string.strip(), datatype=val_type[1]),
+        graph.add((body, _RDF_TYPE, _ANNOTATION))
+        graph.add((body, _HAS_LITERAL_BODY, literal))
+
+
+def write_ontology(onto, target_file, target_format):
+    if isinstance(onto, TripleBuffer) and target_format not in STREAMING_FORMATS:
+        onto = onto.to_graph()
+    with _phase("write_ontology"):
+        if isinstance(target_file, (str, os.PathLike)):
+            with open_output(target_file) as f:
+                f.write(onto.serialize(format=target_format).encode("utf-8"))
+        else:
+            target_file.write(onto.serialize(format=target_format).encode("utf-8"))
+
+
+# formats NTriplesWriter can write line by line
+STREAMING_FORMATS = ("ntriples", "nt", "nt11", "nquads")
+# triples attach_distributions reads, kept aside while streaming
+# predicates attach_distributions follows, NTriplesWriter keeps the triples of them it needs until it is closed
+_DISTRIBUTION_PREDICATES = frozenset(
+    (
+        OBIS.dataset_permid,
+        RDF.value,
+        OBIS.has_identifier,
+        OBIS.relates_to,
+        DCAT.endpointURL,
+        OBIS.file_path,
+    )
+)
+_DISTRIBUTION_TYPES = frozenset((DCAT.Distribution, OBIS.DataStore))
+_DATA_STORE = OBIS.DataStore
+_DATASET = DCAT.Dataset
+_PERMANENT_IDENTIFIER = OBIS.PermanentIdentifier
+_HAS_IDENTIFIER = OBIS.has_identifier
+_OBIS_CODE = OBIS.code
+
+
+class TripleBuffer:
+    # compact stand-in for a Graph while converting: terms are interned to ints and the triples are kept in
+    # three int arrays, about 12 bytes per triple plus the terms. duplicates and removals are applied in one
+    # pass when the triples are read, a removal only drops the triples added before it, the lookups attach_distributions needs are answered from indexes built
+    # on first use, obis:code lookups during the traversal come from a table like in NTriplesWriter
+    def __init__(self):
+        self.terms = []
+        self.ids = {}
+        self.s = array("i")
+        self.p = array("i")
+        self.o = array("i")
+        self.namespaces = {}
+        self.codes = {}
+        # removals waiting for the next compaction: subjects, (predicate, object) and whole triples -> the number
+        # of triples added when they were last removed
+        self.removed_subjects = {}
+        self.removed_pairs = {}
+        self.removed_triples = {}
+        self.compacted = True
+        # predicate id -> positions, and predicate id -> subject id -> object ids
+        self.by_predicate = None
+        self.by_subject = {}
+
+    def _intern(self, term):
+        i = self.ids.get(term)
+        if i is None:
+            i = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return i
+
+    def add(self, triple):
+        s, p, o = triple
+        intern = self._intern
+        self.s.append(intern(s))
+        self.p.append(intern(p))
+        self.o.append(intern(o))
+        if p == OBIS.code:
+            self.codes.setdefault(o, s)
+        self.compacted = False
+
+    def remove(self, triple):
+        # (s, None, None), (None, p, o) or a whole triple
+        s, p, o = triple
+        ids = self.ids
+        if any(term is not None and term not in ids for term in triple):
+            return
+        if p is None and o is None and s is not None:
+            self.removed_subjects[ids[s]] = len(self.s)
+        elif s is None and p is not None and o is not None:
+            self.removed_pairs[(ids[p], ids[o])] = len(self.s)
+        elif None not in triple:
+            self.removed_triples[(ids[s], ids[p], ids[o])] = len(self.s)
+        else:
+            raise ValueError(f"TripleBuffer can not remove {triple}")
+        self.compacted = False
+
+    def bind(self, prefix, namespace):
+        self.namespaces[prefix] = namespace
+
+    def compact(self):
+        # drops duplicates, keeping the first like a Graph does, and the triples removed after they were added
+        if self.compacted:
+            return
+        s, p, o = array("i"), array("i"), array("i")
+        seen = set()
+        n = len(self.terms)
+        subjects, pairs, triples = self.removed_subjects, self.removed_pairs, self.removed_triples
+        for i, triple in enumerate(zip(self.s, self.p, self.o)):
+            key = (triple[0] * n + triple[1]) * n + triple[2]
+            if key in seen:
+                continue
+            if (
+                subjects.get(triple[0], 0) > i
+                or pairs.get((triple[1], triple[2]), 0) > i
+                or triples.get(triple, 0) > i
+            ):
+                continue
+            seen.add(key)
+            s.append(triple[0])
+            p.append(triple[1])
+            o.append(triple[2])
+        self.s, self.p, self.o = s, p, o
+        self.removed_subjects, self.removed_pairs, self.removed_triples = {}, {}, {}
+        self.by_predicate = None
+        self.by_subject = {}
+        self.compacted = True
+
+    def _positions(self, p):
+        self.compact()
+        if self.by_predicate is None:
+            self.by_predicate = {}
+            for i, pid in enumerate(self.p):
+                self.by_predicate.setdefault(pid, []).append(i)
+        return self.by_predicate.get(p, ())
+
+    def triples(self, pattern):
+        s, p, o = pattern
+        ids, terms = self.ids, self.terms
+        if any(term is not None and term not in ids for term in pattern):
+            return
+        sid, pid, oid = (None if term is None else ids[term] for term in pattern)
+        if pid is not None:
+            positions = self._positions(pid)
+        else:
+            self.compact()
+            positions = range(len(self.s))
+        for i in positions:
+            if (sid is None or self.s[i] == sid) and (oid is None or self.o[i] == oid):
+                yield terms[self.s[i]], terms[self.p[i]], terms[self.o[i]]
+
+    def subjects(self, predicate=None, object=None):
+        if predicate == OBIS.code and object is not None and not self.compacted:
+            # get_custom_props while the triples are added
+            if object in self.codes:
+                yield self.codes[object]
+            return
+        for s, _, _ in self.triples((None, predicate, object)):
+            yield s
+
+    def objects(self, subject=None, predicate=None):
+        if subject is None or predicate is None or predicate not in self.ids:
+            for _, _, o in self.triples((subject, predicate, None)):
+                yield o
+            return
+        pid = self.ids[predicate]
+        index = self.by_subject.get(pid)
+        if index is None or not self.compacted:
+            index = {}
+            for i in self._positions(pid):
+                index.setdefault(self.s[i], []).append(self.o[i])
+            self.by_subject[pid] = index
+        for oid in index.get(self.ids.get(subject), ()):
+            yield self.terms[oid]
+
+    def subject_objects(self, predicate=None):
+        for s, _, o in self.triples((None, predicate, None)):
+            yield s, o
+
+    def value(self, subject, predicate):
+        return next(self.objects(subject, predicate), None)
+
+    def __iter__(self):
+        return self.triples((None, None, None))
+
+    def __len__(self):
+        self.compact()
+        return len(self.s)
+
+    def __contains__(self, triple):
+        return next(self.triples(triple), None) is not None
+
+    def to_graph(self) -> Graph:
+        graph = Graph()
+        for prefix, namespace in self.namespaces.items():
+            graph.bind(prefix, namespace)
+        graph.addN((s, p, o, graph) for s, p, o in self)
+        return graph
+
+    def serialize(self, format="turtle", graph_name=None) -> str:
+        # line based formats are written from the arrays, the others through a Graph
+        if format not in STREAMING_FORMATS:
+            return self.to_graph().serialize(format=format)
+        rows = (_nt_row(triple) for triple in self)
+        if format == "nquads" and graph_name is not None:
+            rows = (f"{row[:-3]} {graph_name.n3()} .\n" for row in rows)
+        return "".join(rows)
+
+
+class NTriplesWriter:
+    # graph stand-in for iterate_json that writes each triple as N-Triples/N-Quads line when it is added
+    def __init__(self, stream, target_format="ntriples", graph_name=None, dropped=(), dedupe_window=65536):
+        if target_format not in STREAMING_FORMATS:
+            raise ValueError(f"can not stream {target_format}, use one of {', '.join(STREAMING_FORMATS)}")
+        self.stream = stream
+        self.graph_name = graph_name if target_format == "nquads" else None
+        self.dropped = set(dropped)
+        self.dedupe_window = dedupe_window
+        # recently written triples, repeated entities are mostly written close to each other
+        self.recent = OrderedDict()
+        self.codes = {}
+        # entities written so far, see iterate_json
+        self.emitted = {}
+        self.distributions = TripleBuffer()
+        # datasets and data stores written so far, and the rdf:value of permanent identifiers until it is known
+        # whose identifier they are, only the ones of datasets are kept
+        self.datasets = set()
+        self.stores = set()
+        self.identifiers = {}
+        self.count = 0
+
+    def add(self, triple):
+        s, p, o = triple
+        if s in self.dropped or (p == _RELATES_TO and o in self.dropped):
+            return
+        if triple in self.recent:
+            self.recent.move_to_end(triple)
+            return
+        self.recent[triple] = None
+        if len(self.recent) > self.dedupe_window:
+            self.recent.popitem(last=False)
+        if p == _OBIS_CODE:
+            self.codes.setdefault(o, s)
+        elif p in _DISTRIBUTION_PREDICATES or p == _RDF_TYPE:
+            self._keep(triple)
+        row = _nt_row(triple)
+        if self.graph_name is not None:
+            row = f"{row[:-3]} {self.graph_name.n3()} .\n"
+        self.stream.write(row.encode("utf-8"))
+        self.count += 1
+
+    def _keep(self, triple):
+        # keeps what attach_distributions needs: the distributions, the data stores and the identifiers and data
+        # store links of datasets. an entity is typed before its other triples are added
+        s, p, o = triple
+        if p == _RDF_TYPE:
+            if o in _DISTRIBUTION_TYPES:
+                self.distributions.add(triple)
+                if o == _DATA_STORE:
+                    self.stores.add(s)
+            elif o == _DATASET:
+                self.datasets.add(s)
+            elif o == _PERMANENT_IDENTIFIER:
+                self.identifiers[s] = None
+        elif p == _RDF_VALUE:
+            if s in self.identifiers:
+                self.identifiers[s] = triple
+        elif p == _HAS_IDENTIFIER:
+            # an identifier is done before it is related to
+            value = self.identifiers.pop(o, None)
+            if s in self.datasets:
+                self.distributions.add(triple)
+                if value is not None:
+                    self.distributions.add(value)
+        elif p == _RELATES_TO:
+            if s in self.datasets and o in self.stores:
+                self.distributions.add(triple)
+        else:
+            self.distributions.add(triple)
+
+    def subjects(self, predicate, object):
+        # only the obis:code lookup of get_custom_props is supported
+        if predicate == OBIS.code and object in self.codes:
+            yield self.codes[object]
+
+    def bind(self, prefix, namespace):
+        # line based formats have no prefixes
+        pass
+
+    def close(self):
+        with _phase("attach_distributions"):
+            attach_distributions(self.distributions, target=self)
+        self.distributions = TripleBuffer()
+        self.datasets.clear()
+        self.stores.clear()
+        self.identifiers.clear()
+        self.recent.clear()
+        self.emitted.clear()
+        return self.count
+
+    def __len__(self):
+        return self.count
+
+
+def stream_elements(
+    elements, target_file, target_format="ntriples", base_url=None, graph_name=None, properties=None
+) -> int:
+    # converts json documents one after another into one stream, an element is discarded once it is written
+    # and later elements can refer back to its @ids and properties, returns the number of lines written
+    if isinstance(target_file, (str, os.PathLike)):
+        with open_output(target_file) as f:
+            return stream_elements(
+                elements, f, target_format, base_url=base_url, graph_name=graph_name, properties=properties
+            )
+    writer = NTriplesWriter(target_file, target_format, graph_name=graph_name)
+    # temporary iri of every @id seen so far -> its final iri, None if it was dropped
+    resolved = {}
+    with _property_registry(properties):
+        for data in elements:
+            _stream_element(data, writer, base_url, resolved)
+    count = writer.close()
+    if _stats is not None:
+        _stats.triples += count
+    return count
+
+
+def _stream_element(data, writer, base_url, resolved):
+    with _phase("resolve_iris"):
+        iris = resolve_iris(data, base_url=base_url, resolved=resolved, codes=writer.codes)
+    writer.dropped = set(iris.dropped)
+    with _phase("iterate_json"):
+        iterate_json(data, writer, base_url=base_url, iris=iris, emitted=writer.emitted)
+
+
+def stream_documents(
+    documents, target_file, target_format="ntriples", base_url=None, graph_name=None, properties=None
+) -> int:
+    # converts independent json documents, like the pages of a search, into one stream. every document has
+    # its own @ids, the codes and properties of earlier ones are known, returns the number of lines written
+    if isinstance(target_file, (str, os.PathLike)):
+        with open_output(target_file) as f:
+            return stream_documents(
+                documents, f, target_format, base_url=base_url, graph_name=graph_name, properties=properties
             )
+    writer = NTriplesWriter(target_file, target_format, graph_name=graph_name)
+    with _property_registry(properties):
+        for data in documents:
+            _stream_element(data, writer, base_url, {})
+    count = writer.close()
+    if _stats is not None:
+        _stats.triples += count
+    return count
+
+
+def stream_dict(data, target_file, target_format="ntriples", base_url=None, graph_name=None, properties=None) -> int:
+    # like write_ontology(parse_dict(data)) without building the graph, returns the number of lines written
+    return stream_elements(
+        [data], target_file, target_format, base_url=base_url, graph_name=graph_name, properties=properties
+    )
+
+
+def stream_json(json_file, target_file, target_format="ntriples", base_url=None, graph_name=None, properties=None) -> int:
+    # json_file is a path or a readable file, gzip or zstd compressed or not,
+    # a SearchResult is read and converted one object at a time
+    with open_input(json_file) as f:
+        return stream_elements(
+            iter_json_objects(f),
+            target_file,
+            target_format,
+            base_url=base_url,
+            graph_name=graph_name,
+            properties=properties,
         )
 
 
-def write_ontology(onto, target_file, target_format):
-    if isinstance(target_file, str):
-        with open(target_file, "wb") as f:
-            f.write(onto.serialize(format=target_format).encode("utf-8"))
+# bump when the layout of the delta state file changes
+DELTA_STATE_VERSION = 1
+
+
+class _DeltaWriter(NTriplesWriter):
+    # writes one element, blank nodes get labels derived from the element so the lines are the same on every run
+    def __init__(self, stream, key, codes, dropped=()):
+        super().__init__(stream, dropped=dropped)
+        self.codes = codes
+        self.prefix = "d" + hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:16] + "b"
+        self.bnodes = {}
+
+    def add(self, triple):
+        super().add(tuple(self.label(term) if isinstance(term, BNode) else term for term in triple))
+
+    def label(self, bnode):
+        if bnode not in self.bnodes:
+            self.bnodes[bnode] = BNode(f"{self.prefix}{len(self.bnodes)}")
+        return self.bnodes[bnode]
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        if state.get("version") == DELTA_STATE_VERSION:
+            return state
+    except FileNotFoundError:
+        pass
+    return {"version": DELTA_STATE_VERSION, "ontology_sha256": None, "base_url": None, "codes": {}, "entities": {}}
+
+
+def delta_elements(elements, state_file, target_file, base_url=None, removals_file=None, prune=True) -> Tuple[int, int]:
+    # converts only the elements whose modificationDate differs from the state file and writes what changed
+    # since the last run: as rdf patch (D and A rows) into target_file, or as n-triples of the added triples
+    # into target_file and of the removed ones into removals_file. with prune, entities of the last run that
+    # are missing now are removed. returns (added, removed) triples and updates the state file
+    state = _load_state(state_file)
+    digest = ontology_hash()
+    # another ontology or base url can change every triple, all elements are converted again
+    force = state["ontology_sha256"] != digest or state["base_url"] != base_url
+    entities = state["entities"]
+    # entities emitting each line, a line is only removed once no entity emits it any more
+    counts = Counter(row for entity in entities.values() for row in entity["triples"])
+    # whether a line changed by this run was emitted before it
+    before = {}
+
+    def update(rows, delta):
+        for row in rows:
+            before.setdefault(row, counts[row] > 0)
+            counts[row] += delta
+
+    codes = {Literal(code): URIRef(iri) for code, iri in state["codes"].items()}
+    resolved = {}
+    seen = set()
+    for data in elements:
+        iris = resolve_iris(data, base_url=base_url, resolved=resolved, codes=codes)
+        entity = _temp_iri(data["@id"], iris) if isinstance(data, dict) and "@id" in data else None
+        if entity is None or entity in iris.dropped:
+            key = hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+        else:
+            key = str(entity)
+        modified = data.get("modificationDate") if isinstance(data, dict) else None
+        seen.add(key)
+        old = entities.get(key)
+        if not force and old is not None and modified is not None and old["modified"] == modified:
+            continue
+        writer = _DeltaWriter(io.BytesIO(), key, codes, dropped=iris.dropped)
+        # every entity defines the properties it uses, they stay while any entity emits them
+        with _property_registry():
+            iterate_json(data, writer, base_url=base_url, iris=iris)
+        writer.close()
+        rows = list(dict.fromkeys(writer.stream.getvalue().decode("utf-8").splitlines()))
+        triples_hash = hashlib.sha256("\n".join(sorted(rows)).encode("utf-8")).hexdigest()
+        if old is not None and old["hash"] == triples_hash:
+            old["modified"] = modified
+            continue
+        if old is not None:
+            update(old["triples"], -1)
+        update(rows, 1)
+        entities[key] = {"modified": modified, "hash": triples_hash, "triples": rows}
+    if prune:
+        for key in [key for key in entities if key not in seen]:
+            update(entities.pop(key)["triples"], -1)
+
+    added = [row for row, emitted in before.items() if not emitted and counts[row] > 0]
+    removed = [row for row, emitted in before.items() if emitted and counts[row] <= 0]
+    if removals_file is None:
+        _write_lines(target_file, [f"D {row}" for row in removed] + [f"A {row}" for row in added])
     else:
-        target_file.write(onto.serialize(format=target_format).encode("utf-8"))
+        _write_lines(target_file, added)
+        _write_lines(removals_file, removed)
+    state.update(ontology_sha256=digest, base_url=base_url)
+    state["codes"] = {str(code): str(iri) for code, iri in codes.items()}
+    _write_atomic(pathlib.Path(state_file), json.dumps(state))
+    return len(added), len(removed)
+
+
+def _write_lines(target_file, rows):
+    content = "".join(f"{row}\n" for row in rows).encode("utf-8")
+    if isinstance(target_file, (str, os.PathLike)):
+        with open_output(target_file) as f:
+            f.write(content)
+    else:
+        target_file.write(content)
+
+
+def delta_json(json_file, state_file, target_file, base_url=None, removals_file=None, prune=True) -> Tuple[int, int]:
+    # incremental conversion of a json file or readable file, compressed or not, see delta_elements
+    with open_input(json_file) as f:
+        return delta_elements(
+            iter_json_objects(f), state_file, target_file, base_url, removals_file=removals_file, prune=prune
+        )
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# characters that can follow a complete json value
+_DELIMITERS = frozenset(",:]} \t\n\r")
+
+
+def loads_json(text):
+    # json.loads, decoded with orjson if it is installed
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode(json.detect_encoding(text), "surrogatepass")
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def load_json(f):
+    return loads_json(f.read())
+
+
+def serialize(data):
+    # jackson style object identity: typed dicts get an @id, repeated ones are written as it
+    ids = {}
+
+    def visit(value):
+        if isinstance(value, dict):
+            if "@type" not in value:
+                return {key: visit(item) for key, item in value.items()}
+            if id(value) in ids:
+                return ids[id(value)]
+            ids[id(value)] = len(ids) + 1
+            result = {"@type": value["@type"], "@id": ids[id(value)]}
+            result.update((key, visit(item)) for key, item in value.items() if key != "@type")
+            return result
+        if isinstance(value, list):
+            return [visit(item) for item in value]
+        return value
+
+    return visit(data)
+
+
+# keys of the openBIS dtos that hold related objects, the ones that only ever hold back references
+# can not be told from the json
+REFERENCE_KEYS = frozenset(
+    ("type", "project", "space", "experiment", "sample", "dataStore", "registrator", "modifier", "parents", "children")
+)
+
+
+def unserialize(data):
+    # the inverse of serialize: the @id back references are replaced by the objects they refer to, which are
+    # then shared, like repeated objects written in full with the same @id. an int is taken for a reference
+    # in lists and under REFERENCE_KEYS or keys that hold a full object somewhere
+    definitions = {}
+    reference_keys = set(REFERENCE_KEYS)
+
+    def collect(value):
+        if isinstance(value, dict):
+            if "@id" in value:
+                definitions.setdefault(value["@id"], value)
+            for key, item in value.items():
+                if isinstance(item, dict) and "@id" in item:
+                    reference_keys.add(key)
+                collect(item)
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+
+    collect(data)
+    objects = {}
+
+    def is_reference(value):
+        return isinstance(value, int) and not isinstance(value, bool) and value in definitions
+
+    def reference(ref):
+        if ref not in objects:
+            resolve(definitions[ref])
+        return objects[ref]
+
+    def resolve(value):
+        if isinstance(value, dict):
+            if value.get("@id") in objects:
+                return objects[value["@id"]]
+            result = {}
+            if "@id" in value:
+                # registered before the keys, an object can refer back to itself through its children
+                objects[value["@id"]] = result
+            for key, item in value.items():
+                if key != "@id":
+                    result[key] = reference(item) if key in reference_keys and is_reference(item) else resolve(item)
+            return result
+        if isinstance(value, list):
+            return [reference(item) if is_reference(item) else resolve(item) for item in value]
+        return value
+
+    return resolve(data)
+
+
+# compressions -> the extension of their files
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+# the bytes compressed files start with
+_MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+
+def compression_of(path) -> Optional[str]:
+    # the compression a file name asks for by its extension
+    suffix = pathlib.PurePath(path).suffix
+    return next((name for name, extension in COMPRESSIONS.items() if extension == suffix), None)
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ValueError("zstd needs the zstandard package, pip install zstandard")
+    return zstandard
+
+
+@contextlib.contextmanager
+def open_input(source):
+    # a path or readable binary file, gzip and zstd are recognized by their first bytes and decompressed while
+    # reading, never as a whole. text files are used as they are
+    with contextlib.ExitStack() as stack:
+        if isinstance(source, (str, os.PathLike)):
+            source = stack.enter_context(open(source, "rb"))
+        if isinstance(source, io.TextIOBase):
+            yield source
+            return
+        if not hasattr(source, "peek"):
+            source = io.BufferedReader(source)
+        head = source.peek(4)[:4]
+        compression = next((name for magic, name in _MAGIC.items() if head.startswith(magic)), None)
+        if compression == "gzip":
+            source = stack.enter_context(gzip.GzipFile(fileobj=source, mode="rb"))
+        elif compression == "zstd":
+            source = stack.enter_context(
+                _zstandard().ZstdDecompressor().stream_reader(source, read_across_frames=True, closefd=False)
+            )
+        yield source
+
+
+@contextlib.contextmanager
+def open_output(target, compression=None):
+    # a path or writable binary file, compressed by a CompressedWriter if compression is given or the path ends in
+    # the extension of one
+    with contextlib.ExitStack() as stack:
+        if isinstance(target, (str, os.PathLike)):
+            compression = compression or compression_of(target)
+            target = stack.enter_context(open(target, "wb"))
+        if compression is not None:
+            target = stack.enter_context(CompressedWriter(target, compression))
+        yield target
+
+
+def compress_bytes(data: bytes, compression=None) -> bytes:
+    # one gzip member or zstd frame, they can be concatenated into one file and still be read separately
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.compress(data, mtime=0)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor().compress(data)
+    raise ValueError(f"unknown compression {compression}, use one of {', '.join(COMPRESSIONS)}")
+
+
+class CompressedWriter:
+    # writable binary file that compresses into target in a background thread, so the compression overlaps with
+    # the conversion writing to it. writes are collected into chunks, at most queue_size of them wait for the thread
+    def __init__(self, target, compression="gzip", level=None, chunk_size=1 << 20, queue_size=8):
+        if compression == "gzip":
+            self.compressor = gzip.GzipFile(fileobj=target, mode="wb", compresslevel=6 if level is None else level, mtime=0)
+        elif compression == "zstd":
+            compressor = _zstandard().ZstdCompressor(level=3 if level is None else level)
+            self.compressor = compressor.stream_writer(target, closefd=False)
+        else:
+            raise ValueError(f"unknown compression {compression}, use one of {', '.join(COMPRESSIONS)}")
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._compress, name="compress", daemon=True)
+        self.thread.start()
+
+    def _compress(self):
+        # after an error the chunks are still taken, so writers never block on a full queue
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.compressor.write(chunk)
+                except Exception as e:
+                    self.error = e
+        try:
+            self.compressor.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def write(self, data) -> int:
+        if self.error is not None:
+            raise self.error
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def writable(self):
+        return True
 
+    def flush(self):
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
 
-def parse_dict(data, base_url=None):
-    result = Graph()
+    def close(self):
+        # waits for the thread to compress everything, the target stays open
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _JsonReader:
+    # reads json values one at a time from a text or binary file without loading all of it
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        # drops the consumed text and appends the next chunk
+        chunk = self.f.read(size)
+        self.eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self.utf8.decode(chunk, final=self.eof)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str:
+        # next non whitespace character, "" at the end of the file
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos : self.pos + 1]
+            self._fill(self.chunk_size)
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number or literal at the end of the buffer could go on in the next chunk
+                if self.eof or self.buffer[end : end + 1] in _DELIMITERS:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # values larger than a chunk are read in growing chunks, so they are decoded a few times at most
+            self._fill(size)
+            size *= 2
+
+    def items(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("]")
+                return
+
+
+def iter_json_objects(f, chunk_size=1 << 20):
+    # yields the objects of a SearchResult or the items of a top level list one by one,
+    # any other json document is yielded as a whole
+    reader = _JsonReader(f, chunk_size)
+    if reader.peek() == "[":
+        yield from reader.items()
+        return
+    reader.expect("{")
+    data = {}
+    streamed = False
+    while reader.peek() != "}":
+        if data or streamed:
+            reader.expect(",")
+        key = reader.value()
+        reader.expect(":")
+        if key == "objects" and data.get("@type") == "as.dto.common.search.SearchResult" and reader.peek() == "[":
+            yield from reader.items()
+            streamed = True
+        else:
+            value = reader.value()
+            if key != "fetchOptions":
+                data[key] = value
+    reader.expect("}")
+    if not streamed:
+        yield data
+
+
+def parse_dict(data, base_url=None, single_pass=True, stats=False, compact=False, properties=None):
+    # with stats, returns (graph, ConversionStats) of this conversion. with compact the triples are
+    # collected in a TripleBuffer, which is returned instead of a Graph. properties is a PropertyRegistry
+    # shared with other conversions, by default every conversion has its own
+    if stats:
+        stats = ConversionStats()
+        with stats.collect():
+            return (
+                parse_dict(data, base_url=base_url, single_pass=single_pass, compact=compact, properties=properties),
+                stats,
+            )
+    if compact and not single_pass:
+        raise ValueError("fix_iris rewrites triples in place, it needs a Graph")
+    result = TripleBuffer() if compact else Graph()
     result.bind("obis", OBIS)
     result.bind("qudt", QUDT)
     result.bind("oa", OA)
 
     # result.bind('data', _get_ns(base_url))
-    iterate_json(data, result, base_url=base_url)
-    result = fix_iris(result, base_url=base_url)
-    result = attach_distributions(result)
-    
+    if single_pass:
+        # final iris are known before traversal, so no triple has to be rewritten
+        with _phase("resolve_iris"):
+            iris = resolve_iris(data, base_url=base_url)
+        for prefix, namespace in iris.namespaces.items():
+            result.bind(prefix, namespace)
+        with _phase("iterate_json"), _property_registry(properties):
+            iterate_json(data, result, base_url=base_url, iris=iris)
+        with _phase("drop_iris"):
+            result = drop_iris(result, iris.dropped)
+    else:
+        references = {}
+        with _phase("iterate_json"), _property_registry(properties) as registry:
+            iterate_json(data, result, base_url=base_url, references=references)
+        with _phase("fix_iris"):
+            result = fix_iris(result, base_url=base_url, references=references.values())
+            registry.rename(result)
+    with _phase("attach_distributions"):
+        result = attach_distributions(result)
+    if _stats is not None:
+        _stats.triples += len(result)
     return result
 
 
-def parse_json(file_path, base_url=None):
-    with open(file_path) as f:
-        data = json.load(f)
-    return parse_dict(data, base_url=base_url)
+def parse_json(file_path, base_url=None, single_pass=True, stats=False, properties=None):
+    if stats:
+        stats = ConversionStats()
+        with stats.collect():
+            return parse_json(file_path, base_url=base_url, single_pass=single_pass, properties=properties), stats
+    with open_input(file_path) as f, _phase("decode"):
+        data = load_json(f)
+    return parse_dict(data, base_url=base_url, single_pass=single_pass, properties=properties)
+
+
+class ConversionCache:
+    # serialized conversions on disk, keyed on the input json, base_url, format and ontology. entries are written
+    # atomically so several processes can share a directory, the least recently used are evicted past max_bytes
+    def __init__(self, directory=None, max_bytes=1 << 30, ontology_file=ONTOLOGY_FILE):
+        self.directory = pathlib.Path(directory or _cache_dir()) / f"conversions-v{CONVERSION_CACHE_VERSION}"
+        self.max_bytes = max_bytes
+        self.ontology_digest = ontology_hash(ontology_file)
+        # bytes in the directory as of the last scan plus what this process wrote since
+        self.size = None
+
+    def key(self, json_bytes, base_url, target_format, graph_name=None) -> str:
+        parts = (self.ontology_digest, base_url, target_format, graph_name)
+        digest = hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8") + b"\0")
+        digest.update(json_bytes)
+        return digest.hexdigest()
+
+    def path(self, key) -> pathlib.Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data: bytes):
+        try:
+            _write_atomic(self.path(key), data)
+        except OSError:
+            return
+        if self.size is None:
+            self.size = self.scan()[1]
+        else:
+            self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def scan(self):
+        # ([(mtime, size, path)], total size) of the finished entries
+        entries = []
+        for path in self.directory.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def evict(self):
+        # other processes may be evicting the same entries, their files vanishing is fine
+        entries, self.size = self.scan()
+        entries.sort(key=lambda entry: entry[0])
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            with contextlib.suppress(OSError):
+                path.unlink()
+            self.size -= size
+
+    def clear(self):
+        for path in self.directory.glob("*/*"):
+            with contextlib.suppress(OSError):
+                path.unlink()
+        self.size = 0
+
+
+def convert_json(json_file, target_format="turtle", base_url=None, graph_name=None, cache=None) -> bytes:
+    # json_file is a path, a readable file (compressed or not) or the json bytes, returns the serialized rdf,
+    # from the cache without parsing if the same input was converted before
+    if isinstance(json_file, (bytes, bytearray)):
+        json_bytes = bytes(json_file)
+    else:
+        with open_input(json_file) as f:
+            json_bytes = f.read()
+        if isinstance(json_bytes, str):
+            json_bytes = json_bytes.encode("utf-8")
+    if cache is not None:
+        key = cache.key(json_bytes, base_url, target_format, graph_name)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    data = loads_json(json_bytes)
+    output = io.BytesIO()
+    if target_format in STREAMING_FORMATS:
+        stream_dict(data, output, target_format=target_format, base_url=base_url, graph_name=graph_name)
+    else:
+        write_ontology(parse_dict(data, base_url=base_url), output, target_format=target_format)
+    output = output.getvalue()
+    if cache is not None:
+        cache.put(key, output)
+    return output
+
+
+# bump when the tables of the triple store change
+TRIPLE_STORE_VERSION = 1
+
+
+def _nt_term(term) -> str:
+    return _quoteLiteral(term) if isinstance(term, Literal) else term.n3()
+
+
+def store_rows(graph) -> List[Tuple[str, str, str]]:
+    # the triples of a Graph or TripleBuffer as n-triples terms, blank nodes are labeled by a hash of the
+    # triples around them. the value nodes of the same entity are then the same in every file it occurs in
+    # and merge in the store like its iris do
+    neighbours = {}
+    for s, p, o in graph:
+        if isinstance(s, BNode):
+            neighbours.setdefault(s, []).append(f"> {p.n3()} {'_' if isinstance(o, BNode) else _nt_term(o)}")
+        if isinstance(o, BNode):
+            neighbours.setdefault(o, []).append(f"< {'_' if isinstance(s, BNode) else s.n3()} {p.n3()}")
+    labels = {
+        bnode: "_:s" + hashlib.sha1("\n".join(sorted(rows)).encode("utf-8")).hexdigest()[:24]
+        for bnode, rows in neighbours.items()
+    }
+    return [
+        tuple(labels[term] if isinstance(term, BNode) else _nt_term(term) for term in triple) for triple in graph
+    ]
+
+
+def _namespaces(graph) -> List[Tuple[str, str]]:
+    namespaces = graph.namespaces.items() if isinstance(graph, TripleBuffer) else graph.namespaces()
+    return [(prefix, str(namespace)) for prefix, namespace in namespaces]
+
+
+def json_store_rows(json_file, base_url=None, properties=None):
+    # converts a json file for TripleStore.add_rows, in a worker process when many files are added,
+    # returns (rows, namespaces)
+    with open_input(json_file) as f:
+        return dict_store_rows(load_json(f), base_url=base_url, properties=properties)
+
+
+def dict_store_rows(data, base_url=None, properties=None):
+    # see json_store_rows, properties a failed conversion created are forgotten as it is not stored
+    known = dict(properties.properties) if properties is not None else None
+    try:
+        buffer = parse_dict(data, base_url=base_url, compact=True, properties=properties)
+    except Exception:
+        if properties is not None:
+            properties.properties = known
+        raise
+    return store_rows(buffer), _namespaces(buffer)
+
+
+class TripleStore:
+    # triples of many conversions in one sqlite file, so a whole openBIS instance can be merged without holding
+    # it in memory. terms are stored once and a triple added by several files is kept once, the export streams
+    # the triples from disk. the files added through it share a PropertyRegistry
+    def __init__(self, path):
+        self.path = path
+        self.properties = PropertyRegistry()
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, TRIPLE_STORE_VERSION):
+            raise ValueError(f"{path} is a triple store of version {version}, expected {TRIPLE_STORE_VERSION}")
+        with self.db:
+            self.db.executescript(
+                f"""
+                PRAGMA user_version={TRIPLE_STORE_VERSION};
+                CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE);
+                CREATE TABLE IF NOT EXISTS triples (
+                    s INTEGER NOT NULL, p INTEGER NOT NULL, o INTEGER NOT NULL, PRIMARY KEY (s, p, o)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS namespaces (prefix TEXT PRIMARY KEY, namespace TEXT NOT NULL);
+                CREATE TEMP TABLE batch (s TEXT, p TEXT, o TEXT);
+                """
+            )
+
+    def add_rows(self, rows, namespaces=()) -> int:
+        # rows of store_rows and (prefix, namespace) pairs, returns the number of triples that were not in the store yet
+        with self.db:
+            self.db.executemany("INSERT INTO batch VALUES (?, ?, ?)", rows)
+            self.db.execute(
+                "INSERT OR IGNORE INTO terms (term) SELECT s FROM batch UNION SELECT p FROM batch UNION SELECT o FROM batch"
+            )
+            before_triples = self.db.total_changes
+            self.db.execute(
+                """
+                INSERT OR IGNORE INTO triples
+                SELECT ts.id, tp.id, tob.id FROM batch
+                JOIN terms ts ON ts.term = batch.s JOIN terms tp ON tp.term = batch.p JOIN terms tob ON tob.term = batch.o
+                """
+            )
+            added = self.db.total_changes - before_triples
+            self.db.execute("DELETE FROM batch")
+            self.db.executemany("INSERT OR IGNORE INTO namespaces VALUES (?, ?)", namespaces)
+        return added
+
+    def add_graph(self, graph) -> int:
+        # a Graph or TripleBuffer, see store_rows
+        with _phase("store"):
+            return self.add_rows(store_rows(graph), _namespaces(graph))
+
+    def add_dict(self, data, base_url=None) -> int:
+        rows, namespaces = dict_store_rows(data, base_url=base_url, properties=self.properties)
+        with _phase("store"):
+            return self.add_rows(rows, namespaces)
+
+    def add_json(self, json_file, base_url=None) -> int:
+        rows, namespaces = json_store_rows(json_file, base_url=base_url, properties=self.properties)
+        with _phase("store"):
+            return self.add_rows(rows, namespaces)
+
+    def namespaces(self) -> List[Tuple[str, str]]:
+        return self.db.execute("SELECT prefix, namespace FROM namespaces").fetchall()
+
+    def rows(self, batch_size=10000):
+        # (s, p, o) n-triples terms, read from disk batch_size at a time
+        cursor = self.db.execute(
+            """
+            SELECT ts.term, tp.term, tob.term FROM triples
+            JOIN terms ts ON ts.id = triples.s JOIN terms tp ON tp.id = triples.p JOIN terms tob ON tob.id = triples.o
+            """
+        )
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                return
+            yield from batch
+
+    def export(self, target_file, target_format="ntriples", graph_name=None) -> int:
+        # line based formats are streamed from the store, the others are parsed into a Graph first
+        if isinstance(target_file, (str, os.PathLike)):
+            with open_output(target_file) as f:
+                return self.export(f, target_format, graph_name=graph_name)
+        if target_format not in STREAMING_FORMATS:
+            graph = self.to_graph()
+            write_ontology(graph, target_file, target_format)
+            return len(graph)
+        end = f" {graph_name.n3()} .\n" if target_format == "nquads" and graph_name is not None else " .\n"
+        count = 0
+        with _phase("export"):
+            for s, p, o in self.rows():
+                target_file.write(f"{s} {p} {o}{end}".encode("utf-8"))
+                count += 1
+        return count
+
+    def to_graph(self) -> Graph:
+        graph = Graph()
+        for prefix, namespace in self.namespaces():
+            graph.bind(prefix, namespace)
+        output = io.BytesIO()
+        self.export(output)
+        return graph.parse(data=output.getvalue(), format="nt")
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# levels an export can be sharded at -> the class of the containers owning the shards, from the top
+SHARD_LEVELS = {"space": OBIS.Space, "project": OBIS.Project, "collection": OBIS.Collection}
+# entities that go with the container they relate to
+_OWNED_TYPES = frozenset((OBIS.Object, DCAT.Dataset))
+# links to the parts of an entity that go with it, besides its blank nodes
+_PART_PREDICATES = frozenset((OBIS.has_identifier, DCAT.distribution))
+
+
+def shard_owners(graph, level="project") -> dict:
+    # node -> the container whose shard its triples go to. containers are sharded at the level, or at the closest
+    # container above it that is in the export. objects and datasets go with the most specific container they
+    # relate to, else with an entity they relate to, their identifiers, values and distributions go with them.
+    # nodes without an owner, like people, types and property definitions, are shared
+    if level not in SHARD_LEVELS:
+        raise ValueError(f"can not shard by {level}, use one of {', '.join(SHARD_LEVELS)}")
+    ranks = {cls: rank for rank, cls in enumerate(SHARD_LEVELS.values())}
+    top = list(SHARD_LEVELS).index(level)
+    kinds, entities, relations, parts = {}, [], {}, {}
+    for s, p, o in graph:
+        if p == _RDF_TYPE:
+            if o in ranks:
+                kinds.setdefault(s, ranks[o])
+            elif o in _OWNED_TYPES:
+                entities.append(s)
+        elif p == _RELATES_TO:
+            relations.setdefault(s, []).append(o)
+        elif isinstance(o, BNode) or p in _PART_PREDICATES:
+            parts.setdefault(s, []).append(o)
+    # the container one level up, like the project of a collection
+    parents = {}
+    for node, rank in kinds.items():
+        parent = next((o for o in relations.get(node, ()) if kinds.get(o) == rank - 1), None)
+        if parent is not None:
+            parents[node] = parent
+
+    def shard(node):
+        while kinds[node] > top and node in parents:
+            node = parents[node]
+        return node
+
+    owners = {node: shard(node) for node in kinds}
+    pending = []
+    for node in dict.fromkeys(entities):
+        if node in owners:
+            continue
+        containers = [o for o in relations.get(node, ()) if o in kinds]
+        if containers:
+            owners[node] = shard(max(containers, key=kinds.get))
+        else:
+            pending.append(node)
+    # entities only relating to other entities, like a dataset of a sample, until no more owners are found
+    while pending:
+        left = []
+        for node in pending:
+            owner = next((owners[o] for o in relations.get(node, ()) if o in owners), None)
+            if owner is None:
+                left.append(node)
+            else:
+                owners[node] = owner
+        if len(left) == len(pending):
+            break
+        pending = left
+    stack = list(owners)
+    while stack:
+        node = stack.pop()
+        for part in parts.get(node, ()):
+            if part not in owners:
+                owners[part] = owners[node]
+                stack.append(part)
+    return owners
+
+
+def shard_graph(graph, level="project") -> dict:
+    # the triples of a Graph or TripleBuffer split by shard_owners into one TripleBuffer per container, the shared
+    # triples are under None. a triple goes to the shard of its subject
+    owners = shard_owners(graph, level)
+    namespaces = _namespaces(graph)
+    shards = {}
+    for triple in graph:
+        owner = owners.get(triple[0])
+        shard = shards.get(owner)
+        if shard is None:
+            shard = shards[owner] = TripleBuffer()
+            for prefix, namespace in namespaces:
+                shard.bind(prefix, namespace)
+        shard.add(triple)
+    return shards
+
+
+def shard_name(container, base_url=None) -> str:
+    # file name of a shard, the iri of its container relative to the data namespace
+    if container is None:
+        return "shared"
+    ns, iri = str(_get_ns(base_url)), str(container)
+    name = iri[len(ns) :] if iri.startswith(ns) else iri.rstrip("/").rsplit("/", 1)[-1]
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "shard"
 
 
-def create_instance_triple(data: dict, base_url=None):
+def _temp_iri(ref_id, iris=None):
+    # temporary iri of a json @id, or its final iri if resolved up front
+    iri = TEMP[str(ref_id)]
+    if iris is not None:
+        return iris.get(iri)
+    return iri
+
+
+def create_instance_triple(data: dict, base_url=None, iris=None):
     entity = None
     o_class = None
     parent = None
@@ -185,16 +1768,14 @@ def create_instance_triple(data: dict, base_url=None):
 
         instance_id = str(data["@id"])
         o_class = get_obis_entity(data["@type"])
-        print(data["@id"],data["@type"],instance_id,o_class)
+        if _debug:
+            log.debug("%s %s %s %s", data["@id"], data["@type"], instance_id, o_class)
         if o_class:
-            entity = URIRef(instance_id, TEMP)
-        else:
-            print("no type found in OBIS Ontology for key: {}".format(data["@type"]))
-        if data["@type"] == "as.dto.sample.SampleType":
-            parent = OBIS.Object
-        elif data["@type"] == "as.dto.experiment.ExperimentType":
-            parent = OBIS.Collection
-        
+            entity = _temp_iri(instance_id, iris)
+        elif _debug:
+            log.debug("no type found in OBIS Ontology for key: %s", data["@type"])
+        parent = get_index().type_parents.get(data["@type"])
+
     return entity, o_class, parent
 
 
@@ -224,204 +1805,493 @@ def add_identifier(
         return None
 
 
-def create_new_property(graph: Graph, prop_key: str):
+def create_new_property(graph: Graph, prop_key: str, iris=None):
     # create a new ObjectProperty
     obj_prop = BNode()
     obj_prop_id = BNode()
+    if iris is not None:
+        # use the iris fix_iris would give the property and its identifier
+        label = re.sub("[$:]", "", prop_key)
+        if prop_key and label:
+            obj_prop = iris.get(URIRef(f"object_property/{label}", iris.ns))
+        obj_prop_id = iris.get(URIRef(f"permanentidentifier/{label if prop_key else None}", iris.ns))
     graph.add((obj_prop, RDF.type, OWL.ObjectProperty))
     # add identifier
     obj_prop_id = add_identifier(
         graph, obj_prop, obj_prop_id, OBIS.PermanentIdentifier, label=prop_key
     )
-    print("created a custom object property with permid: {}".format(prop_key))
+    if _debug:
+        log.debug("created a custom object property with permid: %s", prop_key)
     return obj_prop
 
 
-def iterate_json(data, graph, last_entity=None, base_url=None):
-    if isinstance(data, dict):
-        # lookup if the id and type in dict result in a ontology entity
-        entity, e_class, parent = create_instance_triple(data, base_url=base_url)
-        
-        if not e_class and "@type" in data.keys():
-            print(data["@id"],data["@type"])
-            if data["@type"]=="as.dto.common.search.SearchResult" and "objects" in data.keys():
-                for hit in data['objects']:
-                    iterate_json(hit, graph, None, base_url=base_url)
-        if e_class in [OBIS.DataSet, DCAT.Distribution,OBIS.DataStore]:
-            print(data.keys())
-        if entity and e_class:
-            adid=data.get('@id',None)
-            print(f"its entity: {entity} and class {e_class} with {adid}")
-
-            # if the entity is a Identifier, only create it if it relates to entity previously created
-            # if e_class in [
-            #     OBIS.PermanentIdentifier,
-            # ]:
-            #     prmid=data.get("permId",None)
-            #     if isinstance(prmid,str):
-            #         label = data["permId"]
-            #         entity = add_identifier(graph, last_entity, entity, e_class, label)
-            #         print(f"added identifier to {last_entity} with label {label}")
-            if e_class in [
-                OBIS.Identifier,
-            ]:
-                label = data["identifier"]
-                entity = add_identifier(graph, last_entity, entity, e_class, label)
-            #skipping directory DataSetFiles
-            if "directory" in data.keys() and data['directory']:
-                print(data['directory'],type(data['directory']),e_class)
-                print("{} is a directory, skipping".format(entity))
-                return
-            else:
-                # add the triple defining the entity
-                graph.add((entity, RDF.type, e_class))
-                print(f"added {entity} with type {e_class}")
-                
-            if parent and e_class==OWL.Class:
-                print(
-                    "new class {} of type {} has parent {}, adding subClassOf relation".format(
-                        entity, e_class, parent
-                    )
+class PropertyRegistry:
+    # custom property code -> the property it converts to, every property is looked up and created once per
+    # conversion instead of for every value. conversions whose outputs end up together (one stream, a TripleStore)
+    # can share a registry, a property is then only defined in the output of the first one using it
+    def __init__(self):
+        self.properties = {}
+
+    def get(self, graph, prop_key: str, iris=None):
+        # the iris of a property depend on the namespace of the conversion
+        key = (iris.ns if iris is not None else None, prop_key)
+        obj_prop = self.properties.get(key)
+        if obj_prop is None:
+            obj_prop = get_custom_props(prop_key, graph) or create_new_property(graph, prop_key, iris=iris)
+            self.properties[key] = obj_prop
+        return obj_prop
+
+    def rename(self, graph):
+        # fix_iris gave the properties created in graph their final iris, the later conversions get these
+        # instead of the blank nodes, found by the permanent identifier labelled with the property code
+        for key, obj_prop in self.properties.items():
+            if not isinstance(obj_prop, BNode) or (obj_prop, RDF.type, OWL.ObjectProperty) in graph:
+                continue
+            label = Literal(re.sub("[$:]", "", key[1]))
+            for identifier in graph.subjects(RDF.value, label):
+                renamed = next(
+                    (
+                        entity
+                        for entity in graph.subjects(OBIS.has_identifier, identifier)
+                        if (entity, RDF.type, OWL.ObjectProperty) in graph
+                    ),
+                    None,
                 )
-                graph.add((entity, RDFS.subClassOf, parent))
+                if renamed is not None:
+                    self.properties[key] = renamed
+                    break
+
+    def __len__(self):
+        return len(self.properties)
+
+
+@contextlib.contextmanager
+def _property_registry(registry=None):
+    # the registry iterate_json uses for the properties of the block, a new one if none is given
+    token = _properties.set(registry if registry is not None else PropertyRegistry())
+    try:
+        yield _properties.get()
+    finally:
+        _properties.reset(token)
+
+
+def _attach_identifier(graph, data, entity, e_class, last_entity):
+    # an Identifier is only created if it relates to the entity it was found in
+    label = data["identifier"]
+    return add_identifier(graph, last_entity, entity, e_class, label)
+
+
+# handlers for entity classes that need more than the type triple, they return the entity to go on with
+ENTITY_HANDLERS = {
+    OBIS.Identifier: _attach_identifier,
+}
+# json types that are no entity but hold documents, -> the key holding them
+CONTAINER_TYPES = {
+    "as.dto.common.search.SearchResult": "objects",
+}
+FILE_TYPE = "dss.dto.datasetfile.DataSetFile"
+# entity classes embedded again under every object of a search, once the final iri of one (from its permId or
+# code) was written, later copies are only linked to and not traversed again
+EMIT_ONCE_CLASSES = frozenset((OBIS.User, OBIS.Space, OBIS.Project, OBIS.DataStore, OWL.Class, OWL.ObjectProperty))
+
+
+def _skip_key(graph, entity, value, iris) -> bool:
+    return True
+
+
+def _add_properties(graph, entity, value, iris) -> bool:
+    # all json keys in properties are relations to openbis properties followed by there values
+    if not isinstance(value, dict):
+        return False
+    registry = _properties.get()
+    for prop_key, prop_value in value.items():
+        if registry is not None:
+            obj_prop = registry.get(graph, prop_key, iris)
+        else:
+            # lookup in graph
+            obj_prop = get_custom_props(prop_key, graph)
+            if not obj_prop:
+                # create a new ObjectProperty
+                obj_prop = create_new_property(graph, prop_key, iris=iris)
+        # the iri pre-scan has no use for the values
+        if not isinstance(graph, _IriRecorder):
+            describe_value(graph, entity, obj_prop, prop_value)
+        # graph.add((entity, obj_prop, Literal(str(prop_value))))
+    return True
+
+
+def _add_permid(graph, entity, value, iris) -> bool:
+    if isinstance(value, str):
+        graph.add((entity, RDF.value, Literal(value)))
+        return True
+    if not (isinstance(value, dict) and "dataSetId" in value.keys()):
+        return False
+    #add nested dataSetPermID
+    annotation = get_obis_entity("dataSetId")
+    id_perident = str(value["dataSetId"]["permId"])
+    if _debug:
+        log.debug("adding tripple: %s %s %s", entity, annotation, id_perident)
+    if annotation:
+        graph.add((entity, annotation, Literal(id_perident)))
+    # need to add filePath
+    if "filePath" in value.keys() and isinstance(value['filePath'], str):
+        if _debug:
+            log.debug("filePath found")
+        identifier = BNode()
+        if iris is not None:
+            label = value['filePath']
+            identifier = iris.get(URIRef(f"permanentidentifier/{re.sub('[$:]', '', label) if label else None}", iris.ns))
+        add_identifier(graph, entity, identifier=identifier, identifier_class=OBIS.PermanentIdentifier, label=value['filePath'])
+    return True
+
+
+# handlers for json keys of an entity, they return False to leave the value to the generic handling
+KEY_HANDLERS = {
+    "fetchOptions": _skip_key,
+    "properties": _add_properties,
+    "permId": _add_permid,
+}
+
+
+# keys of a file listing entry _add_file_listing handles itself
+_FILE_KEYS = frozenset(("@type", "@id", "permId", "directory"))
+
 
-            for key, value in data.items():
-                # if the key is properties all json keys in that dict are relations to openbis properties followed by there values
-                if key == "fetchOptions":
+def _ns_iri(ns, path) -> URIRef:
+    # URIRef(path, ns) without the urljoin where joining only appends the path
+    if path[:1] in " /" or "//" in path or "/." in "/" + path or not path.isprintable() or "?" in path or "#" in path:
+        return URIRef(path, ns)
+    return URIRef(ns + path)
+
+
+def _file_row(item) -> bool:
+    # a file entry that converts column by column: a flat dict with the dataset permId and a file path
+    perm_id = item.get("permId")
+    if not (isinstance(perm_id, dict) and isinstance(perm_id.get("dataSetId"), dict)):
+        return False
+    path = perm_id.get("filePath")
+    if "permId" not in perm_id["dataSetId"] or not (isinstance(path, str) and re.sub("[$:]", "", path)):
+        return False
+    return all(key == "permId" or not isinstance(value, (dict, list)) for key, value in item.items())
+
+
+def _add_file_listing(graph, items, base_url=None, iris=None, references=None) -> list:
+    # the plain entries of a DataSetFile listing are converted a column at a time into the same triples
+    # iterate_json adds for them one by one, but with the final distribution iris. returns the entries left
+    if iris is None and not isinstance(graph, _IriRecorder):
+        # fix_iris renames the distributions afterwards
+        return items
+    files, directories, rest = [], [], []
+    for item in items:
+        if not (isinstance(item, dict) and item.get("@type") == FILE_TYPE and "@id" in item):
+            rest.append(item)
+        elif item.get("directory"):
+            directories.append(item)
+        elif _file_row(item):
+            files.append(item)
+        else:
+            rest.append(item)
+    if references is not None:
+        # directories are skipped, their @ids are dropped like any other that is never converted
+        for item in directories + files:
+            references.setdefault(item["@id"], _temp_iri(item["@id"], iris))
+    if _stats is not None:
+        _stats.skipped_directories += len(directories)
+        _stats.entities[str(DCAT.Distribution)] += len(files)
+    if _debug:
+        log.debug("file listing: %d files, %d directories skipped", len(files), len(directories))
+
+    temporary = [TEMP[str(item["@id"])] for item in files]
+    dataset_permids = [str(item["permId"]["dataSetId"]["permId"]) for item in files]
+    labels = [re.sub("[$:]", "", item["permId"]["filePath"]) for item in files]
+    annotation = get_obis_entity("dataSetId")
+    if iris is None:
+        # the iri pre-scan, resolve_iris names the distributions like fix_iris would from their identifiers
+        ns = _get_ns(base_url)
+        entities = temporary
+        distribution = DCAT.Distribution
+        for iri, dataset_permid, label in zip(temporary, dataset_permids, labels):
+            graph.add((iri, _RDF_TYPE, distribution))
+            graph.distributions.append((graph.nodes[iri], _ns_iri(ns, f"distribution/{dataset_permid}/{label}")))
+    else:
+        entities = [iris.get(iri) for iri in temporary]
+        distribution, permanent_identifier = DCAT.Distribution, OBIS.PermanentIdentifier
+        has_identifier, is_identifier_of = OBIS.has_identifier, OBIS.is_identifier_of
+        for entity, dataset_permid, label in zip(entities, dataset_permids, labels):
+            identifier = iris.get(_ns_iri(iris.ns, f"permanentidentifier/{label}"))
+            graph.add((entity, _RDF_TYPE, distribution))
+            if annotation:
+                graph.add((entity, annotation, Literal(dataset_permid)))
+            graph.add((identifier, _RDF_TYPE, permanent_identifier))
+            graph.add((identifier, _RDF_VALUE, Literal(label)))
+            graph.add((entity, has_identifier, identifier))
+            graph.add((identifier, is_identifier_of, entity))
+
+    for key in dict.fromkeys(key for item in files for key in item):
+        if key in _FILE_KEYS:
+            continue
+        annotation = get_obis_entity(key)
+        if iris is None and annotation != _RELATES_TO and annotation not in _RECORDED_PREDICATES:
+            # nothing the pre-scan keeps
+            continue
+        # values that are not set are skipped
+        column = [(entity, item[key]) for entity, item in zip(entities, files) if item.get(key)]
+        if not annotation:
+            if _stats is not None and column:
+                _stats.unhandled_keys[key] += len(column)
+        elif annotation == _RELATES_TO:
+            for entity, value in column:
+                target = _temp_iri(value, iris)
+                if references is not None:
+                    references.setdefault(value, target)
+                graph.add((entity, annotation, target))
+        elif key in _DATE_KEYS or key == "email":
+            for entity, value in column:
+                _add_annotation(graph, entity, key, value, iris, references)
+        else:
+            for entity, value in column:
+                graph.add((entity, annotation, Literal(str(value))))
+    return rest
+
+
+# handlers for lists of one json type that are converted at once, they return the items left to iterate_json
+LIST_HANDLERS = {
+    FILE_TYPE: _add_file_listing,
+}
+
+
+def _visit_items(items, graph, stack, base_url=None, iris=None, references=None):
+    # list items are visited without the entity the list belongs to
+    if items and isinstance(items[0], dict):
+        handler = LIST_HANDLERS.get(items[0].get("@type"))
+        if handler is not None:
+            items = handler(graph, items, base_url, iris, references)
+    stack.append((_ITEMS, iter(items), None))
+
+
+# terms used for every json value, looked up once instead of through the namespaces
+_RDF_TYPE = RDF.type
+_RDF_VALUE = RDF.value
+_RELATES_TO = OBIS.relates_to
+_DATE_KEYS = frozenset(("registrationDate", "modificationDate"))
+# entity classes whose json keys are logged
+_LOGGED_CLASSES = frozenset((OBIS.DataSet, DCAT.Distribution, OBIS.DataStore))
+
+
+def _add_annotation(graph, entity, key, value, iris, references=None):
+    # if its no dict or list test if its kind of object/data/annotation property and set it
+    annotation = get_obis_entity(key)
+    if _debug:
+        log.debug("non list or dict object %s %s %s %r", entity, key, annotation, value)
+    # skip if the value is not set
+    if not value:
+        return
+    elif not (entity and annotation):
+        if key not in ["@type","@id"]:
+            _unhandled(key, value)
+    # date value should be transformed to iso format
+    elif key in _DATE_KEYS:
+        # timestamp values are transformed to iso datetime strings, the iri pre-scan has no use for them
+        batch = _literals.get()
+        if batch is not None and batch.graph is graph:
+            batch.add_timestamp(entity, annotation, value)
+        elif not isinstance(graph, _IriRecorder):
+            graph.add((entity, annotation, timestamp_literal(value)))
+    # emails should have mailto prefix
+    elif key == "email":
+        graph.add(
+            (
+                entity,
+                annotation,
+                URIRef("mailto:{}".format(value)),
+            )
+        )
+    # these are properties having a singular entry which is a relativ id in the json output
+    elif annotation == _RELATES_TO:
+        # these json keyword point to integers which relates to other entities
+        # graph.add((entity, annotation, _get_ns(base_url)[str(value)]))
+        target = _temp_iri(value, iris)
+        if references is not None:
+            references.setdefault(value, target)
+        graph.add((entity, annotation, target))
+    elif isinstance(value, (str,int,float)):
+        graph.add((entity, annotation, Literal(str(value))))
+    else:
+        if key not in ["@type","@id"]:
+            _unhandled(key, value)
+
+
+def _unhandled(key, value, entity=None):
+    if _stats is not None:
+        _stats.unhandled_keys[key] += 1
+    if _debug:
+        if entity is None:
+            log.debug("possible unhandled annotation %s with %r", key, value)
+        else:
+            log.debug("unhandled relation on entity %s with %s.", entity, key)
+
+
+# what an entry of the iterate_json stack stands for
+_VISIT, _KEYS, _ITEMS, _RELATE, _RELATE_ITEMS = range(5)
+
+
+def iterate_json(data, graph, last_entity=None, base_url=None, iris=None, references=None, emitted=None):
+    # walks the json with an explicit stack, so deep parent/child chains can not hit the recursion limit,
+    # triples are added in the same order as by a depth first recursion,
+    # references collects the temporary iri of every @id defined or referred to by its integer.
+    # with final iris, emitted maps the entities of EMIT_ONCE_CLASSES written so far to their dates and json keys,
+    # pass the same dict to share it between documents going into one output
+    if emitted is None and iris is not None:
+        emitted = {}
+    with _literal_batch(graph):
+        _iterate(data, graph, last_entity, base_url, iris, references, emitted)
+
+
+def _iterate(data, graph, last_entity, base_url, iris, references, emitted):
+    stack = [(_VISIT, data, last_entity)]
+    while stack:
+        frame = stack[-1]
+        kind = frame[0]
+        if kind == _KEYS:
+            # the keys of an entity, until a nested dict or list has to be visited first
+            _, items, entity = frame
+            for key, value in items:
+                handler = KEY_HANDLERS.get(key)
+                if handler is not None and handler(graph, entity, value, iris):
                     continue
-                elif key == "properties" and isinstance(value, dict):
-                    # lookup in graph
-                    for prop_key, prop_value in value.items():
-                        obj_prop = get_custom_props(prop_key, graph)
-                        # print(entity, key, prop_key, prop_value, obj_prop)
-                        if not obj_prop:
-                            # create a new ObjectProperty
-                            obj_prop = create_new_property(graph, prop_key)
-                        describe_value(graph, entity, obj_prop, prop_value)
-                        # graph.add((entity, obj_prop, Literal(str(prop_value))))
-                #add nested dataSetPermID
-                elif key == "permId" and isinstance(value, dict) and "dataSetId" in value.keys():
-                    annotation = get_obis_entity("dataSetId")
-                    id_perident=str(value["dataSetId"]["permId"])
-                    print('adding tripple: {} {} {}'.format(entity,annotation,Literal(id_perident)))
-                    if annotation:
-                        graph.add(
-                                (
-                                    entity,
-                                    annotation,
-                                    Literal(id_perident)
-                                )
-                            )
-                    # need to add filePath
-                    if "filePath" in value.keys() and isinstance(value['filePath'],str):
-                        print('filePath found')
-                        add_identifier(graph, entity, identifier=BNode(),identifier_class=OBIS.PermanentIdentifier, label=value['filePath'])
-                elif key == "permId" and isinstance(value, str):
-                    graph.add(
-                            (
-                                entity,
-                                RDF.value,
-                                Literal(value),
-                            )
-                        )
-                elif isinstance(value, dict):
-                    print("iterate dict")
-                    # recursively inter over all json objects
-                    iterate_json(value, graph, entity, base_url=base_url)
-                    # add the ObjectProperty to the created instance
-                    annotation = get_obis_entity(key)
-                    # identifiers are handled already
-                    if entity and key not in ["identifier", "id"]:
-                        if (
-                            annotation and "@id" in value.keys()
-                        ):  # and key in ['project', 'space', 'experiment']:
-                            graph.add(
-                                (
-                                    entity,
-                                    annotation,
-                                    URIRef(str(value["@id"]), TEMP),
-                                )
-                            )
-                            
-                        else:
-                            print(f"unhandled relation on entity {entity} with {key}.")
-                            #print(entity, e_class, annotation, key)
+                if isinstance(value, dict):
+                    # the relation is added once the nested object is done
+                    stack.append((_RELATE, entity, key, value))
+                    stack.append((_VISIT, value, entity))
+                    break
                 elif isinstance(value, list):
-                    print("iterate list")
-                    # recursively inter over all json objects
-                    iterate_json(value, graph, entity, base_url=base_url)
-                    # see if an entity is created and relate it if necessary
-                    annotation = get_obis_entity(key)
-                    if entity and annotation:
-                        for item in value:
-                            if isinstance(item, dict) and "@id" in item.keys():
-                                graph.add(
-                                    (
-                                        entity,
-                                        annotation,
-                                        URIRef(str(item["@id"]), TEMP),
-                                    )
-                                )
-                                print('adding tripple: {} {} {}'.format(entity,annotation,URIRef(str(item["@id"]), TEMP)))
-                    else:
-                        print(f"unhandled relation on entity {entity} with {key}.")
+                    stack.append((_RELATE_ITEMS, entity, key, value))
+                    _visit_items(value, graph, stack, base_url, iris, references)
+                    break
                 else:
-                    # if its no dict or list test if its kind of object/data/annotation property and set it
-                    annotation = get_obis_entity(key)
-                    print("non list or dict object {} {}".format(key,value))
-                    # skip if the value is not set
-                    print(entity,key,annotation,value,type(value))
-                    if not value:
-                        continue
-                    # date value should be transformed to iso format
-                    elif (
-                        entity
-                        and annotation
-                        and key in ["registrationDate", "modificationDate"]
-                    ):
-                        # timestamp values are transformed to iso datetime strings
-                        timestamp = value / 1000  # convert milliseconds to seconds
-                        dt = datetime.fromtimestamp(timestamp)
-                        iso_string = dt.isoformat()
-                        graph.add(
-                            (
-                                entity,
-                                annotation,
-                                Literal(str(iso_string), datatype=XSD.dateTimeStamp),
-                            )
+                    _add_annotation(graph, entity, key, value, iris, references)
+            else:
+                stack.pop()
+        elif kind == _ITEMS:
+            # list items are visited without the entity the list belongs to
+            for item in frame[1]:
+                if isinstance(item, (dict, list)):
+                    stack.append((_VISIT, item, None))
+                    break
+            else:
+                stack.pop()
+        elif kind == _RELATE:
+            stack.pop()
+            _, entity, key, value = frame
+            # add the ObjectProperty to the created instance
+            annotation = get_obis_entity(key)
+            # identifiers are handled already
+            if entity and key not in ["identifier", "id"]:
+                if (
+                    annotation and "@id" in value.keys()
+                ):  # and key in ['project', 'space', 'experiment']:
+                    graph.add(
+                        (
+                            entity,
+                            annotation,
+                            _temp_iri(value["@id"], iris),
                         )
-                    # emails should have mailto prefix
-                    elif entity and annotation and key in ["email"]:
+                    )
+
+                else:
+                    _unhandled(key, value, entity)
+        elif kind == _RELATE_ITEMS:
+            stack.pop()
+            _, entity, key, value = frame
+            # see if an entity is created and relate it if necessary
+            annotation = get_obis_entity(key)
+            if entity and annotation:
+                for item in value:
+                    if isinstance(item, dict) and "@id" in item.keys():
                         graph.add(
                             (
                                 entity,
                                 annotation,
-                                URIRef("mailto:{}".format(value)),
+                                _temp_iri(item["@id"], iris),
                             )
                         )
-                    # these are properties having a singular entry which is a relativ id in the json output
-                    elif (
-                        entity
-                        and annotation
-                        and annotation==OBIS.relates_to
-                    ):
-                        # these json keyword point to integers which relates to other entities
-                        # graph.add((entity, annotation, _get_ns(base_url)[str(value)]))
-                        graph.add((entity, annotation, URIRef(str(value), TEMP)))
-                    elif entity and annotation and isinstance(value, (str,int,float)):
-                        graph.add((entity, annotation, Literal(str(value))))
-                        print('adding tripple: {} {} {}'.format(entity,annotation,Literal(str(value))))
-                    else:
-                        if key not in ["@type","@id"]:
-                            print(f"possible unhandled annotation {key} with {value}")
-            
-    elif isinstance(data, list):
-        for item in data:
-            iterate_json(item, graph, base_url=base_url)
+            else:
+                _unhandled(key, value, entity)
+        else:
+            stack.pop()
+            _, data, last_entity = frame
+            if isinstance(data, list):
+                _visit_items(data, graph, stack, base_url, iris, references)
+            elif isinstance(data, dict):
+                _visit_dict(data, graph, last_entity, stack, base_url, iris, references, emitted)
+
+
+def _repeated(data, entity, emitted) -> bool:
+    # a copy of an entity written before adds nothing if it is the same version (same dates) and has no keys with
+    # values the copies before lacked, the link to it is added by the entity holding it
+    keys = frozenset(key for key, value in data.items() if value)
+    versions = emitted.setdefault(entity, {})
+    version = (data.get("registrationDate"), data.get("modificationDate"))
+    seen = versions.get(version)
+    if seen is not None and keys <= seen:
+        return True
+    versions[version] = keys if seen is None else seen | keys
+    return False
+
+
+def _visit_dict(data, graph, last_entity, stack, base_url=None, iris=None, references=None, emitted=None):
+    # lookup if the id and type in dict result in a ontology entity
+    entity, e_class, parent = create_instance_triple(data, base_url=base_url, iris=iris)
+    if references is not None and "@id" in data:
+        # objects that are no entity are related to by their @id as well, they are dropped with the relations
+        references.setdefault(data["@id"], entity or _temp_iri(data["@id"], iris))
+
+    if not e_class and "@type" in data.keys():
+        container_key = CONTAINER_TYPES.get(data["@type"])
+        if container_key in data.keys():
+            # the documents in it are visited like top level ones
+            _visit_items(data[container_key], graph, stack, base_url, iris, references)
+        elif _stats is not None:
+            _stats.unknown_types[data["@type"]] += 1
+    if _debug and e_class in _LOGGED_CLASSES:
+        log.debug("%s", data.keys())
+    if entity and e_class:
+        if _debug:
+            log.debug("its entity: %s and class %s with %s", entity, e_class, data.get("@id"))
+
+        if emitted is not None and e_class in EMIT_ONCE_CLASSES and _repeated(data, entity, emitted):
+            if _stats is not None:
+                _stats.repeated_entities[str(e_class)] += 1
+            return
+        handler = ENTITY_HANDLERS.get(e_class)
+        if handler is not None:
+            entity = handler(graph, data, entity, e_class, last_entity)
+        #skipping directory DataSetFiles
+        if "directory" in data.keys() and data['directory']:
+            if _stats is not None:
+                _stats.skipped_directories += 1
+            if _debug:
+                log.debug("%s is a directory, skipping", entity)
+            return
+        else:
+            # add the triple defining the entity
+            graph.add((entity, _RDF_TYPE, e_class))
+            if _stats is not None:
+                _stats.entities[str(e_class)] += 1
+            if _debug:
+                log.debug("added %s with type %s", entity, e_class)
+
+        if parent and e_class==OWL.Class:
+            if _debug:
+                log.debug("new class %s of type %s has parent %s, adding subClassOf relation", entity, e_class, parent)
+            graph.add((entity, RDFS.subClassOf, parent))
+        stack.append((_KEYS, iter(data.items()), entity))
 
 
 def replace_iris(old: URIRef, new: URIRef, graph: Graph):
     # replaces all iri of all triple in a graph with the value of relation
+    if _stats is not None:
+        _stats.iris_rewritten += 1
     old_triples = list(graph[old:None:None])
     for triple in old_triples:
         graph.remove((old, triple[0], triple[1]))
@@ -436,7 +2306,8 @@ def replace_iris(old: URIRef, new: URIRef, graph: Graph):
         graph.add((triple[0], new, triple[1]))
 
 
-def fix_iris(graph, base_url=None):
+def fix_iris(graph, base_url=None, references=()):
+    # references are the temporary iris of the json @ids, as collected by iterate_json
 
     # replace int iris with permids if possible
     for permid in graph[: RDF.type : OBIS.PermanentIdentifier]:
@@ -448,7 +2319,8 @@ def fix_iris(graph, base_url=None):
         
         for identity in identities:
             identities_type = graph.value(identity, RDF.type)
-            print(identity, identities_type, permid_value)
+            if _debug:
+                log.debug("%s %s %s", identity, identities_type, permid_value)
             if identities_type and permid_value:
                 type_str = identities_type.split("#")[-1].split("/")[-1].lower()
                 prefix=type_str
@@ -466,7 +2338,8 @@ def fix_iris(graph, base_url=None):
                     new = URIRef(f"{type_str}/{permid_value}", _get_ns(base_url))
                 graph.bind(prefix, _get_ns(base_url)[f"{type_str}/"])
                 replace_iris(identity, new, graph)
-                print(identity, new)
+                if _debug:
+                    log.debug("%s %s", identity, new)
 
 
     # replace iri of created object properties with value of code if possible
@@ -487,9 +2360,10 @@ def fix_iris(graph, base_url=None):
         replace_iris(identifier, new, graph)
    
     #if still int id left try to replace them with OBIS.code
-    temp_entities=[subject for subject in graph.subjects(None,None,unique=True) if str(subject).rsplit("/",1)[-1].isnumeric()]
-    temp_entities+=[object for object in graph.objects(None,None,unique=True) if str(object).rsplit("/",1)[-1].isnumeric()]
-    for entity in temp_entities:
+    for entity in dict.fromkeys(references):
+        if (entity, None, None) not in graph and (None, None, entity) not in graph:
+            # replaced already
+            continue
         code_value = graph.value(entity, OBIS.code)
         #print(entity,code_value)
         if code_value:
@@ -497,12 +2371,233 @@ def fix_iris(graph, base_url=None):
             replace_iris(entity, new, graph)
         #remove probably if not meaningful
         else:
-            print(list(graph[::entity]))
+            if _stats is not None:
+                _stats.iris_dropped += 1
+            if _debug:
+                log.debug("dropping %s %s", entity, list(graph[::entity]))
             graph.remove((entity,None,None))
             graph.remove((None,OBIS.relates_to,entity))
     
     return graph
 
+class IriTable(NamedTuple):
+    # temporary or intermediate iri -> the iri fix_iris ends up giving it
+    names: Mapping[URIRef, Union[URIRef, BNode]]
+    # iris fix_iris removes together with the obis:relates_to links pointing at them
+    dropped: List[URIRef]
+    # prefixes fix_iris binds to the result graph
+    namespaces: Mapping[str, Namespace]
+    ns: Namespace
+
+    def get(self, iri):
+        return self.names.get(iri, iri)
+
+
+class _IriNode:
+    __slots__ = ("name", "types", "codes", "values", "dataset_permids", "identities", "merged")
+
+    def __init__(self, name):
+        self.name = name
+        self.types = []
+        self.codes = []
+        self.values = []
+        self.dataset_permids = []
+        # subjects of obis:has_identifier pointing at this node
+        self.identities = []
+        self.merged = None
+
+    def find(self):
+        node = self
+        while node.merged is not None:
+            node = node.merged
+        return node
+
+
+# BNode subjects are only tracked if fix_iris renames nodes of their type
+_RENAMED_TYPES = (OBIS.PermanentIdentifier, OWL.ObjectProperty, OBIS.Identifier)
+# predicates fix_iris reads -> where the recorder keeps them
+_RECORDED_PREDICATES = {
+    RDF.type: "types",
+    OBIS.code: "codes",
+    RDF.value: "values",
+    OBIS.dataset_permid: "dataset_permids",
+    OBIS.has_identifier: "identities",
+}
+
+
+class _IriRecorder:
+    # graph stand-in for iterate_json that keeps only the triples fix_iris derives iris from
+    def __init__(self, codes=None):
+        self.nodes = {}
+        self.typed = {rdf_type: [] for rdf_type in _RENAMED_TYPES}
+        self.codes = {}
+        # codes of entities converted before, they come first like in the graph
+        self.known_codes = codes if codes is not None else {}
+        # distributions of file listings -> the iri they get, see _add_file_listing
+        self.distributions = []
+
+    def add(self, triple):
+        s, p, o = triple
+        field = _RECORDED_PREDICATES.get(p)
+        if field is None:
+            return
+        node = self.nodes.get(s)
+        if node is None:
+            if isinstance(s, BNode) and not (field == "types" and o in _RENAMED_TYPES):
+                return
+            node = self.nodes[s] = _IriNode(s)
+        if field == "types":
+            if o not in node.types:
+                node.types.append(o)
+                if o in self.typed:
+                    self.typed[o].append(node)
+        elif field == "identities":
+            if not isinstance(o, Literal):
+                if o not in self.nodes:
+                    self.nodes[o] = _IriNode(o)
+                _append_new(self.nodes[o].identities, node)
+        else:
+            _append_new(getattr(node, field), o)
+            if field == "codes":
+                self.codes.setdefault(o, s)
+
+    def subjects(self, predicate, object):
+        # only the obis:code lookup of get_custom_props is supported
+        if predicate == OBIS.code:
+            if object in self.known_codes:
+                yield self.known_codes[object]
+            elif object in self.codes:
+                yield self.codes[object]
+
+
+def _append_new(values: list, value):
+    if value not in values:
+        values.append(value)
+
+
+def resolve_iris(data, base_url=None, resolved=None, codes=None) -> IriTable:
+    # pre-scan the json and replay fix_iris on the recorded entities instead of the graph,
+    # resolved and codes carry the iris of documents converted before and are updated in place
+    recorder = _IriRecorder(codes)
+    # @id -> temporary iri of every object and integer reference met
+    references = {}
+    with _untracked(), _property_registry():
+        iterate_json(data, recorder, base_url=base_url, references=references)
+    ns = _get_ns(base_url)
+    live = {node.name: node for node in recorder.nodes.values()}
+    history = dict(live)
+    namespaces = {}
+
+    def names(nodes):
+        # like the subject lists fix_iris iterates, taken when a step starts
+        return list(dict.fromkeys(node.find().name for node in nodes))
+
+    def rename(node, new):
+        node = node.find()
+        if new == node.name:
+            return
+        del live[node.name]
+        target = live.get(new)
+        if target is not None:
+            # same as replace_iris onto an existing node, the triples are merged
+            for attr in ("types", "codes", "values", "dataset_permids", "identities"):
+                for value in getattr(node, attr):
+                    _append_new(getattr(target, attr), value)
+            node.merged = target
+        else:
+            node.name = new
+            live[new] = node
+        history.setdefault(new, node.find())
+
+    # replace int iris with permids if possible
+    for name in names(recorder.typed[OBIS.PermanentIdentifier]):
+        permid = live.get(name)
+        if permid is None:
+            continue
+        permid_value = permid.values[0] if permid.values else None
+        identities = [live[name] for name in names(permid.identities)]
+        for identity in identities:
+            identity = identity.find()
+            identities_type = identity.types[0] if identity.types else None
+            if identities_type and permid_value:
+                type_str = identities_type.split("#")[-1].split("/")[-1].lower()
+                prefix = type_str
+                if identities_type in [OWL.Class]:
+                    type_str = "class"
+                    prefix = "obiclass"
+                elif identities_type in [OWL.ObjectProperty]:
+                    type_str = "object_property"
+                    prefix = "obisop"
+                if identities_type in [DCAT.Distribution]:
+                    dataset_prmid = identity.dataset_permids[0] if identity.dataset_permids else None
+                    new = URIRef(f"{type_str}/{dataset_prmid}/{permid_value}", ns)
+                else:
+                    new = URIRef(f"{type_str}/{permid_value}", ns)
+                namespaces.setdefault(prefix, ns[f"{type_str}/"])
+                rename(identity, new)
+    for node, new in recorder.distributions:
+        namespaces.setdefault("distribution", ns["distribution/"])
+        rename(node, new)
+
+    # replace iri of created object properties with value of code if possible
+    for name in names(recorder.typed[OWL.ObjectProperty]):
+        property = live.get(name)
+        if property is not None and property.codes:
+            rename(property, ns[property.codes[0]])
+    for name in names(recorder.typed[OBIS.Identifier]):
+        if name in live:
+            rename(live[name], BNode())
+    if recorder.distributions:
+        namespaces.setdefault("permanentidentifier", ns["permanentidentifier/"])
+    for name in names(recorder.typed[OBIS.PermanentIdentifier]):
+        namespaces.setdefault("permanentidentifier", ns["permanentidentifier/"])
+        identifier = live.get(name)
+        if identifier is not None:
+            permid_value = str(identifier.values[0] if identifier.values else None)
+            rename(identifier, URIRef(f"permanentidentifier/{permid_value}", ns))
+
+    # if still int id left try to replace them with OBIS.code, else they are dropped
+    dropped = []
+    names = {}
+    temporary = list(dict.fromkeys(references.values()))
+    for iri in temporary:
+        entity = history.get(iri)
+        if entity is None:
+            # a reference back to an @id of an earlier document
+            if resolved and resolved.get(iri) is not None:
+                names[iri] = resolved[iri]
+            else:
+                dropped.append(iri)
+            continue
+        entity = entity.find()
+        if entity.name == iri:
+            if entity.codes:
+                rename(entity, ns[entity.codes[0]])
+            else:
+                dropped.append(iri)
+
+    for name, node in history.items():
+        final = node.find().name
+        if isinstance(name, URIRef) and final != name:
+            names[name] = final
+    if _stats is not None:
+        _stats.iris_rewritten += len(names)
+        _stats.iris_dropped += len(dropped)
+    if resolved is not None:
+        dropped_names = set(dropped)
+        for iri in temporary:
+            final = names.get(iri, iri)
+            resolved[iri] = None if final in dropped_names else final
+    return IriTable(names, dropped, namespaces, ns)
+
+
+def drop_iris(graph, dropped):
+    for entity in dropped:
+        graph.remove((entity, None, None))
+        graph.remove((None, OBIS.relates_to, entity))
+    return graph
+
+
 def get_permid(graph,entitiy):
     identifiers=[identifier for identifier in graph[entitiy:OBIS.has_identifier:] if graph.value(identifier,RDF.type)==OBIS.PermanentIdentifier]
     if identifiers:
@@ -510,21 +2605,58 @@ def get_permid(graph,entitiy):
     else:
         return None
 
-def attach_distributions(graph, base_url=None):
-    print("attach distributions")
-    for distribution in graph[: RDF.type : DCAT.Distribution]:
-        permids = graph.objects(distribution, OBIS.dataset_permid)
-        for permid in permids:
-            identifer=next(graph.subjects(RDF.value,permid),None)
+def _first_subjects(graph, predicate):
+    # object -> first subject with it, like next(graph.subjects(predicate, object))
+    index = {}
+    for s, o in graph.subject_objects(predicate):
+        index.setdefault(o, s)
+    return index
+
+
+def _first_objects(graph, predicate):
+    # subject -> first object, like graph.value(subject, predicate) for single valued predicates
+    index = {}
+    for s, o in graph.subject_objects(predicate):
+        index.setdefault(s, o)
+    return index
+
+
+def attach_distributions(graph, base_url=None, target=None):
+    # the distribution triples go to target if given, e.g. a streaming writer
+    target = graph if target is None else target
+    if _debug:
+        log.debug("attach distributions")
+    distributions = list(graph.subjects(RDF.type, DCAT.Distribution))
+    if not distributions:
+        return graph
+    # everything looked up per distribution is indexed in one sweep over the graph
+    identifiers = _first_subjects(graph, RDF.value)
+    datasets = _first_subjects(graph, OBIS.has_identifier)
+    endpoints = _first_objects(graph, DCAT.endpointURL)
+    file_paths = _first_objects(graph, OBIS.file_path)
+    # dataset -> the first data store (in graph order) it relates to
+    stores = {store: i for i, store in enumerate(graph.subjects(RDF.type, OBIS.DataStore))}
+    dataset_stores = {}
+    for dataset, store in graph.subject_objects(OBIS.relates_to):
+        if store in stores and (dataset not in dataset_stores or stores[store] < stores[dataset_stores[dataset]]):
+            dataset_stores[dataset] = store
+    permids = {}
+    for distribution, permid in graph.subject_objects(OBIS.dataset_permid):
+        permids.setdefault(distribution, []).append(permid)
+    for distribution in distributions:
+        for permid in permids.get(distribution, ()):
+            identifer = identifiers.get(permid)
             if identifer:
-                dataset=next(graph.subjects(OBIS.has_identifier, identifer),None)
+                dataset = datasets.get(identifer)
                 if dataset:
-                    graph.add((dataset,DCAT.distribution,distribution))
-                    store=[store for store in graph.subjects(RDF.type,OBIS.DataStore) if store in graph.objects(dataset,OBIS.relates_to)][0]
-                    store_url=graph.value(store,DCAT.endpointURL)
-                    file_url=graph.value(distribution,OBIS.file_path)
+                    target.add((dataset, DCAT.distribution, distribution))
+                    store_url = endpoints.get(dataset_stores.get(dataset))
+                    file_url = file_paths.get(distribution)
                     if store_url:
-                        obj=URIRef(f"{store_url}/datastore_server/{permid}/{file_url}")
-                        graph.add((distribution,DCAT.downloadURL,obj))
-                        print('adding tripple: {} {} {}'.format(distribution,DCAT.downloadURL,obj))
+                        obj = URIRef(f"{store_url}/datastore_server/{permid}/{file_url}")
+                        target.add((distribution, DCAT.downloadURL, obj))
+                        if _stats is not None:
+                            _stats.download_urls += 1
+                        if _debug:
+                            log.debug("adding tripple: %s %s %s", distribution, DCAT.downloadURL, obj)
     return graph
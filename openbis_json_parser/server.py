@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import urllib.parse
+
+from openbis_json_parser.main import ConversionCache, convert_json, get_index, init_worker
+
+# output formats and their content types, any format write_ontology supports
+FORMATS = {
+    "turtle": "text/turtle",
+    "ttl": "text/turtle",
+    "longturtle": "text/turtle",
+    "n3": "text/n3",
+    "ntriples": "application/n-triples",
+    "nt": "application/n-triples",
+    "nt11": "application/n-triples",
+    "nquads": "application/n-quads",
+    "xml": "application/rdf+xml",
+    "pretty-xml": "application/rdf+xml",
+    "json-ld": "application/ld+json",
+    "trig": "application/trig",
+    "trix": "application/trix",
+    "hext": "application/x-ndjson",
+}
+# format picked for an Accept header, the first format of each content type
+MEDIA_TYPES = {}
+for _name, _media_type in FORMATS.items():
+    MEDIA_TYPES.setdefault(_media_type, _name)
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+    411: "Length Required",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+# errors of a body that is no json, any other error of a conversion is answered with 500
+INPUT_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+
+
+def convert(body, target_format="turtle", base_url=None):
+    # runs in a worker, openBIS json bytes -> serialized rdf bytes
+    return convert_json(body, target_format=target_format, base_url=base_url)
+
+
+def negotiate(query, headers, default="turtle"):
+    # ?format= wins over the Accept header, None if nothing acceptable is supported
+    if "format" in query:
+        target_format = query["format"][-1]
+        return target_format if target_format in FORMATS else None
+    accept = headers.get("accept", "")
+    if not accept:
+        return default
+    for media_type in accept.split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type in ("*/*", "text/*", "application/*"):
+            return default
+        if media_type in MEDIA_TYPES:
+            return MEDIA_TYPES[media_type]
+    return None
+
+
+class ConversionServer:
+    # http server converting json POSTed to /convert, the conversions run in a pool of jobs worker processes
+    # that load the ontology index once, at most max_pending conversions are queued or running and further
+    # requests are turned away with 503 before their body is read. with a cache, hits are answered
+    # without going through the pool
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=8080,
+        jobs=1,
+        max_pending=None,
+        max_body=256 * 1024 * 1024,
+        base_url="https://openbis.matolab.org/",
+        executor=None,
+        cache=None,
+    ):
+        self.host = host
+        self.port = port
+        self.jobs = jobs
+        self.max_pending = max_pending or 4 * jobs
+        self.max_body = max_body
+        self.base_url = base_url
+        self.executor = executor
+        self.own_executor = executor is None
+        self.cache = cache
+        self.pending = 0
+        self.server = None
+
+    async def start(self):
+        get_index()
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.jobs, initializer=init_worker)
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        # the bound port, when started on port 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.own_executor and self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def handle(self, reader, writer):
+        try:
+            status, headers, body = await self.respond(reader)
+            await send_response(writer, status, headers, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def respond(self, reader):
+        # returns (status, headers, body) for one request
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            return error(400, "malformed request line")
+        method, target, _ = request_line
+        headers = await read_headers(reader)
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/health":
+            return json_response(200, {"pending": self.pending, "max_pending": self.max_pending})
+        if url.path != "/convert":
+            return error(404, f"no such path {url.path}")
+        if method != "POST":
+            return error(405, "POST the json to /convert")
+        target_format = negotiate(query, headers)
+        if target_format is None:
+            return error(406, f"supported formats: {', '.join(FORMATS)}")
+        if "content-length" not in headers:
+            return error(411, "content-length is required")
+        length = headers["content-length"]
+        if not (length.isascii() and length.isdigit()):
+            return error(400, f"invalid content-length {length!r}")
+        length = int(length)
+        if length > self.max_body:
+            return error(413, f"at most {self.max_body} bytes are accepted")
+        if self.pending >= self.max_pending:
+            return error(503, "too many pending conversions", {"Retry-After": "1"})
+
+        self.pending += 1
+        try:
+            body = await reader.readexactly(length)
+            base_url = query.get("base_url", [self.base_url])[-1]
+            loop = asyncio.get_running_loop()
+            output = None
+            if self.cache is not None:
+                key = self.cache.key(body, base_url, target_format)
+                output = await loop.run_in_executor(None, self.cache.get, key)
+            if output is None:
+                output = await loop.run_in_executor(self.executor, convert, body, target_format, base_url)
+                if self.cache is not None:
+                    await loop.run_in_executor(None, self.cache.put, key, output)
+        except INPUT_ERRORS as e:
+            return error(400, f"{type(e).__name__}: {e}")
+        except Exception as e:
+            return error(500, f"{type(e).__name__}: {e}")
+        finally:
+            self.pending -= 1
+        return 200, {"Content-Type": f"{FORMATS[target_format]}; charset=utf-8"}, output
+
+
+def error(status, message, headers=None):
+    status, response_headers, body = json_response(status, {"error": message})
+    response_headers.update(headers or {})
+    return status, response_headers, body
+
+
+def json_response(status, data):
+    return status, {"Content-Type": "application/json"}, json.dumps(data).encode("utf-8")
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            return headers
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def send_response(writer, status, headers, body):
+    # the conversion is serialized whole in the worker, its output is sent in one piece
+    head = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Length: {len(body)}", "Connection: close"]
+    head += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+    writer.write(body)
+    await writer.drain()
+
+
+async def request(host, port, method, path, body=b"", headers=None):
+    # minimal client for the server, returns (status, headers, body)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        head = [f"{method} {path} HTTP/1.1", f"Host: {host}:{port}", f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        response_headers = await read_headers(reader)
+        response_body = await reader.readexactly(int(response_headers["content-length"]))
+        return status, response_headers, response_body
+    finally:
+        writer.close()
+        with contextlib.suppress(ConnectionError):
+            await writer.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="OpenBIS JSON Parser Server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--max-pending", type=int, help="Conversions queued or running before 503, 4 per job by default")
+    parser.add_argument(
+        "-b",
+        "--base-url",
+        help="OpenBIS base URL, a request can override it with ?base_url=",
+        default="https://openbis.matolab.org/",
+    )
+    parser.add_argument("--cache-dir", help="Keep converted outputs in this directory and answer repeated inputs from it")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Size limit of the cache in MiB")
+    args = parser.parse_args()
+    cache = ConversionCache(args.cache_dir, args.cache_size << 20) if args.cache_dir else None
+
+    async def serve():
+        async with ConversionServer(
+            args.host, args.port, jobs=args.jobs, max_pending=args.max_pending, base_url=args.base_url, cache=cache
+        ) as server:
+            print(f"listening on http://{server.host}:{server.port}/convert")
+            await server.serve_forever()
+
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import argparse
+import json
+import random
+import sys
+
+from openbis_json_parser.main import serialize
+
+# synthetic openBIS v3 json exports of configurable size, the same arguments always give the same document.
+# entities are built as plain dicts and serialized like jackson does it: every object gets an @id on its first
+# occurrence and is written as that integer wherever it occurs again
+
+BASE_DATE = 1685542100000
+
+# sample type code -> property code -> kind of value
+SAMPLE_TYPES = {
+    "EMODUL_INGREDIENT": {
+        "$NAME": "name",
+        "EMODUL_INGREDIENT.BULKDENSITY": "float",
+        "EMODUL_INGREDIENT.ANNOTATION": "text",
+        "EMODUL_INGREDIENT.SUPPLIER": "vocabulary",
+    },
+    "EMODUL_MIX": {
+        "$NAME": "name",
+        "EMODUL_MIX.WATER_CEMENT_RATIO": "float",
+        "EMODUL_MIX.MIXING_DATE": "date",
+        "EMODUL_MIX.AIR_CONTENT": "integer",
+        "EMODUL_MIX.VALIDATED": "boolean",
+    },
+    "EMODUL_SPECIMEN": {
+        "$NAME": "name",
+        "EMODUL_SPECIMEN.DIAMETER": "float",
+        "EMODUL_SPECIMEN.LENGTH": "float",
+        "EMODUL_SPECIMEN.CASTING_DATE": "date",
+        "EMODUL_SPECIMEN.ANNOTATION": "text",
+    },
+}
+VOCABULARY = ["HOLCIM", "HEIDELBERG", "DYCKERHOFF", "SCHWENK", "CEMEX"]
+WORDS = ["cement", "water", "sand", "gravel", "admixture", "fly ash", "silica fume", "slag", "filler", "fibre"]
+DATASET_TYPES = ["EMODUL_RAW_DATA", "EMODUL_PROCESSED_DATA", "ATTACHMENT"]
+FILE_EXTENSIONS = [".csv", ".dat", ".md", ".json", ".png"]
+
+
+class _Export:
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.clock = BASE_DATE
+
+    def date(self):
+        self.clock += self.random.randint(1, 120000)
+        return self.clock
+
+    def perm_id(self):
+        return f"{20230531140000000 + self.date() % 100000000}-{self.random.randint(1, 99999)}"
+
+    def value(self, kind, i):
+        r = self.random
+        if kind == "name":
+            return f"{r.choice(WORDS)} {i}"
+        if kind == "float":
+            return f"{r.uniform(0.1, 100):.3f}"
+        if kind == "integer":
+            return str(r.randint(0, 1000))
+        if kind == "boolean":
+            return r.choice(["true", "false"])
+        if kind == "date":
+            return f"2023-{r.randint(1, 12):02d}-{r.randint(1, 28):02d} {r.randint(0, 23):02d}:{r.randint(0, 59):02d}:00 +0200"
+        if kind == "vocabulary":
+            return r.choice(VOCABULARY)
+        return " ".join(r.choice(WORDS) for _ in range(r.randint(2, 8)))
+
+
+def _entity_type(type_class, code, kind):
+    return {
+        "@type": type_class,
+        "permId": {"@type": "as.dto.entitytype.id.EntityTypePermId", "permId": code, "entityKind": kind},
+        "code": code,
+        "description": None,
+        "modificationDate": BASE_DATE,
+        "propertyAssignments": None,
+        "validationPlugin": None,
+    }
+
+
+def _sample_stub(sample):
+    # how a related sample looks when its own relations were not fetched
+    stub = {key: sample[key] for key in ("@type", "code", "frozen", "registrationDate", "modificationDate")}
+    stub["permId"] = dict(sample["permId"])
+    stub["identifier"] = dict(sample["identifier"])
+    for key in ("type", "project", "space", "experiment", "properties", "parents", "children", "dataSets"):
+        stub[key] = None
+    return stub
+
+
+def generate_export(samples=1000, experiments=None, datasets=None, files_per_dataset=20, parents=2, seed=0):
+    # one SearchResult with experiments, samples and datasets of one space and project
+    export = _Export(seed)
+    r = export.random
+    experiments = max(1, samples // 50) if experiments is None else experiments
+    datasets = samples // 10 if datasets is None else datasets
+
+    person = {
+        "@type": "as.dto.person.Person",
+        "permId": {"@type": "as.dto.person.id.PersonPermId", "permId": "admin"},
+        "userId": "admin",
+        "firstName": "",
+        "lastName": "",
+        "email": "",
+        "registrationDate": BASE_DATE,
+        "active": True,
+    }
+    space = {
+        "@type": "as.dto.space.Space",
+        "permId": {"@type": "as.dto.space.id.SpacePermId", "permId": "EMODUL"},
+        "code": "EMODUL",
+        "description": "Space for Emodul samples",
+        "frozen": False,
+        "registrationDate": export.date(),
+        "modificationDate": export.date(),
+        "registrator": person,
+    }
+    project = {
+        "@type": "as.dto.project.Project",
+        "permId": {"@type": "as.dto.project.id.ProjectPermId", "permId": export.perm_id()},
+        "identifier": {"@type": "as.dto.project.id.ProjectIdentifier", "identifier": "/EMODUL/LEBEDIGITAL"},
+        "code": "LEBEDIGITAL",
+        "description": "Project for Emodul samples",
+        "frozen": False,
+        "registrationDate": export.date(),
+        "modificationDate": export.date(),
+        "space": space,
+        "registrator": person,
+    }
+    data_store = {
+        "@type": "as.dto.datastore.DataStore",
+        "code": "DSS1",
+        "downloadUrl": "https://xeo54:8128",
+        "remoteUrl": "http://127.0.0.1:8081",
+        "registrationDate": BASE_DATE,
+        "modificationDate": BASE_DATE,
+    }
+    experiment_type = _entity_type("as.dto.experiment.ExperimentType", "COLLECTION", "EXPERIMENT")
+    sample_types = {code: _entity_type("as.dto.sample.SampleType", code, "SAMPLE") for code in SAMPLE_TYPES}
+    dataset_types = {code: _entity_type("as.dto.dataset.DataSetType", code, "DATA_SET") for code in DATASET_TYPES}
+
+    collections = []
+    for i in range(experiments):
+        code = f"LEBEDIGITAL_COLLECTION_{i}"
+        collections.append(
+            {
+                "@type": "as.dto.experiment.Experiment",
+                "permId": {"@type": "as.dto.experiment.id.ExperimentPermId", "permId": export.perm_id()},
+                "identifier": {
+                    "@type": "as.dto.experiment.id.ExperimentIdentifier",
+                    "identifier": f"/EMODUL/LEBEDIGITAL/{code}",
+                },
+                "code": code,
+                "frozen": False,
+                "registrationDate": export.date(),
+                "modificationDate": export.date(),
+                "type": experiment_type,
+                "project": project,
+                "properties": {"$NAME": export.value("name", i)},
+                "tags": [],
+                "registrator": person,
+                "modifier": person,
+            }
+        )
+
+    objects = []
+    for i in range(samples):
+        type_code = list(SAMPLE_TYPES)[i % len(SAMPLE_TYPES)]
+        code = f"{type_code}{i}"
+        sample = {
+            "@type": "as.dto.sample.Sample",
+            "permId": {"@type": "as.dto.sample.id.SamplePermId", "permId": export.perm_id()},
+            "identifier": {"@type": "as.dto.sample.id.SampleIdentifier", "identifier": f"/EMODUL/LEBEDIGITAL/{code}"},
+            "code": code,
+            "frozen": False,
+            "registrationDate": export.date(),
+            "modificationDate": export.date(),
+            "type": sample_types[type_code],
+            "project": project,
+            "space": space,
+            "experiment": collections[i % len(collections)],
+            "properties": {
+                key: export.value(kind, i) for key, kind in SAMPLE_TYPES[type_code].items() if r.random() < 0.9 or key == "$NAME"
+            },
+            # parents are earlier samples, written as @id back references
+            "parents": r.sample(objects[-50:], min(parents, len(objects[-50:]))) if objects else [],
+            "children": [],
+            "dataSets": [],
+            "tags": [],
+            "registrator": person,
+            "modifier": person,
+        }
+        for parent in sample["parents"]:
+            # children are listed without their own relations, like openBIS fetches them
+            parent["children"].append(_sample_stub(sample))
+        objects.append(sample)
+
+    all_datasets = []
+    for i in range(datasets):
+        sample = objects[r.randrange(len(objects))] if objects else None
+        perm_id = export.perm_id()
+        dataset_id = {"@type": "as.dto.dataset.id.DataSetPermId", "permId": perm_id}
+        files = []
+        paths = ["original"] + [f"original/measurement_{i}_{j}{r.choice(FILE_EXTENSIONS)}" for j in range(files_per_dataset)]
+        for path in paths:
+            # every file permId holds its own copy of the dataset permId, dataSetPermId refers back to it
+            file_dataset_id = dict(dataset_id)
+            directory = path == "original"
+            files.append(
+                {
+                    "@type": "dss.dto.datasetfile.DataSetFile",
+                    "permId": {
+                        "@type": "dss.dto.datasetfile.id.DataSetFilePermId",
+                        "dataSetId": file_dataset_id,
+                        "filePath": path,
+                    },
+                    "dataSetPermId": file_dataset_id,
+                    "dataStore": data_store,
+                    "path": path,
+                    "directory": directory,
+                    "fileLength": 0 if directory else r.randint(100, 10000000),
+                    "checksumCRC32": 0 if directory else r.randint(0, 2**32 - 1),
+                }
+            )
+        dataset = {
+            "@type": "as.dto.dataset.DataSet",
+            "permId": dataset_id,
+            "code": perm_id,
+            "frozen": False,
+            "type": dataset_types[DATASET_TYPES[i % len(DATASET_TYPES)]],
+            "kind": "PHYSICAL",
+            "dataStore": data_store,
+            "measured": True,
+            "experiment": sample["experiment"] if sample else collections[0],
+            "sample": sample,
+            "properties": {"$NAME": export.value("name", i)},
+            "registrationDate": export.date(),
+            "modificationDate": export.date(),
+            "registrator": person,
+            "modifier": person,
+            "files": {"@type": "as.dto.common.search.SearchResult", "objects": files, "totalCount": len(files)},
+        }
+        if sample is not None:
+            sample["dataSets"].append({"@type": dataset["@type"], "permId": dict(dataset_id), "code": perm_id})
+        all_datasets.append(dataset)
+
+    result = {
+        "@type": "as.dto.common.search.SearchResult",
+        "objects": collections + objects + all_datasets,
+        "totalCount": len(collections) + len(objects) + len(all_datasets),
+    }
+    return serialize(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic openBIS export to stdout")
+    parser.add_argument("samples", type=int, nargs="?", default=1000)
+    parser.add_argument("--experiments", type=int)
+    parser.add_argument("--datasets", type=int)
+    parser.add_argument("--files-per-dataset", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    export = generate_export(
+        args.samples,
+        experiments=args.experiments,
+        datasets=args.datasets,
+        files_per_dataset=args.files_per_dataset,
+        seed=args.seed,
+    )
+    json.dump(export, sys.stdout)
@@ -1,8 +1,48 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import copy
+import gzip
+import io
 import json
 import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
-from main import parse_dict, write_ontology
+from rdflib import RDF, ConjunctiveGraph, Graph, Literal, URIRef
+from rdflib.compare import isomorphic
+
+from openbis_json_parser import fetch, main, server, synthetic
+from openbis_json_parser.main import (
+    OBIS,
+    ONTOLOGY_FILE,
+    PropertyRegistry,
+    ConversionCache,
+    ConversionStats,
+    TripleBuffer,
+    TripleStore,
+    convert_json,
+    delta_json,
+    get_obis_entity,
+    load_index,
+    obis,
+    obis_index,
+    iter_json_objects,
+    loads_json,
+    parse_dict,
+    parse_json,
+    stream_dict,
+    stream_json,
+    value_literal,
+    value_literals,
+    write_ontology,
+)
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -57,5 +97,1149 @@ class TestMain(unittest.TestCase):
         write_ontology(onto, output_file, target_format="turtle")
         self.assertTrue(os.path.exists(output_file))
 
+
+class TestOntologyIndex(unittest.TestCase):
+    def test_index_matches_graph_lookup(self):
+        for key in set(obis.objects(None, OBIS.openbis_json_key)):
+            hits = list(obis[: OBIS.openbis_json_key : Literal(str(key))])
+            self.assertEqual(get_obis_entity(str(key)), hits[0])
+        self.assertIsNone(get_obis_entity("fetchOptions"))
+
+    def test_index_is_immutable(self):
+        with self.assertRaises(TypeError):
+            obis_index.json_keys["code"] = OBIS.code
+
+
+class TestSinglePass(unittest.TestCase):
+    def assert_same_as_fix_iris(self, data):
+        legacy = parse_dict(json.loads(json.dumps(data)), single_pass=False)
+        single_pass = parse_dict(json.loads(json.dumps(data)), single_pass=True)
+        self.assertTrue(isomorphic(legacy, single_pass))
+        self.assertEqual(dict(legacy.namespaces()), dict(single_pass.namespaces()))
+
+    def test_fixtures(self):
+        for name in ["user", "collection", "object", "project", "space", "dataset"]:
+            with open(os.path.join(__location__, "tests", f"{name}.json")) as f:
+                data = json.load(f)
+            with self.subTest(name):
+                self.assert_same_as_fix_iris(data)
+
+    def test_custom_properties(self):
+        with open(os.path.join(__location__, "tests", "object.json")) as f:
+            data = json.load(f)
+        data["properties"] = {"NAME": "x", "$WEIRD:KEY": "1,5", "EXP8": "a", "$": "2"}
+        self.assert_same_as_fix_iris(data)
+
+    def test_no_temporary_iris(self):
+        # the files SearchResult of a dataset is no entity, the relation to its @id is dropped
+        with open(os.path.join(__location__, "tests", "dataset.json")) as f:
+            data = json.load(f)
+        data["files"]["@id"] = 99999
+        for name, document in [("dataset", data), ("synthetic", synthetic.generate_export(15))]:
+            with self.subTest(name):
+                outputs = {
+                    "single pass": parse_dict(copy.deepcopy(document)).serialize(format="nt"),
+                    "fix_iris": parse_dict(copy.deepcopy(document), single_pass=False).serialize(format="nt"),
+                }
+                out = io.BytesIO()
+                stream_dict(copy.deepcopy(document), out)
+                outputs["stream"] = out.getvalue().decode("utf-8")
+                with tempfile.TemporaryDirectory() as tmp:
+                    out = io.BytesIO()
+                    delta_json(io.BytesIO(json.dumps(document).encode("utf-8")), os.path.join(tmp, "state.json"), out)
+                    outputs["delta"] = out.getvalue().decode("utf-8")
+                for output_name, output in outputs.items():
+                    self.assertNotIn(str(main.TEMP), output, output_name)
+
+
+class TestStreaming(unittest.TestCase):
+    def test_ntriples_match_graph(self):
+        for name in ["user", "collection", "object", "project", "space", "dataset"]:
+            with open(os.path.join(__location__, "tests", f"{name}.json")) as f:
+                data = json.load(f)
+            out = io.BytesIO()
+            count = stream_dict(json.loads(json.dumps(data)), out, target_format="ntriples")
+            streamed = Graph().parse(data=out.getvalue().decode("utf-8"), format="ntriples")
+            with self.subTest(name):
+                self.assertEqual(count, len(out.getvalue().splitlines()))
+                self.assertTrue(isomorphic(streamed, parse_dict(data)))
+
+    def test_nquads_graph_name(self):
+        with open(os.path.join(__location__, "tests", "dataset.json")) as f:
+            data = json.load(f)
+        out = io.BytesIO()
+        graph_name = URIRef("https://example.com/graph/dataset")
+        stream_dict(data, out, target_format="nquads", graph_name=graph_name)
+        streamed = ConjunctiveGraph()
+        streamed.parse(data=out.getvalue().decode("utf-8"), format="nquads")
+        self.assertTrue(isomorphic(streamed.get_context(graph_name), parse_dict(data)))
+
+    def test_incremental_input(self):
+        # the file listing refers back to the data store of its first object
+        with open(os.path.join(__location__, "tests", "dataset.json")) as f:
+            files = json.load(f)["files"]
+        source = json.dumps(files, indent=2).encode("utf-8")
+        out = io.BytesIO()
+        stream_json(io.BytesIO(source), out)
+        streamed = Graph().parse(data=out.getvalue().decode("utf-8"), format="ntriples")
+        self.assertTrue(isomorphic(streamed, parse_dict(json.loads(source))))
+
+    def test_iter_json_objects(self):
+        objects = [{"@id": 1, "code": "A é"}, 2.5, None, [True]]
+        result = {"@type": "as.dto.common.search.SearchResult", "@id": 0, "objects": objects, "totalCount": 4}
+        for chunk_size in (1, 3, 1 << 20):
+            with self.subTest(chunk_size=chunk_size):
+                source = json.dumps(result).encode("utf-8")
+                self.assertEqual(list(iter_json_objects(io.BytesIO(source), chunk_size)), objects)
+                self.assertEqual(list(iter_json_objects(io.StringIO(json.dumps(objects)), chunk_size)), objects)
+                self.assertEqual(list(iter_json_objects(io.StringIO(json.dumps(objects[0])), chunk_size)), [objects[0]])
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_objects(io.StringIO('{"objects": [1, 2'), 4))
+
+    def test_other_formats_are_rejected(self):
+        with self.assertRaises(ValueError):
+            stream_dict({}, io.BytesIO(), target_format="turtle")
+
+
+class TestReferences(unittest.TestCase):
+    def parse(self, data):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return [parse_dict(data, single_pass=single_pass) for single_pass in (True, False)]
+
+    def test_numeric_permid_is_kept(self):
+        with open(os.path.join(__location__, "tests", "user.json")) as f:
+            data = json.load(f)
+        data["permId"]["permId"] = "42"
+        user = URIRef("https://openbismantic.matolab.org/openbismantic/user/42")
+        for graph in self.parse(data):
+            self.assertIn((user, main.RDF.type, OBIS.User), graph)
+
+    def test_unresolved_reference_is_dropped(self):
+        with open(os.path.join(__location__, "tests", "dataset.json")) as f:
+            files = json.load(f)["files"]
+        # the data store is defined in the first file and referred to by its @id in the others
+        for hit in files["objects"]:
+            hit["directory"] = False
+        files["objects"][1]["dataStore"] = 999
+        for graph in self.parse(files):
+            stores = set(graph.objects(None, OBIS.relates_to))
+            self.assertEqual(len(stores), 1)
+            self.assertFalse(any(str(store).endswith("/999") for store in stores))
+
+
+class TestDistributions(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(__location__, "tests", "dataset.json")) as f:
+            self.data = json.load(f)
+
+    def parse(self):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return parse_dict(self.data)
+
+    def test_streaming_keeps_little(self):
+        # besides the distributions, the writer keeps a few triples per dataset and data store until it is closed
+        data = synthetic.generate_export(200, experiments=2, datasets=20, files_per_dataset=3)
+        kept = {}
+        close = main.NTriplesWriter.close
+
+        def closing(writer):
+            kept["triples"] = list(writer.distributions)
+            kept["datasets"] = len(writer.datasets)
+            return close(writer)
+
+        out = io.BytesIO()
+        with mock.patch.object(main.NTriplesWriter, "close", closing):
+            stream_dict(copy.deepcopy(data), out)
+
+        def lines(text):
+            return sorted(re.sub(r"_:\w+", "_:b", line) for line in text.splitlines())
+
+        self.assertEqual(lines(out.getvalue().decode("utf-8")), lines(parse_dict(data).serialize(format="nt")))
+        streamed = Graph().parse(data=out.getvalue().decode("utf-8"), format="ntriples")
+        distributions = set(streamed.subjects(RDF.type, main.DCAT.Distribution))
+        self.assertEqual(len(distributions), 60)
+        self.assertEqual(kept["datasets"], 20)
+        others = [triple for triple in kept["triples"] if triple[0] not in distributions]
+        # identifier, its value and data store per dataset, type and endpoint of the data store
+        self.assertLessEqual(len(others), 3 * kept["datasets"] + 2)
+
+    def test_every_file_is_attached(self):
+        files = [hit for hit in self.data["files"]["objects"] if hit["path"]]
+        for hit in files:
+            hit["directory"] = False
+        graph = self.parse()
+        dataset = URIRef("https://openbismantic.matolab.org/openbismantic/dataset/20240904142300681-40")
+        distributions = set(graph.objects(dataset, main.DCAT.distribution))
+        self.assertEqual(len(distributions), len(files))
+        urls = {str(graph.value(distribution, main.DCAT.downloadURL)) for distribution in distributions}
+        self.assertIn("https://xeo54:8128/datastore_server/20240904142300681-40/original/markdown_demo.md", urls)
+
+    def test_dataset_without_data_store(self):
+        # the distribution is still attached, only the download url is missing
+        del self.data["dataStore"]
+        graph = self.parse()
+        self.assertEqual(len(set(graph.objects(None, main.DCAT.distribution))), 1)
+        self.assertEqual(len(set(graph.objects(None, main.DCAT.downloadURL))), 0)
+
+    def test_file_listing(self):
+        # the columnar listing path gives the same triples as converting the files one by one
+        export = synthetic.generate_export(20, datasets=4, files_per_dataset=5)
+        files = export["objects"][-1]["files"]["objects"]
+        files[1]["permId"]["filePath"] = "original/../$odd:name"
+        # entries the columnar path does not take are left to iterate_json
+        files[2]["checksum"] = {"@type": "unknown", "@id": 10**6}
+        with mock.patch.dict(main.LIST_HANDLERS, clear=True):
+            graph, stats = parse_dict(copy.deepcopy(export), stats=True)
+        columnar, columnar_stats = parse_dict(copy.deepcopy(export), stats=True)
+
+        # the blank nodes differ
+        def lines(data):
+            return sorted(re.sub(rb"_:\w+", b"_:b", line) for line in data.splitlines())
+
+        self.assertEqual(
+            lines(graph.serialize(format="nt", encoding="utf-8")), lines(columnar.serialize(format="nt", encoding="utf-8"))
+        )
+        self.assertEqual(list(graph.namespaces()), list(columnar.namespaces()))
+        self.assertEqual(stats.entities, columnar_stats.entities)
+        self.assertEqual(stats.unhandled_keys, columnar_stats.unhandled_keys)
+        self.assertEqual(columnar_stats.skipped_directories, 4)
+        self.assertEqual(len(set(columnar.objects(None, main.DCAT.downloadURL))), 4 * 5)
+        with mock.patch.dict(main.LIST_HANDLERS, clear=True):
+            expected = io.BytesIO()
+            stream_dict(copy.deepcopy(export), expected)
+        streamed = io.BytesIO()
+        stream_dict(copy.deepcopy(export), streamed)
+        self.assertEqual(lines(expected.getvalue()), lines(streamed.getvalue()))
+
+
+def sample_chain(depth):
+    # samples that are each others parent, nested as deep as in the json export
+    chain = None
+    for i in range(depth, 0, -1):
+        chain = {
+            "@type": "as.dto.sample.Sample",
+            "@id": i,
+            "code": f"S{i}",
+            "parents": [chain] if chain else [],
+        }
+    return chain
+
+
+class TestTraversal(unittest.TestCase):
+    def test_deep_chain(self):
+        depth = sys.getrecursionlimit() * 2
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            graph = parse_dict(sample_chain(depth))
+        self.assertEqual(len(list(graph.subjects(main.RDF.type, OBIS.Object))), depth)
+        self.assertEqual(len(list(graph.triples((None, OBIS.has_parent, None)))), depth - 1)
+
+
+class TestJsonInput(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(__location__, "tests", "dataset.json")) as f:
+            self.text = f.read()
+        self.expected = json.loads(self.text)
+
+    def test_decoder_backends(self):
+        orjson = main.orjson
+        try:
+            for backend in {orjson, None}:
+                main.orjson = backend
+                with self.subTest(backend=backend):
+                    self.assertEqual(loads_json(self.text.encode("utf-8")), self.expected)
+        finally:
+            main.orjson = orjson
+
+    def test_parse_json(self):
+        for name in ["object", "dataset"]:
+            path = os.path.join(__location__, "tests", f"{name}.json")
+            with open(path) as f:
+                data = json.load(f)
+            with self.subTest(name):
+                self.assertTrue(isomorphic(parse_json(path), parse_dict(data)))
+
+
+class TestValueTypes(unittest.TestCase):
+    values = ["12", "1,5", "True", "2024-09-04", "4,9,2024", "abc", " ", 7, 2.5, "12", "abc", 7]
+
+    def setUp(self):
+        main._value_cache.clear()
+
+    def test_literals(self):
+        self.assertEqual(value_literal("12")[1], Literal(12))
+        self.assertEqual(value_literal("1,5")[1], Literal(1.5))
+        self.assertEqual(value_literal(" abc ")[1], Literal("abc", datatype=main.XSD.string))
+        self.assertEqual(value_literal("4,9,2024")[0][0], "DATE")
+        self.assertEqual(value_literal(7), value_literal("7"))
+        with self.assertRaises(AttributeError):
+            value_literal(["a"])
+
+    def test_cache(self):
+        with mock.patch.object(main, "_infer_value", wraps=main._infer_value) as infer:
+            first = [value_literal(value) for value in self.values]
+            second = [value_literal(value) for value in self.values]
+        self.assertEqual(first, second)
+        self.assertEqual(infer.call_count, len({(type(value), value) for value in self.values}))
+        with mock.patch.object(main, "VALUE_CACHE_SIZE", 3):
+            for value in range(10):
+                value_literal(value)
+        self.assertEqual(len(main._value_cache), 3)
+
+    def test_threads(self):
+        # another thread evicting the entry that was just looked up, before it is marked as used
+        threads = []
+
+        def evict():
+            for value in ("b", "c"):
+                value_literal(value)
+
+        class Cache(main.OrderedDict):
+            def get(self, key, default=None):
+                found = super().get(key, default)
+                if found is not None and not threads:
+                    threads.append(threading.Thread(target=evict))
+                    threads[0].start()
+                    threads[0].join(0.2)
+                return found
+
+        with mock.patch.object(main, "VALUE_CACHE_SIZE", 2), mock.patch.object(main, "_value_cache", Cache()):
+            value_literal("a")
+            self.assertEqual(value_literal("a"), main._value_literal("a"))
+            threads[0].join()
+            self.assertEqual(list(main._value_cache), [(str, "b"), (str, "c")])
+
+    def test_batch(self):
+        expected = [value_literal(value) for value in self.values]
+        main._value_cache.clear()
+        with mock.patch.object(main, "VALUE_CACHE_SIZE", 1), mock.patch.object(
+            main, "_infer_value", wraps=main._infer_value
+        ) as infer:
+            self.assertEqual(value_literals(self.values), expected)
+        # distinct values are inferred once, even if the cache can not hold them
+        self.assertEqual(infer.call_count, len({(type(value), value) for value in self.values}))
+
+    def test_number_fast_path(self):
+        # the same types as literal_eval gives them, floats equal to 0 or 1 included
+        values = ["00", "-0", "+5", "01", "1_000", "1.e5", ".5", "-.5", "1e999", "01e5", "0,0", "1.", "-1,0", "1,5,3"]
+        values += ["0x1F", "12 ", " -3,25", "7E-900", "١٢"]
+        fast = [main._infer_value(value)[0] for value in values]
+        never = re.compile("(?!)")
+        with mock.patch.object(main, "_INT_VALUE", never), mock.patch.object(main, "_FLOAT_VALUE", never):
+            self.assertEqual(fast, [main._infer_value(value)[0] for value in values])
+
+    def test_timestamps(self):
+        milliseconds = [1685542100000, 1725452483997, 1685542100000]
+        literals = value_literals(milliseconds, literal=main.timestamp_literal)
+        # local time, like datetime.fromtimestamp
+        local = main.datetime.fromtimestamp(1725452483.997).isoformat()
+        self.assertEqual(literals[1], Literal(local, datatype=main.XSD.dateTimeStamp))
+        self.assertTrue(local.endswith(".997000"))
+        self.assertEqual(literals, [main.timestamp_literal(value) for value in milliseconds])
+        self.assertIs(literals[0], literals[2])
+        # property values and timestamps share the memo of a conversion without mixing up the same number
+        seen = {}
+        self.assertEqual(value_literals([1685542100000], seen), [value_literal(1685542100000)])
+        self.assertEqual(value_literals([1685542100000], seen, main.timestamp_literal), literals[:1])
+
+    def test_deferred_literals(self):
+        # converting in batches of any size gives the same triples as converting every value where it is met
+        data = synthetic.generate_export(30, experiments=2, datasets=3, files_per_dataset=2)
+
+        def lines(graph):
+            return sorted(re.sub(r"_:\w+", "_:b", line) for line in graph.serialize(format="nt").splitlines())
+
+        with mock.patch.object(main, "LITERAL_BATCH_SIZE", 0):
+            expected = lines(parse_dict(copy.deepcopy(data)))
+        for size in (1, 7, main.LITERAL_BATCH_SIZE):
+            with self.subTest(size=size), mock.patch.object(main, "LITERAL_BATCH_SIZE", size):
+                self.assertEqual(lines(parse_dict(copy.deepcopy(data))), expected)
+        with mock.patch.object(main, "LITERAL_BATCH_SIZE", 7), mock.patch.object(main, "LITERAL_MEMO_SIZE", 3):
+            self.assertEqual(lines(parse_dict(copy.deepcopy(data))), expected)
+        # a full memo keeps the values met first
+        batch = main._LiteralBatch(Graph(), size=2)
+        with mock.patch.object(main, "LITERAL_MEMO_SIZE", 2):
+            for value in ("a", "b", "c", "a", "d"):
+                batch.add_value(URIRef("https://example.com/1"), OBIS.code, value)
+            batch.flush()
+        self.assertEqual([key[2] for key in batch.seen], ["a", "b"])
+        # describe_value outside of a conversion adds the triples at once
+        graph = Graph()
+        main.describe_value(graph, URIRef("https://example.com/1"), OBIS.code, "1,5")
+        self.assertIn(Literal(1.5), set(graph.objects()))
+
+
+class TestBatch(unittest.TestCase):
+    def test_merged_nquads(self):
+        names = ["user", "object", "dataset"]
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in names:
+                with open(os.path.join(__location__, "tests", f"{name}.json")) as f:
+                    data = f.read()
+                with open(os.path.join(tmp, f"{name}.json"), "w") as f:
+                    f.write(data)
+            output_file = os.path.join(tmp, "merged.nq")
+            run = subprocess.run(
+                [sys.executable, "-m", "openbis_json_parser.cli", tmp, "-j", "2", "-o", output_file],
+                cwd=os.path.dirname(__location__),
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(run.returncode, 0, run.stderr)
+            self.assertIn("converted 3 files (0 failed)", run.stderr)
+            merged = ConjunctiveGraph()
+            merged.parse(output_file, format="nquads")
+            for name in names:
+                path = os.path.join(tmp, f"{name}.json")
+                graph_name = URIRef(pathlib.Path(path).resolve().as_uri())
+                with self.subTest(name):
+                    self.assertTrue(isomorphic(merged.get_context(graph_name), parse_json(path, base_url="https://openbis.matolab.org/")))
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        names = ["user", "object", "project", "space"]
+        objects = []
+        for i, name in enumerate(names):
+            with open(os.path.join(__location__, "tests", f"{name}.json")) as f:
+                objects.append(json.loads(f.read().replace('"@id": ', f'"@id": {i + 1}00')))
+        self.data = {"@type": "as.dto.common.search.SearchResult", "@id": 0, "objects": objects}
+
+    def delta(self, state="state.json", **kwargs):
+        additions, removals = io.BytesIO(), io.BytesIO()
+        counts = delta_json(
+            io.BytesIO(json.dumps(self.data).encode("utf-8")),
+            os.path.join(self.tmp.name, state),
+            additions,
+            removals_file=removals,
+            **kwargs,
+        )
+        rows = [set(stream.getvalue().decode("utf-8").splitlines()) for stream in (additions, removals)]
+        self.assertEqual(counts, tuple(len(row) for row in rows))
+        return rows
+
+    def test_only_changes_are_emitted(self):
+        first, removed = self.delta()
+        self.assertFalse(removed)
+        self.assertEqual(self.delta(), [set(), set()])
+
+        sample = self.data["objects"][1]
+        sample["modificationDate"] += 1
+        sample["properties"]["EMODUL_INGREDIENT.BULKDENSITY"] = "1.15"
+        with mock.patch.object(main, "iterate_json", wraps=main.iterate_json) as iterate:
+            added, removed = self.delta()
+        # the pre-scan of resolve_iris walks every element, only the changed one and the user, which has
+        # no modificationDate, are converted
+        converted = [call.args[0]["@type"] for call in iterate.call_args_list if not isinstance(call.args[1], main._IriRecorder)]
+        self.assertEqual(converted, ["as.dto.person.Person", "as.dto.sample.Sample"])
+        self.assertTrue(added and removed)
+        self.assertTrue(all("1.15" in row or "1.14" not in row for row in added))
+        self.assertTrue(any("1.14" in row for row in removed))
+        # the last output with the delta applied is what a fresh run gives
+        fresh, _ = self.delta("fresh.json")
+        self.assertEqual((first - removed) | added, fresh)
+
+    def test_missing_entities_are_removed(self):
+        first, _ = self.delta()
+        del self.data["objects"][0]
+        added, removed = self.delta(prune=False)
+        self.assertEqual((added, removed), (set(), set()))
+        added, removed = self.delta()
+        self.assertFalse(added)
+        self.assertTrue(any("/user/admin>" in row for row in removed))
+        self.assertEqual(first - removed, self.delta("fresh.json")[0])
+
+    def test_cli_no_prune(self):
+        # a partial export with --no-prune changes nothing, without it the missing entities are removed
+        state = os.path.join(self.tmp.name, "state.json")
+        command = [sys.executable, "-m", "openbis_json_parser.cli", "-", "--state", state]
+
+        def patch(data, *options):
+            run = subprocess.run(
+                command + list(options),
+                input=json.dumps(data).encode("utf-8"),
+                cwd=os.path.dirname(__location__),
+                capture_output=True,
+                check=True,
+            )
+            return run.stdout.decode("utf-8").splitlines()
+
+        self.assertTrue(all(row.startswith("A ") for row in patch(self.data)))
+        partial = dict(self.data, objects=self.data["objects"][1:])
+        self.assertEqual(patch(partial, "--no-prune"), [])
+        removed = patch(partial)
+        self.assertTrue(removed and all(row.startswith("D ") for row in removed))
+        self.assertTrue(any("/user/admin>" in row for row in removed))
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_generate_export(self):
+        export = synthetic.generate_export(60, datasets=5, files_per_dataset=4)
+        self.assertEqual(json.dumps(export), json.dumps(synthetic.generate_export(60, datasets=5, files_per_dataset=4)))
+        self.assertNotEqual(json.dumps(export), json.dumps(synthetic.generate_export(60, datasets=5, files_per_dataset=4, seed=1)))
+        # every integer under parents refers back to a sample serialized before
+        ids = set()
+        for hit in export["objects"]:
+            for parent in hit.get("parents", []):
+                self.assertIn(parent, ids)
+            ids.add(hit["@id"])
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            graph = parse_dict(export)
+        self.assertEqual(len(set(graph.subjects(main.RDF.type, OBIS.Object))), 60)
+        self.assertEqual(len(set(graph.objects(None, main.DCAT.downloadURL))), 5 * 4)
+
+    def test_unserialize(self):
+        export = synthetic.generate_export(30)
+        data = main.unserialize(export)
+        self.assertEqual(main.serialize(data), export)
+        # back references are the objects they refer to
+        sample = data["objects"][-1]["sample"]
+        self.assertIs(sample["project"], data["objects"][0]["project"])
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.json_file = os.path.join(__location__, "tests", "dataset.json")
+
+    def test_parse_json_stats(self):
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            graph, stats = parse_json(self.json_file, stats=True)
+        # nothing is printed while converting
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertTrue(isomorphic(graph, parse_json(self.json_file)))
+        self.assertEqual(
+            list(stats.phases), ["decode", "resolve_iris", "iterate_json", "drop_iris", "attach_distributions"]
+        )
+        self.assertEqual(stats.triples, len(graph))
+        # the iri pre-scan is not counted
+        self.assertEqual(stats.entities[str(main.DCAT.Distribution)], 1)
+        self.assertEqual(stats.skipped_directories, 2)
+        self.assertEqual(stats.download_urls, 1)
+        self.assertIn("remoteUrl", stats.unhandled_keys)
+
+    def test_merge_and_report(self):
+        with open(self.json_file) as f:
+            data = json.load(f)
+        _, stats = parse_dict(data, stats=True)
+        with ConversionStats().collect() as streamed:
+            stream_json(self.json_file, io.BytesIO())
+        merged = ConversionStats.from_dict(stats.as_dict()).merge(streamed)
+        self.assertEqual(merged.triples, stats.triples + streamed.triples)
+        self.assertEqual(merged.entities["http://www.w3.org/ns/dcat#Distribution"], 2)
+        self.assertIn("Distribution", merged.report())
+
+    def test_debug_log(self):
+        with self.assertNoLogs("openbis_json_parser", level="DEBUG"):
+            parse_json(self.json_file)
+        main.set_debug()
+        try:
+            with self.assertLogs("openbis_json_parser", level="DEBUG") as logs:
+                parse_json(self.json_file)
+        finally:
+            main.set_debug(False)
+        self.assertTrue(any(line.startswith("DEBUG:openbis_json_parser:adding tripple") for line in logs.output))
+
+
+class TestTripleBuffer(unittest.TestCase):
+    def test_fixtures(self):
+        for name in ["user", "collection", "object", "project", "space", "dataset"]:
+            with open(os.path.join(__location__, "tests", f"{name}.json")) as f:
+                data = json.load(f)
+            graph = parse_dict(json.loads(json.dumps(data)))
+            buffer = parse_dict(data, compact=True)
+            with self.subTest(name):
+                self.assertIsInstance(buffer, TripleBuffer)
+                self.assertEqual(len(buffer), len(graph))
+                self.assertTrue(isomorphic(buffer.to_graph(), graph))
+                self.assertEqual(dict(buffer.to_graph().namespaces()), dict(graph.namespaces()))
+                self.assertTrue(isomorphic(Graph().parse(data=buffer.serialize("ntriples"), format="nt"), graph))
+
+    def test_duplicates_and_removals(self):
+        a, b, c = URIRef("http://example.org/a"), URIRef("http://example.org/b"), URIRef("http://example.org/c")
+        buffer = TripleBuffer()
+        for triple in [(a, OBIS.code, Literal("A")), (a, b, c), (a, b, c), (b, b, c), (c, b, a), (c, OBIS.code, Literal("C"))]:
+            buffer.add(triple)
+        self.assertEqual(list(buffer.subjects(OBIS.code, Literal("C"))), [c])
+        self.assertEqual(len(buffer), 5)
+        buffer.remove((None, b, c))
+        buffer.remove((c, None, None))
+        self.assertEqual(list(buffer), [(a, OBIS.code, Literal("A"))])
+        self.assertEqual(buffer.value(a, OBIS.code), Literal("A"))
+        self.assertIsNone(buffer.value(b, OBIS.code))
+
+    def test_add_after_remove(self):
+        # like a Graph, a removal does not drop the triples added after it
+        a, b, c = URIRef("http://example.org/a"), URIRef("http://example.org/b"), URIRef("http://example.org/c")
+        buffer, graph = TripleBuffer(), Graph()
+        for target in (buffer, graph):
+            target.add((a, b, c))
+            target.add((a, OBIS.code, Literal("A")))
+            target.remove((a, None, None))
+            target.add((a, b, c))
+            target.add((c, b, a))
+            target.remove((None, b, a))
+            target.add((c, b, a))
+            target.remove((a, OBIS.code, Literal("A")))
+            target.add((b, b, c))
+        self.assertEqual(sorted(buffer), sorted(graph))
+        self.assertEqual(len(buffer), 3)
+
+    def test_needs_single_pass(self):
+        with self.assertRaises(ValueError):
+            parse_dict({}, single_pass=False, compact=True)
+
+
+class TestTripleStore(unittest.TestCase):
+    names = ["user", "collection", "object", "project", "space", "dataset"]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "store.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_single_file(self):
+        json_file = os.path.join(__location__, "tests", "object.json")
+        with TripleStore(self.path) as store:
+            added = store.add_json(json_file)
+            graph = parse_json(json_file)
+            self.assertEqual(added, len(graph))
+            self.assertTrue(isomorphic(store.to_graph(), graph))
+            self.assertEqual(dict(store.to_graph().namespaces())["obis"], URIRef(str(OBIS)))
+
+    def test_merge(self):
+        union = Graph()
+        with TripleStore(self.path) as store:
+            for name in self.names:
+                json_file = os.path.join(__location__, "tests", f"{name}.json")
+                store.add_json(json_file)
+                union += parse_json(json_file)
+        # the store is kept on disk, adding a file again changes nothing
+        with TripleStore(self.path) as store:
+            self.assertEqual(store.add_json(os.path.join(__location__, "tests", "object.json")), 0)
+            output = io.BytesIO()
+            count = store.export(output)
+        self.assertEqual(count, len(output.getvalue().splitlines()))
+        merged = Graph().parse(data=output.getvalue(), format="nt")
+
+        def without_bnodes(graph):
+            return {t for t in graph if not any(isinstance(term, main.BNode) for term in t)}
+
+        self.assertEqual(without_bnodes(merged), without_bnodes(union))
+        # the value nodes of entities in several files are merged as well
+        self.assertLess(len(merged), len(union))
+
+    def test_cli(self):
+        files = [os.path.join(__location__, "tests", f"{name}.json") for name in ["object", "collection"]]
+        command = [sys.executable, "-m", "openbis_json_parser.cli", "--store", self.path]
+        run = subprocess.run(command + files, cwd=os.path.dirname(__location__), capture_output=True, text=True)
+        self.assertEqual(run.returncode, 0, run.stderr)
+        self.assertIn("stored 2 files (0 failed)", run.stderr)
+        run = subprocess.run(command, cwd=os.path.dirname(__location__), capture_output=True)
+        with TripleStore(self.path) as store:
+            self.assertEqual(len(run.stdout.splitlines()), len(store))
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.export = synthetic.generate_export(60, experiments=3, datasets=6, files_per_dataset=3)
+        self.graph = parse_dict(copy.deepcopy(self.export))
+
+    def test_partition(self):
+        for level in main.SHARD_LEVELS:
+            with self.subTest(level):
+                shards = main.shard_graph(self.graph, level)
+                self.assertEqual(sum(len(shard) for shard in shards.values()), len(self.graph))
+                self.assertEqual({t for shard in shards.values() for t in shard}, set(self.graph))
+        shards = main.shard_graph(self.graph, "collection")
+        collections = set(self.graph.subjects(RDF.type, OBIS.Collection))
+        self.assertEqual(len(collections), 3)
+        self.assertLessEqual(collections, set(shards))
+        # objects go with their collection, distributions with their dataset
+        owners = main.shard_owners(self.graph, "collection")
+        for sample in self.graph.subjects(RDF.type, OBIS.Object):
+            self.assertIn(owners[sample], set(self.graph.objects(sample, OBIS.relates_to)))
+        for dataset, distribution in self.graph.subject_objects(main.DCAT.distribution):
+            self.assertEqual(owners[distribution], owners[dataset])
+        # people and types are shared
+        self.assertIn(next(self.graph.subjects(RDF.type, OBIS.User)), set(shards[None].subjects()))
+        with self.assertRaises(ValueError):
+            main.shard_owners(self.graph, "sample")
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            json_file = os.path.join(tmp, "export.json")
+            with open(json_file, "w") as f:
+                json.dump(self.export, f)
+            command = [sys.executable, "-m", "openbis_json_parser.cli", json_file, "--shard", "collection", "-j", "2"]
+            output_file = os.path.join(tmp, "export.nq")
+            run = subprocess.run(
+                command + ["-o", output_file], cwd=os.path.dirname(__location__), capture_output=True, text=True
+            )
+            self.assertEqual(run.returncode, 0, run.stderr)
+            with open(output_file + ".shards.json") as f:
+                manifest = json.load(f)
+            with open(output_file, "rb") as f:
+                output = f.read()
+            self.assertEqual(len(manifest["shards"]), 6)
+            self.assertEqual(sum(shard["triples"] for shard in manifest["shards"]), len(self.graph))
+            for shard in manifest["shards"]:
+                lines = output[shard["offset"] : shard["offset"] + shard["bytes"]].splitlines()
+                self.assertEqual(len(lines), shard["triples"])
+                # the shared triples are in the default graph
+                if shard["graph"]:
+                    self.assertTrue(all(line.endswith(f"<{shard['graph']}> .".encode()) for line in lines))
+            # one file per shard
+            output_dir = os.path.join(tmp, "shards")
+            run = subprocess.run(
+                command + ["-d", output_dir, "-f", "turtle"], cwd=os.path.dirname(__location__), capture_output=True, text=True
+            )
+            self.assertEqual(run.returncode, 0, run.stderr)
+            with open(os.path.join(output_dir, "shards.json")) as f:
+                manifest = json.load(f)
+            union = Graph()
+            for shard in manifest["shards"]:
+                path = os.path.join(output_dir, shard["file"])
+                self.assertEqual(os.path.getsize(path), shard["bytes"])
+                union.parse(path, format="turtle")
+            self.assertEqual(len(union), len(self.graph))
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(__location__, "tests", "dataset.json"), "rb") as f:
+            self.source = f.read()
+        self.graph = parse_dict(json.loads(self.source))
+
+    def test_input(self):
+        for compressed in (gzip.compress(self.source), self.source):
+            with self.subTest(compressed=compressed is not self.source):
+                out = io.BytesIO()
+                stream_json(io.BytesIO(compressed), out)
+                self.assertTrue(isomorphic(Graph().parse(data=out.getvalue().decode("utf-8"), format="ntriples"), self.graph))
+                converted = convert_json(io.BytesIO(compressed), "ntriples")
+                self.assertTrue(isomorphic(Graph().parse(data=converted.decode("utf-8"), format="ntriples"), self.graph))
+        with tempfile.TemporaryDirectory() as tmp:
+            json_file = os.path.join(tmp, "dataset.json.gz")
+            with gzip.open(json_file, "wb") as f:
+                f.write(self.source)
+            self.assertTrue(isomorphic(parse_json(json_file), self.graph))
+
+    def test_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output_file = os.path.join(tmp, "dataset.nt.gz")
+            main.write_ontology(self.graph, output_file, "ntriples")
+            with gzip.open(output_file) as f:
+                self.assertTrue(isomorphic(Graph().parse(data=f.read().decode("utf-8"), format="ntriples"), self.graph))
+        # small chunks so the queue fills up, the output is the same as one gzip member
+        out = io.BytesIO()
+        data = self.source * 20
+        with main.CompressedWriter(out, chunk_size=100, queue_size=2) as writer:
+            for start in range(0, len(data), 37):
+                writer.write(data[start : start + 37])
+        self.assertEqual(gzip.decompress(out.getvalue()), data)
+        with self.assertRaises(ValueError):
+            main.open_output(io.BytesIO(), "lzma").__enter__()
+
+    def test_errors_are_raised(self):
+        class Broken(io.BytesIO):
+            # takes the gzip header, then fails
+            def write(self, data):
+                if self.tell() > 100:
+                    raise OSError("disk full")
+                return super().write(data)
+
+        writer = main.CompressedWriter(Broken(), chunk_size=10)
+        with self.assertRaises(OSError):
+            for _ in range(1000):
+                writer.write(b"x" * 100)
+            writer.close()
+
+    @unittest.skipIf(main.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        out = io.BytesIO()
+        with main.open_output(out, "zstd") as f:
+            f.write(self.source)
+        with main.open_input(io.BytesIO(out.getvalue() + main.compress_bytes(b" ", "zstd"))) as f:
+            self.assertEqual(f.read(), self.source + b" ")
+
+    def test_cli(self):
+        export = synthetic.generate_export(20, experiments=2, datasets=2, files_per_dataset=2)
+        graph = parse_dict(copy.deepcopy(export))
+        with tempfile.TemporaryDirectory() as tmp:
+            inputs = os.path.join(tmp, "inputs")
+            os.makedirs(inputs)
+            with gzip.open(os.path.join(inputs, "export.json.gz"), "wt") as f:
+                json.dump(export, f)
+            command = [sys.executable, "-m", "openbis_json_parser.cli"]
+            runs = {
+                "single.nt.gz": [os.path.join(inputs, "export.json.gz"), "-f", "ntriples"],
+                "stdout.nt": ["-", "-f", "ntriples", "-z", "gzip"],
+                "batch.nq": [inputs, "-z", "gzip"],
+            }
+            for name, arguments in runs.items():
+                with self.subTest(name), open(os.path.join(inputs, "export.json.gz"), "rb") as stdin:
+                    output_file = os.path.join(tmp, name)
+                    run = subprocess.run(
+                        command + arguments + ([] if name.startswith("stdout") else ["-o", output_file]),
+                        cwd=os.path.dirname(__location__),
+                        capture_output=True,
+                        stdin=stdin,
+                    )
+                    self.assertEqual(run.returncode, 0, run.stderr.decode())
+                    output = run.stdout if name.startswith("stdout") else pathlib.Path(output_file).read_bytes()
+                    converted = ConjunctiveGraph()
+                    converted.parse(data=gzip.decompress(output).decode("utf-8"), format="nquads")
+                    self.assertEqual(len(converted), len(graph))
+            # the compressed input keeps its name, without .json.gz
+            output_dir = os.path.join(tmp, "outputs")
+            run = subprocess.run(
+                command + [inputs, "-d", output_dir, "-f", "turtle", "-z", "gzip"],
+                cwd=os.path.dirname(__location__),
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(run.returncode, 0, run.stderr)
+            self.assertEqual(os.listdir(output_dir), ["export.ttl.gz"])
+            # each shard is a gzip member that can be read on its own
+            output_file = os.path.join(tmp, "shards.nq.gz")
+            run = subprocess.run(
+                command + [inputs, "--shard", "collection", "-o", output_file],
+                cwd=os.path.dirname(__location__),
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(run.returncode, 0, run.stderr)
+            with open(output_file + ".shards.json") as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest["compression"], "gzip")
+            with open(output_file, "rb") as f:
+                output = f.read()
+            for shard in manifest["shards"]:
+                member = gzip.decompress(output[shard["offset"] : shard["offset"] + shard["bytes"]])
+                self.assertEqual(len(member.splitlines()), shard["triples"])
+
+
+class TestEmitOnce(unittest.TestCase):
+    # every sample embeds its own copies of the same space and person, with @ids of its own
+    def person(self, ref_id):
+        return {
+            "@type": "as.dto.person.Person",
+            "@id": ref_id,
+            "userId": "admin",
+            "firstName": "Ada",
+            "permId": {"@type": "as.dto.person.id.PersonPermId", "@id": ref_id + 1, "permId": "admin"},
+            "registrationDate": 1685542100000,
+        }
+
+    def sample(self, n, space_modified=1685542100000):
+        ref_id = 100 * (n + 1)
+        space = {
+            "@type": "as.dto.space.Space",
+            "@id": ref_id + 2,
+            "code": "LAB",
+            "modificationDate": space_modified,
+            "permId": {"@type": "as.dto.space.id.SpacePermId", "@id": ref_id + 3, "permId": "LAB"},
+            "registrator": self.person(ref_id + 4),
+        }
+        return {
+            "@type": "as.dto.sample.Sample",
+            "@id": ref_id,
+            "code": f"S{n}",
+            "permId": {"@type": "as.dto.sample.id.SamplePermId", "@id": ref_id + 1, "permId": f"20230531-{n}"},
+            "space": space,
+            "registrator": self.person(ref_id + 6),
+            "modifier": self.person(ref_id + 8),
+        }
+
+    def search_result(self, objects):
+        return {"@type": "as.dto.common.search.SearchResult", "@id": 0, "objects": objects, "totalCount": len(objects)}
+
+    def test_repeats_are_linked(self):
+        data = self.search_result([self.sample(n) for n in range(3)])
+        graph, stats = parse_dict(copy.deepcopy(data), stats=True)
+        with mock.patch.object(main, "EMIT_ONCE_CLASSES", frozenset()):
+            expected = parse_dict(copy.deepcopy(data))
+        self.assertEqual(set(graph), set(expected))
+        # the persons in a repeated space are not visited at all
+        self.assertEqual(stats.repeated_entities[str(OBIS.User)], 6)
+        self.assertEqual(stats.repeated_entities[str(OBIS.Space)], 2)
+        self.assertEqual(stats.entities[str(OBIS.User)], 1)
+        for sample in graph.subjects(RDF.type, OBIS.Object):
+            self.assertIn((sample, OBIS.relates_to, URIRef(main._get_ns()["space/LAB"])), graph)
+        out = io.BytesIO()
+        stream_dict(copy.deepcopy(data), out)
+        self.assertEqual(set(Graph().parse(data=out.getvalue().decode("utf-8"), format="ntriples")), set(graph))
+
+    def test_other_versions_are_visited(self):
+        # a copy with another modificationDate or more keys is traversed again
+        newer = self.sample(1, space_modified=1685542200000)
+        newer["space"]["description"] = "moved"
+        graph, stats = parse_dict(self.search_result([self.sample(0), newer, self.sample(2)]), stats=True)
+        space = URIRef(main._get_ns()["space/LAB"])
+        self.assertEqual(len(set(graph.objects(space, main.get_obis_entity("modificationDate")))), 2)
+        self.assertEqual(stats.repeated_entities[str(OBIS.Space)], 1)
+        self.assertEqual(stats.repeated_entities[str(OBIS.User)], 7)
+
+
+class TestPropertyRegistry(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(__location__, "tests", "object.json")) as f:
+            self.data = json.load(f)
+        self.data["properties"] = {"NAME": "x", "$WEIRD:KEY": "1,5", "EXP8": "a"}
+        # the same properties again in a child
+        self.data["children"] = [dict(json.loads(json.dumps(self.data)), **{"@id": 9999, "children": []})]
+
+    def test_created_once(self):
+        for single_pass in (True, False):
+            with self.subTest(single_pass=single_pass), mock.patch.object(
+                main, "create_new_property", wraps=main.create_new_property
+            ) as create:
+                registry = PropertyRegistry()
+                parse_dict(json.loads(json.dumps(self.data)), single_pass=single_pass, properties=registry)
+                # the pre-scan of the single pass conversion creates them once more
+                self.assertEqual(create.call_count, 6 if single_pass else 3)
+                self.assertEqual(len(registry), 3)
+
+    def test_shared(self):
+        registry = PropertyRegistry()
+        output = io.BytesIO()
+        for _ in range(2):
+            stream_dict(json.loads(json.dumps(self.data)), output, properties=registry)
+        lines = output.getvalue().decode("utf-8").splitlines()
+        property_iri = registry.get(None, "EXP8", main.resolve_iris(self.data))
+        definition = f"{property_iri.n3()} {RDF.type.n3()} {main.OWL.ObjectProperty.n3()} ."
+        self.assertEqual(lines.count(definition), 1)
+
+    def test_shared_two_pass(self):
+        # the second conversion gets the iris fix_iris gave the properties in the first, not their blank nodes
+        registry = PropertyRegistry()
+        graphs = [
+            parse_dict(json.loads(json.dumps(self.data)), single_pass=False, properties=registry) for _ in range(2)
+        ]
+        properties = set(graphs[0].subjects(RDF.type, main.OWL.ObjectProperty))
+        self.assertEqual(len(properties), 3)
+        self.assertFalse(any(isinstance(predicate, main.BNode) for predicate in graphs[1].predicates()))
+        self.assertEqual(properties & set(graphs[1].predicates()), properties)
+        self.assertEqual(set(graphs[1].subjects(RDF.type, main.OWL.ObjectProperty)), set())
+
+
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.json_file = os.path.join(__location__, "tests", "object.json")
+
+    def convert(self, cache, **kwargs):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return convert_json(self.json_file, cache=cache, **kwargs)
+
+    def test_hit_skips_parsing(self):
+        cache = ConversionCache(self.tmp.name)
+        output = self.convert(cache)
+        with mock.patch.object(main, "parse_dict", side_effect=AssertionError("parsed again")):
+            self.assertEqual(self.convert(ConversionCache(self.tmp.name)), output)
+        graph = Graph()
+        graph.parse(data=output, format="turtle")
+        self.assertTrue(isomorphic(graph, parse_json(self.json_file)))
+        self.assertEqual(list(pathlib.Path(self.tmp.name).rglob("*.tmp")), [])
+
+    def test_key(self):
+        cache = ConversionCache(self.tmp.name)
+        keys = {
+            cache.key(b"{}", None, "turtle"),
+            cache.key(b"{ }", None, "turtle"),
+            cache.key(b"{}", "https://example.org/", "turtle"),
+            cache.key(b"{}", None, "ntriples"),
+        }
+        ontology_file = os.path.join(self.tmp.name, "openbis.ttl")
+        with open(ONTOLOGY_FILE, "rb") as f, open(ontology_file, "wb") as copy:
+            copy.write(f.read() + b"\n")
+        keys.add(ConversionCache(self.tmp.name, ontology_file=ontology_file).key(b"{}", None, "turtle"))
+        self.assertEqual(len(keys), 5)
+
+    def test_lru_eviction(self):
+        cache = ConversionCache(self.tmp.name, max_bytes=3500)
+        for i in range(3):
+            cache.put(f"{i:02d}", b"x" * 1000)
+            os.utime(cache.path(f"{i:02d}"), (i, i))
+        # reading the oldest entry makes the second one the least recently used
+        self.assertIsNotNone(cache.get("00"))
+        cache.put("03", b"x" * 1000)
+        self.assertIsNone(cache.get("01"))
+        for key in ("00", "02", "03"):
+            self.assertIsNotNone(cache.get(key))
+        self.assertLessEqual(cache.scan()[1], 3500)
+
+
+class TestFetch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fetch = fetch
+        cls.results = fetch.replay_results(synthetic.generate_export(60))
+
+    def test_paged_conversion(self):
+        fetch = self.fetch
+        with fetch.ReplayServer(self.results) as server:
+            output = io.BytesIO()
+            count = fetch.fetch(server.url, output, user="user", password="", jobs=3, page_size=7)
+            # every page is requested once, over at most jobs + 1 connections
+            pages = sum(-(-len(objects) // 7) or 1 for objects in self.results.values())
+            self.assertEqual(server.requests, pages + 2)
+            self.assertLessEqual(server.connections, 4)
+            # the same pages converted one after another
+            with fetch.Fetcher(server.url, token=server.token, page_size=7) as fetcher:
+                expected = io.BytesIO()
+                main.stream_documents(list(fetcher.pages()), expected, base_url=server.url)
+        self.assertEqual(count, len(output.getvalue().splitlines()))
+
+        # blank node labels differ between runs
+        def lines(data):
+            return sorted(re.sub(rb"_:\w+", b"_:b", line) for line in data.getvalue().splitlines())
+
+        self.assertEqual(lines(output), lines(expected))
+        graph = Graph().parse(data=output.getvalue(), format="nt")
+        samples = {s for s in graph.subjects(main.OBIS.code) if "/object/" in s}
+        self.assertEqual(len(samples), len(self.results["samples"]))
+
+    def test_retries(self):
+        fetch = self.fetch
+        with fetch.ReplayServer(self.results, failures=2) as server:
+            with fetch.Fetcher(server.url, retries=2, backoff=0) as fetcher:
+                fetcher.login("user", "")
+                self.assertEqual(len(list(fetcher.search("experiments"))), 1)
+        with fetch.ReplayServer(self.results, failures=3) as server:
+            with fetch.Fetcher(server.url, retries=2, backoff=0) as fetcher:
+                with self.assertRaises(fetch.FetchError):
+                    fetcher.login("user", "")
+
+    def test_invalid_token(self):
+        fetch = self.fetch
+        with fetch.ReplayServer(self.results) as server, fetch.Fetcher(server.url, token="wrong") as fetcher:
+            with self.assertRaisesRegex(fetch.FetchError, "invalid session token"):
+                list(fetcher.search("samples"))
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = server
+
+    def run_server(self, scenario, **kwargs):
+        async def run():
+            async with self.server.ConversionServer(port=0, **kwargs) as server:
+                return await scenario(server)
+
+        return asyncio.run(run())
+
+    def post(self, server, body, path="/convert", headers=None):
+        return self.server.request(server.host, server.port, "POST", path, body, headers)
+
+    def test_convert(self):
+        path = os.path.join(__location__, "tests", "dataset.json")
+        with open(path, "rb") as f:
+            body = f.read()
+
+        async def scenario(server):
+            return await asyncio.gather(
+                self.post(server, body),
+                self.post(server, body, "/convert?format=nquads"),
+                self.post(server, body, headers={"Accept": "application/n-triples"}),
+            )
+
+        expected = parse_json(path, base_url="https://openbis.matolab.org/")
+        for (status, headers, output), target_format in zip(self.run_server(scenario), ["turtle", "nquads", "nt"]):
+            with self.subTest(target_format):
+                self.assertEqual(status, 200)
+                graph = ConjunctiveGraph() if target_format == "nquads" else Graph()
+                graph.parse(data=output, format=target_format)
+                self.assertTrue(isomorphic(graph, expected))
+
+    def test_bad_requests(self):
+        async def scenario(server):
+            return [
+                (await self.post(server, b"{not json"))[0],
+                (await self.post(server, b'{"code": "\xff"}'))[0],
+                (await self.post(server, b"{}", "/convert?format=csv"))[0],
+                (await self.server.request(server.host, server.port, "GET", "/convert"))[0],
+                (await self.server.request(server.host, server.port, "GET", "/health"))[0],
+            ] + [
+                # the last content-length header is the one read
+                (await self.server.request(server.host, server.port, "POST", "/convert", b"{}", {"Content-Length": length}))[0]
+                for length in ("abc", "-1", "+2", "")
+            ]
+
+        self.assertEqual(self.run_server(scenario), [400, 400, 406, 405, 200, 400, 400, 400, 400])
+
+    def test_backpressure(self):
+        # with one conversion allowed to be pending the second request is turned away until the first is done
+        release = threading.Event()
+
+        def blocked(*args):
+            release.wait(10)
+            return b""
+
+        async def scenario(server):
+            first = asyncio.ensure_future(self.post(server, b"{}"))
+            while not server.pending:
+                await asyncio.sleep(0.01)
+            rejected = await self.post(server, b"{}")
+            release.set()
+            return (await first)[0], rejected[0], rejected[1].get("retry-after"), (await self.post(server, b"{}"))[0]
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor, mock.patch.object(self.server, "convert", blocked):
+            self.assertEqual(self.run_server(scenario, executor=executor, max_pending=1), (200, 503, "1", 200))
+
+    def test_conversion_errors(self):
+        # a conversion failing on valid json is an error of the server, whatever the exception
+        def broken(*args):
+            raise ValueError("TripleBuffer can not remove (None, None, None)")
+
+        async def scenario(server):
+            return await self.post(server, b"{}")
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor, mock.patch.object(self.server, "convert", broken):
+            status, _, body = self.run_server(scenario, executor=executor)
+        self.assertEqual(status, 500)
+        self.assertIn("ValueError", json.loads(body)["error"])
+
+
+class TestOntologyCache(unittest.TestCase):
+    def test_import_is_lazy(self):
+        # the ontology must not be parsed when the module is imported, bench_startup measures the time
+        code = (
+            "import sys\n"
+            "from openbis_json_parser import main\n"
+            "print(main._index is None, 'rdflib.plugins.parsers.notation3' in sys.modules)\n"
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", code], cwd=__location__, capture_output=True, text=True, check=True
+        ).stdout.split()
+        self.assertEqual(out, ["True", "False"])
+
+    def test_cache_is_rebuilt_on_change(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ontology_file = os.path.join(tmp, "openbis.ttl")
+            with open(ONTOLOGY_FILE) as f:
+                ontology = f.read()
+            with open(ontology_file, "w") as f:
+                f.write(ontology)
+            cache_dir = os.path.join(tmp, "cache")
+            built = load_index(ontology_file, cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = load_index(ontology_file, cache_dir)
+            self.assertEqual(dict(built.json_keys), dict(cached.json_keys))
+            self.assertEqual(dict(cached.json_keys), dict(obis_index.json_keys))
+
+            with open(ontology_file, "w") as f:
+                f.write(ontology.replace('"lastName"', '"familyName"'))
+            changed = load_index(ontology_file, cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            self.assertIn("familyName", changed.json_keys)
+            self.assertNotIn("lastName", changed.json_keys)
+
+
 if __name__ == "__main__":
     unittest.main()